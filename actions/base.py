@@ -3,10 +3,11 @@ from pathlib import Path
 from typing import Dict
 import os
 
-import jsonschema
 from dotenv import load_dotenv
 from loguru import logger
 
+import validation
+
 # Load sendgrid credentials
 env_path = Path(".") / "sendgrid.env"
 load_dotenv(dotenv_path=env_path)
@@ -18,15 +19,14 @@ class ActionConstant(Enum):
 
 
 class BaseAction:
+    __slots__ = ()
     action_type = "BASE_ACTION"
 
     def __init__(self, action_data: Dict):
         self.validate(action_data)
 
     def validate(self, action_data):
-        jsonschema.validate(
-            action_data, self.schema, format_checker=jsonschema.draft7_format_checker
-        )
+        validation.validate(action_data, type(self))
 
     def __eq__(self, other):
         return self.action_type == other
@@ -1,5 +1,6 @@
 from .base import BaseAction
 from .base import ActionConstant
+from sys import intern
 from typing import Dict
 import store
 from loguru import logger
@@ -21,16 +22,25 @@ class ChangeRelayState(BaseAction):
         "required": ["type", "device_id", "relay_index", "state"],
     }
 
+    __slots__ = ("device_id", "relay_index", "state")
+
     def __init__(self, action_data: Dict):
         super(ChangeRelayState, self).__init__(action_data)
-        self.device_id = action_data["device_id"]
+        self.device_id = intern(action_data["device_id"])
         self.relay_index = action_data["relay_index"]
         self.state = action_data["state"]
 
-    async def perform(self):
+    async def perform(self, context=None):
         finalRelayStatus = []
 
-        doc  = await store.get_document("devices", self.device_id)
+        # Reuse the device document read while evaluating the rule, if there is one
+        source = store if context is None else context
+        # Ask for the relay field, a cached reading without it falls back to Firestore
+        if self.device_id.startswith('SW2-'):
+            fields = ("relay_state",)
+        else:
+            fields = ("relayStatus",)
+        doc = await source.get_device_document(self.device_id, fields=fields)
         if(doc):
             doc_id = doc.id
             document = doc.to_dict()
@@ -45,6 +55,8 @@ class ChangeRelayState(BaseAction):
 
         final_data = {"relay_state" : finalRelayStatus[0], "insertedBy" : "dashboard"}
         await store.update_document("devices", self.device_id, final_data)
+        if context is not None:
+            context.invalidate_device_document(self.device_id)
         def f():
             logger.info(
                 f"Succesfully updated device state. States updated -> {final_data}. Path is -> devices/{self.device_id}"
@@ -25,13 +25,15 @@ class SendEmailAction(BaseAction):
         "required": ["type", "subject", "body", "to"],
     }
 
+    __slots__ = ("subject", "body", "to")
+
     def __init__(self, action_data: Dict):
         super(SendEmailAction, self).__init__(action_data)
         self.subject = action_data["subject"]
         self.body = action_data["body"]
         self.to = action_data["to"]
 
-    async def perform(self):
+    async def perform(self, context=None):
         from_email = Email("automated@thepodnet.com", name="Podnet")
         to_email = list(map(lambda x: To(x), self.to))
         message = Mail(
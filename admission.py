@@ -0,0 +1,227 @@
+import collections
+import threading
+import time
+
+import trio
+from loguru import logger
+
+# Lanes used by the VM, highest priority first
+TIMER = "timer"  # future tasks that became due
+TRIGGER = "trigger"  # rules whose devices sent new data
+BULK = "bulk"  # re-evaluations after rules were loaded or changed
+
+# What happens to an offer when its lane is full
+DROP_NEWEST = "drop newest"  # the offered item is dropped
+DROP_OLDEST = "drop oldest"  # the longest waiting item is dropped to make room
+
+
+class Lane:
+    """FIFO of items waiting to be admitted, keyed so duplicates coalesce.
+
+    A capacity of None leaves the lane unbounded, nothing is ever dropped from it.
+    """
+
+    def __init__(self, name, capacity, policy=DROP_NEWEST):
+        if policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"Unknown overload policy for the {name} lane: {policy}")
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        # key -> (item, time it entered the lane), oldest first
+        self.items = collections.OrderedDict()
+        self.admitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.promoted = 0
+        self.taken = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    @property
+    def full(self):
+        return self.capacity is not None and len(self.items) >= self.capacity
+
+    def stats(self, now):
+        oldest = next(iter(self.items.values()), None)
+        return {
+            "depth": self.depth,
+            "capacity": self.capacity,
+            "policy": self.policy,
+            "admitted": self.admitted,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "promoted": self.promoted,
+            "taken": self.taken,
+            "mean_wait": self.total_wait / self.taken if self.taken else 0.0,
+            "max_wait": self.max_wait,
+            "oldest_wait": now - oldest[1] if oldest is not None else 0.0,
+        }
+
+    def __str__(self):
+        return f"<Lane {self.name}: {self.depth}/{self.capacity}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class AdmissionQueue:
+    """Priority lanes between the threads that want a rule executed and the task spawner.
+
+    Producers never block: `offer` puts an item in its lane, an item with the
+    same key already waiting in the lane is replaced in place (coalesced). A
+    full lane drops either the offered item or its oldest item, depending on
+    its policy, and `on_drop(lane, item)` is called for the dropped item.
+    `get` returns items from the highest priority lane that has any, it runs in
+    the trio thread and producers in other threads wake it through the trio token.
+    """
+
+    def __init__(self, lanes, on_drop=None):
+        # Highest priority first, (name, capacity, policy) each
+        self._lanes = [Lane(name, capacity, policy) for name, capacity, policy in lanes]
+        self._by_name = {lane.name: lane for lane in self._lanes}
+        self.on_drop = on_drop
+        self._lock = threading.Lock()
+
+        self._trio_token = None
+        self._thread_id = None
+        self._waiter = None
+
+    def offer(self, lane_name, key, item, now=None):
+        """Queue `item` in `lane_name`. Returns False if it was dropped."""
+        now = time.monotonic() if now is None else now
+        lane = self._by_name[lane_name]
+        accepted = True
+        evicted = None
+        with self._lock:
+            if key in lane.items:
+                # Keeps its place in the lane and its wait time
+                lane.items[key] = (item, lane.items[key][1])
+                lane.coalesced += 1
+                return True
+
+            if lane.full:
+                lane.dropped += 1
+                if lane.policy == DROP_NEWEST:
+                    accepted = False
+                else:
+                    _, (evicted, _) = lane.items.popitem(last=False)
+
+            if accepted:
+                lane.items[key] = (item, now)
+                lane.admitted += 1
+
+        if not accepted:
+            self._dropped(lane, item)
+            return False
+
+        if evicted is not None:
+            self._dropped(lane, evicted)
+        self._wake_up()
+        return True
+
+    def promote(self, key, lane_name):
+        """Move the item with `key` to `lane_name` if it waits in a lower priority lane.
+
+        Returns True if it was moved.
+        """
+        target = self._by_name[lane_name]
+        dropped = None
+        with self._lock:
+            lower_lanes = self._lanes[self._lanes.index(target) + 1:]
+            source = next((lane for lane in lower_lanes if key in lane.items), None)
+            if source is None:
+                return False
+
+            if target.full:
+                if target.policy == DROP_NEWEST:
+                    # No room, it stays where it is
+                    return False
+                _, (dropped, _) = target.items.popitem(last=False)
+                target.dropped += 1
+
+            target.items[key] = source.items.pop(key)
+            target.promoted += 1
+
+        if dropped is not None:
+            self._dropped(target, dropped)
+        return True
+
+    def take(self, now=None):
+        """Remove and return (lane name, item) from the highest priority lane, None if all are empty."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for lane in self._lanes:
+                if lane.items:
+                    _, (item, enqueued_at) = lane.items.popitem(last=False)
+                    wait = now - enqueued_at
+                    lane.taken += 1
+                    lane.total_wait += wait
+                    lane.max_wait = max(lane.max_wait, wait)
+                    return lane.name, item
+
+        return None
+
+    async def get(self):
+        """Wait for the next item, returns (lane name, item)."""
+        self._trio_token = trio.lowlevel.current_trio_token()
+        self._thread_id = threading.get_ident()
+
+        while True:
+            entry = self.take()
+            if entry is not None:
+                return entry
+
+            self._waiter = trio.Event()
+            # An offer between take() and installing the waiter didn't wake anyone
+            entry = self.take()
+            if entry is not None:
+                self._waiter = None
+                return entry
+
+            await self._waiter.wait()
+            self._waiter = None
+
+    @property
+    def depth(self):
+        with self._lock:
+            return sum(lane.depth for lane in self._lanes)
+
+    def stats(self, now=None):
+        """Depth and wait time metrics of every lane, by lane name."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return {lane.name: lane.stats(now) for lane in self._lanes}
+
+    def _dropped(self, lane, item):
+        logger.warning(f"The {lane.name} lane is full ({lane.capacity}). Dropped {item}.")
+        if self.on_drop is not None:
+            self.on_drop(lane.name, item)
+
+    def _wake_up(self):
+        if self._trio_token is None:
+            # get() hasn't been called yet, it'll find the item when it is
+            return
+
+        if threading.get_ident() == self._thread_id:
+            self._set_waiter()
+            return
+
+        try:
+            self._trio_token.run_sync_soon(self._set_waiter)
+        except trio.RunFinishedError:
+            logger.error("The trio run consuming the admission queue has finished.")
+
+    def _set_waiter(self):
+        if self._waiter is not None:
+            self._waiter.set()
+
+    def __str__(self):
+        lanes = ", ".join(f"{lane.name} {lane.depth}" for lane in self._lanes)
+        return f"<AdmissionQueue: {lanes}>"
+
+    def __repr__(self):
+        return self.__str__()
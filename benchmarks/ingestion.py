@@ -0,0 +1,89 @@
+"""Messages ingested per second from a fake subscriber, per message vs batched per device.
+
+Runs offline, no PubSub or Firestore needed:
+
+    python benchmarks/ingestion.py [number of messages] [number of devices]
+
+Every trigger costs TRIGGER_COST seconds, standing in for
+execute_all_dependent_rules handing rules over to the VM thread.
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_pubsub import FakeSubscriber  # noqa: E402
+from fake_pubsub import FlowControl  # noqa: E402
+from ingestion import IngestionDispatcher  # noqa: E402
+
+SUBSCRIPTION = FakeSubscriber.subscription_path("podnet-switch", "switch-pod-4ch-state-sub")
+TRIGGER_COST = 0.0005
+
+
+class Sink:
+    def __init__(self):
+        self.triggers = 0
+
+    def process_readings(self, device_id, readings):
+        self.triggers += 1
+        time.sleep(TRIGGER_COST)
+
+
+def publish_all(subscriber, count, devices):
+    for i in range(count):
+        data = json.dumps({"relay1": i % 2, "relay2": 0, "relay3": 0, "relay4": 0})
+        subscriber.publish(
+            SUBSCRIPTION, data.encode("utf-8"), {"deviceId": f"switch-pod-4ch-{i % devices}"}
+        )
+
+
+def per_message(count, devices):
+    # What every gcp_interface callback did: decode, trigger and ack one message at a time
+    sink = Sink()
+
+    def callback(message):
+        data_packet = json.loads(message.data.decode("utf-8"))
+        device_id = message.attributes["deviceId"]
+        sink.process_readings(device_id, [("SWITCH_POD_4CH", data_packet, message.publish_time)])
+        message.ack()
+
+    with FakeSubscriber() as subscriber:
+        publish_all(subscriber, count, devices)
+        start = time.perf_counter()
+        subscriber.subscribe(SUBSCRIPTION, callback, FlowControl(10))
+        subscriber.wait_until_acked(count)
+        elapsed = time.perf_counter() - start
+    return count / elapsed, sink.triggers
+
+
+def batched(count, devices, batch_window=0.1, max_messages=100):
+    sink = Sink()
+    dispatcher = IngestionDispatcher(sink.process_readings, batch_window=batch_window)
+    dispatcher.start()
+    with FakeSubscriber() as subscriber:
+        publish_all(subscriber, count, devices)
+        start = time.perf_counter()
+        dispatcher.subscribe(subscriber, SUBSCRIPTION, "SWITCH_POD_4CH", FlowControl(max_messages))
+        subscriber.wait_until_acked(count)
+        elapsed = time.perf_counter() - start
+    dispatcher.stop()
+    return count / elapsed, sink.triggers
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    rate, triggers = per_message(count, devices)
+    print(f"per message:  {rate:8.0f} messages/s, {triggers} triggers")
+    for max_messages in (100, 1000):
+        rate, triggers = batched(count, devices, max_messages=max_messages)
+        print(
+            f"batched ({max_messages:4d} unacked): {rate:8.0f} messages/s, {triggers} triggers"
+        )
+
+
+if __name__ == "__main__":
+    main()
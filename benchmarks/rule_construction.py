@@ -0,0 +1,81 @@
+"""Rules constructed per second, with and without the cached schema validators.
+
+Run from the repository root (needs the same environment as the VM):
+
+    python benchmarks/rule_construction.py [number of rules]
+"""
+import os
+import sys
+import time
+
+import jsonschema
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rule  # noqa: E402
+import validation  # noqa: E402
+
+CONDITIONS = [
+    {"operation": "at_time", "time": "18:00:00+05:30"},
+    {"operation": "logical_and"},
+    {
+        "operation": "relay_state_for",
+        "device_id": "switch-pod-4ch-1",
+        "relay_index": 0,
+        "state": 1,
+        "for": 15,
+    },
+    {"operation": "logical_or"},
+    {"operation": "occupancy", "device_id": "sense-pod-1", "state": "occupied"},
+]
+
+ACTIONS = [
+    {
+        "type": "change_relay_state",
+        "device_id": "switch-pod-4ch-1",
+        "relay_index": 0,
+        "state": 0,
+    },
+]
+
+
+def uncached_validate(instance, owner):
+    # What every instruction and action did before the validators were cached
+    jsonschema.validate(
+        instance, owner.schema, format_checker=jsonschema.draft7_format_checker
+    )
+
+
+def construction_rate(count):
+    start = time.perf_counter()
+    for i in range(count):
+        rule.Rule(
+            id=f"rule-{i}",
+            name="Benchmark",
+            description="",
+            conditions=[dict(c) for c in CONDITIONS],
+            actions=[dict(a) for a in ACTIONS],
+        )
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # Rule logs every construction at debug level
+    from loguru import logger
+
+    logger.remove()
+
+    cached_validate = validation.validate
+    validation.validate = uncached_validate
+    before = construction_rate(count)
+    validation.validate = cached_validate
+    after = construction_rate(count)
+
+    print(f"Constructed {count} rules, {len(CONDITIONS)} conditions and {len(ACTIONS)} action each")
+    print(f"jsonschema.validate:  {before:10.1f} rules/s")
+    print(f"cached validators:    {after:10.1f} rules/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Memory used per rule and per scheduled execution handle, measured with tracemalloc.
+
+Run from the repository root (needs the same environment as the VM):
+
+    python benchmarks/rule_memory.py [number of rules]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rule  # noqa: E402
+
+CONDITIONS = [
+    {"operation": "at_time", "time": "18:00:00+05:30"},
+    {"operation": "logical_and"},
+    {
+        "operation": "relay_state_for",
+        "device_id": "switch-pod-4ch-1",
+        "relay_index": 0,
+        "state": 1,
+        "for": 15,
+    },
+    {"operation": "logical_or"},
+    {"operation": "occupancy", "device_id": "sense-pod-1", "state": "occupied"},
+]
+
+ACTIONS = [
+    {
+        "type": "change_relay_state",
+        "device_id": "switch-pod-4ch-1",
+        "relay_index": 0,
+        "state": 0,
+    },
+]
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return objects, size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    # Rule logs every construction at debug level
+    from loguru import logger
+
+    logger.remove()
+
+    # Documents are built up front, like the ones Firestore hands to the VM
+    documents = [
+        ([dict(c) for c in CONDITIONS], [dict(a) for a in ACTIONS])
+        for _ in range(count)
+    ]
+
+    rules, rules_size = measure(
+        lambda: [
+            rule.Rule(id=f"rule-{i}", conditions=conditions, actions=actions)
+            for i, (conditions, actions) in enumerate(documents)
+        ]
+    )
+    # What every pending future task holds
+    _, handles_size = measure(lambda: [r.create_clone() for r in rules])
+
+    print(f"{count} rules, {len(CONDITIONS)} conditions and {len(ACTIONS)} action each")
+    print(f"bytes per rule:               {rules_size / count:10.1f}")
+    print(f"bytes per future task handle: {handles_size / count:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
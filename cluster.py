@@ -0,0 +1,268 @@
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+
+from loguru import logger
+
+import sharding
+
+
+class HashRing:
+    """Consistent hash ring, a node joining or leaving only moves the keys next to it.
+
+    Every node is placed on the ring `replicas` times so keys are spread evenly.
+    """
+
+    REPLICAS = 64
+
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self._nodes = set()
+        # Sorted hashes of the virtual nodes and the node each one belongs to
+        self._hashes = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return zlib.crc32(key.encode("utf-8"))
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for replica in range(self.replicas):
+            h = self._hash(f"{node}#{replica}")
+            index = bisect.bisect(self._hashes, h)
+            self._hashes.insert(index, h)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        kept = [(h, owner) for h, owner in zip(self._hashes, self._owners) if owner != node]
+        self._hashes = [h for h, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def node_for(self, key):
+        """The node owning `key`, None if the ring is empty."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+    @property
+    def nodes(self):
+        return set(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __str__(self):
+        return f"<HashRing: {len(self)} nodes>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class InProcessCoordinator:
+    """Cluster membership kept in memory, for VMs running in the same process (tests).
+
+    Nodes that haven't sent a heartbeat for `ttl` seconds are considered gone.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # node_id -> time of the last heartbeat
+        self._heartbeats = {}
+
+    def heartbeat(self, node_id, now=None):
+        """Register or refresh `node_id`. Returns the live members."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._heartbeats[node_id] = now
+            return self._live(self._heartbeats, now)
+
+    def leave(self, node_id):
+        with self._lock:
+            self._heartbeats.pop(node_id, None)
+
+    def members(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._live(self._heartbeats, now)
+
+    def _live(self, heartbeats, now):
+        return {node for node, seen in heartbeats.items() if now - seen <= self.ttl}
+
+    def __str__(self):
+        return f"<InProcessCoordinator: {len(self._heartbeats)} nodes>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class FileLockCoordinator(InProcessCoordinator):
+    """Cluster membership in a JSON file guarded by an flock, for VMs on one machine
+    (or a shared filesystem), so no external service is needed.
+    """
+
+    def __init__(self, path, ttl=30):
+        super(FileLockCoordinator, self).__init__(ttl)
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def heartbeat(self, node_id, now=None):
+        now = time.time() if now is None else now
+        with self._locked():
+            heartbeats = self._read()
+            heartbeats[node_id] = now
+            # Drop long gone nodes so the file doesn't grow forever
+            heartbeats = {n: seen for n, seen in heartbeats.items() if now - seen <= 10 * self.ttl}
+            self._write(heartbeats)
+            return self._live(heartbeats, now)
+
+    def leave(self, node_id):
+        with self._locked():
+            heartbeats = self._read()
+            if heartbeats.pop(node_id, None) is not None:
+                self._write(heartbeats)
+
+    def members(self, now=None):
+        now = time.time() if now is None else now
+        with self._locked():
+            return self._live(self._read(), now)
+
+    def _locked(self):
+        return _FileLock(self.lock_path)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f"{self.path} is corrupt, starting with no members. Error: {e}")
+            return {}
+
+    def _write(self, heartbeats):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(heartbeats, f)
+        os.replace(tmp_path, self.path)
+
+    def __str__(self):
+        return f"<FileLockCoordinator: {self.path}>"
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+class ShardAssignment:
+    """The share of the rules and device subscriptions owned by one VM node.
+
+    Rules are assigned to nodes by consistent hashing of their home key (see
+    sharding.home_key). Membership comes from a coordinator, every heartbeat
+    returns the live nodes and the ring is rebuilt when they changed. Can be
+    passed to the VM as its partition.
+    """
+
+    # Heartbeats are sent this often (in seconds), well within the coordinator's ttl
+    HEARTBEAT_INTERVAL = 10
+
+    def __init__(self, node_id, coordinator, replicas=HashRing.REPLICAS):
+        self.node_id = node_id
+        self.name = node_id
+        self.coordinator = coordinator
+        self.replicas = replicas
+        self._lock = threading.Lock()
+        # Owns every rule until the first heartbeat says otherwise
+        self.ring = HashRing([node_id], replicas)
+        # Incremented every time the membership changes
+        self.generation = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def refresh(self, now=None):
+        """Send a heartbeat. Returns True if the membership changed."""
+        members = self.coordinator.heartbeat(self.node_id, now)
+        with self._lock:
+            if members == self.ring.nodes:
+                return False
+
+            joined = members - self.ring.nodes
+            left = self.ring.nodes - members
+            self.ring = HashRing(members, self.replicas)
+            self.generation += 1
+
+        logger.info(
+            f"Cluster membership changed, joined: {sorted(joined)} left: {sorted(left)}. "
+            f"{len(members)} node(s) in generation {self.generation}."
+        )
+        return True
+
+    join = refresh
+
+    def leave(self):
+        self.stop()
+        self.coordinator.leave(self.node_id)
+
+    @property
+    def members(self):
+        with self._lock:
+            return self.ring.nodes
+
+    def owner_of(self, key):
+        with self._lock:
+            return self.ring.node_for(key)
+
+    def owns_key(self, key):
+        return self.owner_of(key) == self.node_id
+
+    def owns_rule(self, rule_id, conditions):
+        return self.owns_key(sharding.rule_home_key(rule_id, conditions))
+
+    def watch(self, on_change, interval=HEARTBEAT_INTERVAL):
+        """Send heartbeats from a background thread, calling `on_change` after every membership change."""
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    if self.refresh():
+                        on_change()
+                except Exception as e:
+                    logger.error(f"Unable to refresh the shard assignment. Error: {e}")
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __str__(self):
+        return f"<ShardAssignment: {self.node_id} of {len(self.members)} nodes>"
+
+    def __repr__(self):
+        return self.__str__()
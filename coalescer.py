@@ -0,0 +1,85 @@
+import threading
+
+from loguru import logger
+
+# States of a rule known to the coalescer, rules that are neither queued
+# nor running are not tracked at all
+QUEUED = "queued"
+RUNNING = "running"
+RUNNING_RERUN = "running, re-run requested"
+
+
+class RuleCoalescer:
+    """Keeps at most one queued and one running execution per rule.
+
+    `admit` is called before a rule is handed to the VM thread. It returns
+    False when the rule is already queued (the queued execution will see the
+    new data anyway) or when it is running, in which case a single re-run is
+    recorded instead. The VM calls `start` when the execution begins and
+    `finish` when it ends, `finish` tells whether the rule has to run again.
+    Thread-safe, triggers come from the PubSub callback threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # rule_id -> one of the states above
+        self._states = {}
+        # Triggers that did not result in a new execution
+        self.suppressed = 0
+        # Executions started because the rule was triggered while running
+        self.reruns = 0
+
+    def admit(self, rule_id) -> bool:
+        with self._lock:
+            state = self._states.get(rule_id)
+            if state is None:
+                self._states[rule_id] = QUEUED
+                return True
+
+            if state == RUNNING:
+                self._states[rule_id] = RUNNING_RERUN
+            self.suppressed += 1
+
+        logger.debug(f"Rule {rule_id} is {state}. Trigger coalesced.")
+        return False
+
+    def start(self, rule_id):
+        with self._lock:
+            self._states[rule_id] = RUNNING
+
+    def finish(self, rule_id) -> bool:
+        """Called when an execution ends. If True, the rule is queued again and must be re-run."""
+        with self._lock:
+            if self._states.get(rule_id) == RUNNING_RERUN:
+                self._states[rule_id] = QUEUED
+                self.reruns += 1
+                return True
+
+            self._states.pop(rule_id, None)
+            return False
+
+    def discard(self, rule_id):
+        """Forget `rule_id`, e.g. when its queued execution is dropped."""
+        with self._lock:
+            self._states.pop(rule_id, None)
+
+    def state(self, rule_id):
+        return self._states.get(rule_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": sum(1 for s in self._states.values() if s == QUEUED),
+                "running": sum(1 for s in self._states.values() if s != QUEUED),
+                "suppressed": self.suppressed,
+                "reruns": self.reruns,
+            }
+
+    def __len__(self):
+        return len(self._states)
+
+    def __str__(self):
+        return f"<RuleCoalescer: {len(self)} rules, {self.suppressed} suppressed triggers>"
+
+    def __repr__(self):
+        return self.__str__()
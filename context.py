@@ -0,0 +1,153 @@
+import trio
+from async_generator import aclosing
+from loguru import logger
+
+import store
+
+
+class EvaluationContext:
+    """Device data read while evaluating one rule.
+
+    Instructions and actions read device documents and `generatedData`
+    through the context instead of `store`, so a rule that checks several
+    relays of the same device reads that device only once. Reads that are in
+    flight are shared as well, which matters when instructions are evaluated
+    concurrently.
+
+    When a DeviceStateCache is given, it is checked before going to Firestore.
+    When a DeviceHistory is given, `generatedData` is served from it once the
+    device has been backfilled.
+    When a StateTransitionTracker is given, *_FOR conditions look up how long
+    a device has been in a state instead of walking its history.
+    """
+
+    def __init__(self, rule=None, device_state=None, history=None, transitions=None):
+        self.rule = rule
+        self.device_state = device_state
+        self.history = history
+        self.transitions = transitions
+        self._results = {}
+        # key -> trio.Event, set once the read for that key finishes
+        self._in_flight = {}
+        # device_id -> largest `count` fetched from generatedData
+        self._generated_data_count = {}
+
+    async def get_device_document(self, device_id: str, fields=()):
+        if self.device_state is not None:
+            document = self.device_state.get_device_document(device_id, fields)
+            if document is not None:
+                return document
+
+        return await self._memoized(
+            ("devices", device_id), lambda: store.get_device_document(device_id)
+        )
+
+    async def get_generated_data(self, device_id: str, count=5):
+        if count == 1 and self.device_state is not None:
+            reading = self.device_state.get_latest_reading(device_id)
+            if reading is not None:
+                return [reading]
+
+        if self.history is not None and count <= self.history.capacity:
+            if self.history.needs_backfill(device_id, count):
+                documents = await self._memoized(
+                    ("generatedData", device_id, count),
+                    lambda: store.get_generated_data(device_id, count),
+                )
+                self.history.backfill(device_id, documents, count)
+            return self.history.recent(device_id, count)
+
+        fetched_count = self._generated_data_count.get(device_id)
+        if fetched_count is not None:
+            documents = self._results[("generatedData", device_id, fetched_count)]
+            # Fewer documents than requested means there are no more to fetch
+            if fetched_count >= count or len(documents) < fetched_count:
+                return documents[:count]
+
+        documents = await self._memoized(
+            ("generatedData", device_id, count),
+            lambda: store.get_generated_data(device_id, count),
+        )
+        if count > self._generated_data_count.get(device_id, 0):
+            self._generated_data_count[device_id] = count
+        return documents
+
+    async def iter_generated_data(self, device_id: str, page_size=20, limit=None):
+        """Same as `store.iter_generated_data`, from the device history when it can hold `limit` readings."""
+        if (
+            self.history is not None
+            and limit is not None
+            and limit <= self.history.capacity
+        ):
+            if not self.history.needs_backfill(device_id, limit):
+                for document in self.history.recent(device_id, limit):
+                    yield document
+                return
+
+            # Backfilled page by page, a caller that stops early doesn't pay
+            # for the rest. The history only knows as much as was read.
+            documents = []
+            complete = False
+            try:
+                async with aclosing(
+                    store.iter_generated_data(device_id, page_size, limit)
+                ) as pages:
+                    async for document in pages:
+                        documents.append(document)
+                        yield document
+                complete = True
+            finally:
+                self.history.backfill(
+                    device_id, documents, limit if complete else len(documents)
+                )
+            return
+
+        async with aclosing(
+            store.iter_generated_data(device_id, page_size, limit)
+        ) as documents:
+            async for document in documents:
+                yield document
+
+    def state_since(self, device_id: str, channel: str):
+        """ChannelState of a device channel if its last transition is known, else None."""
+        if self.transitions is None:
+            return None
+        state = self.transitions.state_since(device_id, channel)
+        if state is None or not state.exact:
+            return None
+        return state
+
+    def seed_state(self, device_id: str, channel: str, state, since):
+        """Record a transition found while walking the history of a device."""
+        if self.transitions is not None:
+            self.transitions.seed(device_id, channel, state, since)
+
+    def invalidate_device_document(self, device_id: str):
+        """Called after writing to a device document, later reads go to Firestore."""
+        self._results.pop(("devices", device_id), None)
+        if self.device_state is not None:
+            self.device_state.invalidate_device_document(device_id)
+
+    async def _memoized(self, key, fetch):
+        while key in self._in_flight:
+            await self._in_flight[key].wait()
+
+        if key in self._results:
+            logger.debug(f"Using {key} read earlier in this evaluation")
+            return self._results[key]
+
+        event = trio.Event()
+        self._in_flight[key] = event
+        try:
+            self._results[key] = await fetch()
+        finally:
+            del self._in_flight[key]
+            event.set()
+
+        return self._results[key]
+
+    def __str__(self):
+        return f"<EvaluationContext for {self.rule}: {len(self._results)} reads>"
+
+    def __repr__(self):
+        return self.__str__()
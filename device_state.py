@@ -0,0 +1,142 @@
+import datetime
+import threading
+import time
+from typing import Dict
+
+import pytz
+
+# Device families, one per PubSub subscription
+SLIDE_POD = "slide_pod"
+SURGE_POD_1P = "surge_pod_1p"
+SURGE_POD_3P = "surge_pod_3p"
+SENSE_POD = "sense_pod"
+SWITCH_POD_1CHPM = "switch_pod_1chpm"
+SWITCH_POD_4CH = "switch_pod_4ch"
+
+
+def _passthrough(data_packet: Dict) -> Dict:
+    return dict(data_packet)
+
+
+def _switch_pod_1chpm(data_packet: Dict) -> Dict:
+    fields = dict(data_packet)
+    # 1chpm device does not have mutiple relays
+    if "relay_status" in data_packet:
+        fields["relayStatus"] = [data_packet["relay_status"]]
+    return fields
+
+
+def _switch_pod_4ch(data_packet: Dict) -> Dict:
+    fields = dict(data_packet)
+    relay_keys = [f"relay{i}" for i in range(1, 5)]
+    if all(key in data_packet for key in relay_keys):
+        fields["relayStatus"] = [data_packet[key] for key in relay_keys]
+    return fields
+
+
+# Turns a decoded PubSub payload into fields of the device document
+FAMILY_NORMALIZERS = {
+    SLIDE_POD: _passthrough,
+    SURGE_POD_1P: _passthrough,
+    SURGE_POD_3P: _passthrough,
+    SENSE_POD: _passthrough,
+    SWITCH_POD_1CHPM: _switch_pod_1chpm,
+    SWITCH_POD_4CH: _switch_pod_4ch,
+}
+
+
+class CachedDocument:
+    """Stands in for a Firestore DocumentSnapshot built from cached device state."""
+
+    exists = True
+
+    def __init__(self, id, data):
+        self.id = id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+    def __str__(self):
+        return f"<CachedDocument {self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class DeviceStateCache:
+    """Latest state of every device, kept up to date from PubSub messages.
+
+    Two things are cached per device: the latest reading, which is what the
+    newest `generatedData` document would hold, and the device document fields
+    derived from the readings. Device documents can also be changed by other
+    writers (e.g. the dashboard changing a relay), so they are only served for
+    `max_age` seconds after the last message.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # device_id -> latest reading, including its `creation_timestamp`
+        self._readings = {}
+        # device_id -> (received at, merged device document fields)
+        self._devices = {}
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, device_id: str, family: str, data_packet: Dict, timestamp=None):
+        """Record a decoded PubSub payload sent by `device_id`."""
+        if timestamp is None:
+            timestamp = datetime.datetime.now(pytz.timezone("UTC"))
+
+        normalizer = FAMILY_NORMALIZERS.get(family, _passthrough)
+        reading = dict(data_packet)
+        reading["creation_timestamp"] = timestamp
+
+        with self._lock:
+            self._readings[device_id] = reading
+            _, fields = self._devices.get(device_id, (None, {}))
+            fields = {**fields, **normalizer(data_packet)}
+            self._devices[device_id] = (time.monotonic(), fields)
+
+        return reading
+
+    def get_latest_reading(self, device_id: str):
+        """Latest reading of `device_id` or None if nothing was received from it."""
+        reading = self._readings.get(device_id)
+        self._count(reading is not None)
+        return reading
+
+    def get_device_document(self, device_id: str, fields=()):
+        """Cached device document, None if it's missing, stale or lacks any of `fields`."""
+        received_at, data = self._devices.get(device_id, (None, None))
+        if (
+            data is None
+            or time.monotonic() - received_at > self.max_age
+            or any(field not in data for field in fields)
+        ):
+            self._count(False)
+            return None
+
+        self._count(True)
+        return CachedDocument(device_id, data)
+
+    def invalidate_device_document(self, device_id: str):
+        """Stop serving the device document of `device_id` until its next message."""
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def __len__(self):
+        return len(self._readings)
+
+    def __str__(self):
+        return f"<DeviceStateCache: {len(self)} devices, {self.hits} hits, {self.misses} misses>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,158 @@
+"""In-memory stand-in for the PubSub SubscriberClient, for tests and offline benchmarks.
+
+Only the parts gcp_interface uses: subscription_path, subscribe with flow
+control, messages with ack/nack and the client as a context manager. Nacked
+messages are redelivered.
+"""
+import datetime
+import queue
+import threading
+
+
+class FlowControl:
+    def __init__(self, max_messages=10):
+        self.max_messages = max_messages
+
+
+class FakeMessage:
+    def __init__(self, data: bytes, attributes, publish_time=None, settled=None):
+        self.data = data
+        self.attributes = attributes
+        self.publish_time = publish_time or datetime.datetime.now(datetime.timezone.utc)
+        self.acked = False
+        self.nacked = False
+        # Called with the message and True (ack) or False (nack)
+        self._settled = settled
+
+    def ack(self):
+        if self.acked or self.nacked:
+            return
+        self.acked = True
+        if self._settled is not None:
+            self._settled(self, True)
+
+    def nack(self):
+        if self.acked or self.nacked:
+            return
+        self.nacked = True
+        if self._settled is not None:
+            self._settled(self, False)
+
+    def __str__(self):
+        return f"<FakeMessage: {self.attributes}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class FakeStreamingPullFuture:
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def result(self, timeout=None):
+        # Like the real one, only returns once the subscription is cancelled
+        if not self._cancelled.wait(timeout):
+            raise TimeoutError("Subscription is still running")
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+class _Subscription:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.future = None
+
+
+class FakeSubscriber:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settled = threading.Condition(self._lock)
+        self._subscriptions = {}
+        self._threads = []
+        self.published = 0
+        self.delivered = 0
+        self.acked = 0
+        self.nacked = 0
+
+    @staticmethod
+    def subscription_path(project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def _subscription(self, path):
+        with self._lock:
+            return self._subscriptions.setdefault(path, _Subscription())
+
+    def publish(self, subscription, data: bytes, attributes, publish_time=None):
+        """Queue a message on `subscription`, delivered once it is subscribed to."""
+        with self._lock:
+            self.published += 1
+        self._subscription(subscription).queue.put((data, attributes, publish_time))
+
+    def subscribe(self, subscription, callback, flow_control=None):
+        sub = self._subscription(subscription)
+        sub.future = FakeStreamingPullFuture()
+        max_messages = flow_control.max_messages if flow_control is not None else 1000
+        thread = threading.Thread(
+            target=self._deliver,
+            args=(subscription, sub, callback, threading.BoundedSemaphore(max_messages)),
+            daemon=True,
+        )
+        thread.start()
+        self._threads.append(thread)
+        return sub.future
+
+    def _deliver(self, path, sub, callback, outstanding):
+        def settled(message, acked):
+            outstanding.release()
+            with self._lock:
+                if acked:
+                    self.acked += 1
+                else:
+                    self.nacked += 1
+                self._settled.notify_all()
+            if not acked:
+                sub.queue.put((message.data, message.attributes, message.publish_time))
+
+        while not sub.future.cancelled():
+            # Flow control, no more than max_messages unsettled messages
+            if not outstanding.acquire(timeout=0.05):
+                continue
+            try:
+                data, attributes, publish_time = sub.queue.get(timeout=0.05)
+            except queue.Empty:
+                outstanding.release()
+                continue
+
+            with self._lock:
+                self.delivered += 1
+            callback(FakeMessage(data, attributes, publish_time, settled))
+
+    def wait_until_acked(self, count, timeout=None):
+        """Block until `count` messages were acked in total. Returns False on timeout."""
+        with self._lock:
+            return self._settled.wait_for(lambda: self.acked >= count, timeout)
+
+    def close(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+        for sub in subscriptions:
+            if sub.future is not None:
+                sub.future.cancel()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __str__(self):
+        return f"<FakeSubscriber: {self.published} published, {self.acked} acked>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -1,212 +1,126 @@
-import json
+import os
 
+from google.api_core.exceptions import AlreadyExists
+from google.api_core.exceptions import NotFound
 from google.cloud import pubsub_v1
 from loguru import logger
 
+import cluster
+import device_state
+from ingestion import IngestionDispatcher
+from sharding import ShardedVM
 from vm import VM
 
-# Start the VM and add rules from DB
-rule_vm = VM()
-rule_vm.sync_rules()
+# Number of VM processes, rules are sharded by device id when there is more than one
+VM_WORKERS = int(os.getenv("VM_WORKERS", "1"))
+# Set on every VM node when the rules are sharded over several machines
+VM_NODE_ID = os.getenv("VM_NODE_ID")
+# Membership file of the nodes, on a filesystem every node can lock
+VM_CLUSTER_FILE = os.getenv("VM_CLUSTER_FILE", "cluster.json")
+# Readings of a device received within this many seconds trigger its rules once
+INGESTION_BATCH_WINDOW = float(os.getenv("INGESTION_BATCH_WINDOW", "0.1"))
 
+project_id = "podnet-switch"
 
-def slide_pod_callback(message):
-    device_id = message.attributes["deviceId"]
-
-    # Parse the incoming message, if the message is parsable
-    # only then run dependent device rules.
-    try:
-        raw_string = message.data.decode("utf-8")
-        # logger.debug(f"Raw Message from {device_id} -> {raw_string}")
-        data_packet = json.loads(raw_string)
-    except json.JSONDecodeError:
-        logger.error(f"Unable to decode JSON message from {device_id}")
-        return
-
-    device_id = message.attributes["deviceId"]
-
-    # Execute all rules that depend on the state of given device_id
-    rule_vm.execute_all_dependent_rules(device_id)
-
-    # Acknowledge Cloud PubSub message
-    message.ack()
-
-
-def surge_pod_1p_callback(message):
-    device_id = message.attributes["deviceId"]
-
-    # Parse the incoming message, if the message is parsable
-    # only then run dependent device rules.
-    try:
-        raw_string = message.data.decode("utf-8")
-        # logger.debug(f"Raw Message from {device_id} -> {raw_string}")
-        data_packet = json.loads(raw_string)
-
-    except json.JSONDecodeError:
-        logger.error(f"Unable to decode JSON message from {device_id}")
-        return
-
-    # Execute all rules that depend on the state of given device_id
-    rule_vm.execute_all_dependent_rules(device_id)
-
-    # Acknowledge Cloud PubSub message
-    message.ack()
-
-
-def surge_pod_3p_callback(message):
-    device_id = message.attributes["deviceId"]
-
-    # Parse the incoming message, if the message is parsable
-    # only then run dependent device rules.
-    try:
-        raw_string = message.data.decode("utf-8")
-        # logger.debug(f"Raw Message from {device_id} -> {raw_string}")
-        data_packet = json.loads(raw_string)
-
-    except json.JSONDecodeError:
-        logger.error(f"Unable to decode JSON message from {device_id}")
-        return
-
-    # Execute all rules that depend on the state of given device_id
-    rule_vm.execute_all_dependent_rules(device_id)
-
-    # Acknowledge Cloud PubSub message
-    message.ack()
-
-
-def sense_pod_callback(message):
-    device_id = message.attributes["deviceId"]
-
-    # Parse the incoming message, if the message is parsable
-    # only then run dependent device rules.
-    try:
-        raw_string = message.data.decode("utf-8")
-        # logger.debug(f"Raw Message from {device_id} -> {raw_string}")
-        data_packet = json.loads(raw_string)
-    except json.JSONDecodeError:
-        logger.error(f"Unable to decode JSON message from {device_id}")
-        return
-
-    # Execute all rules that depend on the state of given device_id
-    rule_vm.execute_all_dependent_rules(device_id)
-
-    # Acknowledge Cloud PubSub message
-    message.ack()
-
-
-def switch_pod_1chpm_callback(message):
-    # Parse the incoming message, if the message is parsable
-    # only then run dependent device rules.
-    device_id = message.attributes["deviceId"]
-
+# Subscription, device family and how many of its messages may be unacked. Messages
+# are acked per batch, a subscription can't go faster than this many messages
+# per INGESTION_BATCH_WINDOW.
+SUBSCRIPTIONS = [
+    ("slide-pod-state-sub", device_state.SLIDE_POD, 1000),
+    ("surge-pod-1p-state-sub", device_state.SURGE_POD_1P, 1000),
+    ("surge-pod-3p-state-sub", device_state.SURGE_POD_3P, 1000),
+    ("sense-pod-state-sub", device_state.SENSE_POD, 1000),
+    ("switch-pod-1chpm-state-sub", device_state.SWITCH_POD_1CHPM, 1000),
+    ("switch-pod-4ch-state-sub", device_state.SWITCH_POD_4CH, 1000),
+]
+
+
+def start_vm():
+    # Start the VM and add rules from DB
+    if VM_NODE_ID is not None:
+        assignment = cluster.ShardAssignment(
+            VM_NODE_ID, cluster.FileLockCoordinator(VM_CLUSTER_FILE)
+        )
+        assignment.join()
+        vm = VM(partition=assignment)
+        vm.sync_rules()
+        assignment.watch(vm.rebalance)
+        return vm
+
+    if VM_WORKERS > 1:
+        vm = ShardedVM(VM_WORKERS)
+    else:
+        vm = VM()
+    vm.sync_rules()
+    return vm
+
+
+def subscription_path(subscriber, name):
+    """Path of the subscription this VM listens on for `name`.
+
+    Nodes sharing a subscription would split its messages between them, so
+    every node gets its own subscription `<name>-<VM_NODE_ID>` on the same
+    topic, created on first start. Each node receives every reading (the
+    device state it caches has to stay current), only rule evaluation is split.
+    """
+    shared_path = subscriber.subscription_path(project_id, name)
+    if VM_NODE_ID is None:
+        return shared_path
+
+    node_path = subscriber.subscription_path(project_id, f"{name}-{VM_NODE_ID}")
     try:
-        raw_string = message.data.decode("utf-8")
-        # logger.debug(f"Raw Message from {device_id} -> {raw_string}")
-        data_packet = json.loads(raw_string)
-    except json.JSONDecodeError:
-        logger.error(f"Unable to decode JSON message from {device_id}")
-        return
-
-    # Execute all rules that depend on the state of given device_id
-    rule_vm.execute_all_dependent_rules(device_id)
-
-    # Acknowledge Cloud PubSub message
-    message.ack()
-
+        subscriber.get_subscription(request={"subscription": node_path})
+    except NotFound:
+        shared = subscriber.get_subscription(request={"subscription": shared_path})
+        try:
+            subscriber.create_subscription(
+                request={"name": node_path, "topic": shared.topic}
+            )
+            logger.info(f"Created {node_path} on {shared.topic}")
+        except AlreadyExists:
+            pass
+    return node_path
+
+
+def main():
+    rule_vm = start_vm()
+    dispatcher = IngestionDispatcher(
+        rule_vm.process_readings, batch_window=INGESTION_BATCH_WINDOW
+    )
+    dispatcher.start()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    futures = []
+    for name, family, max_messages in SUBSCRIPTIONS:
+        subscription = subscription_path(subscriber, name)
+        futures.append(
+            dispatcher.subscribe(
+                subscriber,
+                subscription,
+                family,
+                pubsub_v1.types.FlowControl(max_messages=max_messages),
+            )
+        )
 
-def switch_pod_4ch_callback(message):
-    # Parse the incoming message, if the message is parsable
-    # only then run dependent device rules.
-    device_id = message.attributes["deviceId"]
+    # Section responsible for pulling messages from PubSub
+    with subscriber:
+        try:
+            for future in futures:
+                future.result()
 
-    try:
-        raw_string = message.data.decode("utf-8")
-        # logger.debug(f"Raw Message from {device_id} -> {raw_string}")
-        data_packet = json.loads(raw_string)
-    except json.JSONDecodeError:
-        logger.error(f"Unable to decode JSON message from {device_id}")
-        return
+        except TimeoutError as e:
+            logger.error(f"Request timed out. Error: {e}")
 
-    # Execute all rules that depend on the state of given device_id
-    rule_vm.execute_all_dependent_rules(device_id)
+        except Exception as ex:
+            logger.error(
+                f"Some error happened in the underlying execution. PubSub Callback Error: {ex}"
+            )
+            for future in futures:
+                future.cancel()
 
-    # Acknowledge Cloud PubSub message
-    message.ack()
+    dispatcher.stop()
 
 
-project_id = "podnet-switch"
-
-subscriber = pubsub_v1.SubscriberClient()
-flow_control = pubsub_v1.types.FlowControl(max_messages=10)
-
-# Slide Pod subscription
-slide_pod_sub = subscriber.subscription_path(project_id, "slide-pod-state-sub")
-slide_pod_future = subscriber.subscribe(
-    slide_pod_sub, callback=slide_pod_callback, flow_control=flow_control
-)
-logger.info(f"Listening for messages on {slide_pod_sub}...")
-
-# Surge Pod 1 Phase subscription
-surge_pod_1p_sub = subscriber.subscription_path(project_id, "surge-pod-1p-state-sub")
-surge_pod_1p_future = subscriber.subscribe(
-    surge_pod_1p_sub, callback=surge_pod_1p_callback, flow_control=flow_control
-)
-logger.info(f"Listening for messages on {surge_pod_1p_sub}...")
-
-# Surge Pod 3 Phase subscription
-surge_pod_3p_sub = subscriber.subscription_path(project_id, "surge-pod-3p-state-sub")
-surge_pod_3p_future = subscriber.subscribe(
-    surge_pod_3p_sub, callback=surge_pod_3p_callback, flow_control=flow_control
-)
-logger.info(f"Listening for messages on {surge_pod_3p_sub}...")
-
-
-# Sense Pod subscription
-sense_pod_sub = subscriber.subscription_path(project_id, "sense-pod-state-sub")
-sense_pod_future = subscriber.subscribe(
-    sense_pod_sub, callback=sense_pod_callback, flow_control=flow_control
-)
-logger.info(f"Listening for messages on {sense_pod_sub}...")
-
-# Switch Pod 1 Channel with PM subscription
-switch_pod_1chpm_sub = subscriber.subscription_path(
-    project_id, "switch-pod-1chpm-state-sub"
-)
-switch_pod_1chpm_future = subscriber.subscribe(
-    switch_pod_1chpm_sub, callback=switch_pod_1chpm_callback, flow_control=flow_control
-)
-logger.info(f"Listening for messages on {switch_pod_1chpm_sub}...")
-
-# Switch Pod 4 Channel subscription
-switch_pod_4ch_sub = subscriber.subscription_path(
-    project_id, "switch-pod-4ch-state-sub"
-)
-switch_pod_4ch_future = subscriber.subscribe(
-    switch_pod_4ch_sub, callback=switch_pod_4ch_callback, flow_control=flow_control
-)
-logger.info(f"Listening for messages on {switch_pod_4ch_sub}...")
-
-
-# Section responsible for pulling messages from PubSub
-with subscriber:
-    try:
-        slide_pod_future.result()
-        surge_pod_1p_future.result()
-        surge_pod_3p_future.result()
-        sense_pod_future.result()
-        switch_pod_1chpm_future.result()
-        switch_pod_4ch_future.result()
-
-    except TimeoutError as e:
-        logger.error(f"Request timed out. Error: {e}")
-
-    except Exception as ex:
-        logger.error(
-            f"Some error happened in the underlying execution. PubSub Callback Error: {ex}"
-        )
-        slide_pod_future.cancel()
-        surge_pod_1p_future.cancel()
-        surge_pod_3p_future.cancel()
-        sense_pod_future.cancel()
-        switch_pod_1chpm_future.cancel()
-        switch_pod_4ch_future.cancel()
+# Workers are spawned processes that import this module, they must not start a VM
+if __name__ == "__main__":
+    main()
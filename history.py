@@ -0,0 +1,101 @@
+import collections
+import datetime
+import itertools
+import threading
+from typing import Dict
+
+from loguru import logger
+
+
+class DeviceHistory:
+    """Recent readings of every device, newest last, kept in bounded ring buffers.
+
+    Readings are recorded as PubSub messages arrive. The first time more than
+    the latest reading of a device is needed, the buffer is backfilled from
+    `generatedData`. After that the buffer is always at least as deep as the
+    backfill (up to `capacity`), since new readings only add to the front.
+    """
+
+    # A `generatedData` document this close to a reading received over PubSub
+    # is the same reading
+    SAME_READING_WINDOW = datetime.timedelta(seconds=5)
+
+    def __init__(self, capacity=720):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # device_id -> deque of readings ordered by `creation_timestamp`
+        self._readings = {}
+        # device_id -> number of readings the buffer is known to hold
+        self._depth = {}
+        self.backfills = 0
+
+    def record(self, device_id: str, reading: Dict):
+        """Add a reading carrying a `creation_timestamp`."""
+        with self._lock:
+            readings = self._buffer(device_id)
+            timestamp = reading["creation_timestamp"]
+            if not readings or readings[-1]["creation_timestamp"] <= timestamp:
+                readings.append(reading)
+                return
+
+            # Out of order, find its place from the newest end
+            index = len(readings)
+            while index > 0 and readings[index - 1]["creation_timestamp"] > timestamp:
+                index -= 1
+            if len(readings) == self.capacity:
+                if index == 0:
+                    # Older than everything in a full buffer
+                    return
+                readings.popleft()
+                index -= 1
+            readings.insert(index, reading)
+
+    def needs_backfill(self, device_id: str, count: int) -> bool:
+        return count <= self.capacity and self._depth.get(device_id, 0) < count
+
+    def backfill(self, device_id: str, documents, count: int):
+        """Merge `count` documents read from `generatedData`, newest first.
+
+        Documents overlapping readings already recorded are skipped.
+        """
+        with self._lock:
+            readings = self._buffer(device_id)
+            if readings:
+                oldest = readings[0]["creation_timestamp"] - self.SAME_READING_WINDOW
+            else:
+                oldest = None
+
+            for document in documents:
+                if len(readings) == self.capacity:
+                    break
+                if oldest is None or document["creation_timestamp"] < oldest:
+                    readings.appendleft(document)
+
+            # Fewer documents than asked for is all the history there is
+            depth = self.capacity if len(documents) < count else count
+            self._depth[device_id] = max(self._depth.get(device_id, 0), depth)
+            self.backfills += 1
+
+        logger.debug(f"Backfilled history of {device_id} with {len(documents)} document(s)")
+
+    def recent(self, device_id: str, count: int):
+        """Up to `count` latest readings of `device_id`, newest first."""
+        with self._lock:
+            readings = self._readings.get(device_id, ())
+            return list(itertools.islice(reversed(readings), count))
+
+    def _buffer(self, device_id):
+        readings = self._readings.get(device_id)
+        if readings is None:
+            readings = collections.deque(maxlen=self.capacity)
+            self._readings[device_id] = readings
+        return readings
+
+    def __len__(self):
+        return len(self._readings)
+
+    def __str__(self):
+        return f"<DeviceHistory: {len(self)} devices, {self.backfills} backfills>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,146 @@
+import json
+import threading
+
+from loguru import logger
+
+
+class IngestionDispatcher:
+    """Single entry point for device readings from every PubSub subscription.
+
+    Callbacks only decode the message and queue the reading. Every
+    `batch_window` seconds the queued readings are handed over per device, so
+    a burst from one device triggers its rules once, and the messages of the
+    batch are acked together afterwards. Messages whose readings couldn't be
+    processed are nacked, PubSub redelivers them.
+
+    `process_readings(device_id, readings)` receives the readings of one device
+    as a list of (family, data_packet, publish_time), oldest first.
+    """
+
+    def __init__(self, process_readings, batch_window=0.1):
+        self.process_readings = process_readings
+        self.batch_window = batch_window
+        self._lock = threading.Lock()
+        # device_id -> ([readings], [messages])
+        self._pending = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.rejected = 0
+        self.batches = 0
+        self.triggers = 0
+        self.acked = 0
+        self.nacked = 0
+
+    def subscribe(self, subscriber, subscription, family, flow_control):
+        """Listen on `subscription`, whose messages carry readings of device `family`.
+
+        `flow_control` caps the messages of this subscription that are waiting
+        for their batch, it should allow for a full batch window of messages.
+        """
+        future = subscriber.subscribe(
+            subscription, callback=self.callback_for(family), flow_control=flow_control
+        )
+        logger.info(f"Listening for messages on {subscription}...")
+        return future
+
+    def callback_for(self, family):
+        def callback(message):
+            self.receive(message, family)
+
+        return callback
+
+    def receive(self, message, family):
+        device_id = message.attributes["deviceId"]
+
+        # Parse the incoming message, if the message is parsable
+        # only then run dependent device rules.
+        try:
+            data_packet = json.loads(message.data.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.error(f"Unable to decode JSON message from {device_id}")
+            # Redelivering it wouldn't help, it would only take up the flow control window
+            message.ack()
+            with self._lock:
+                self.rejected += 1
+            return
+
+        with self._lock:
+            readings, messages = self._pending.setdefault(device_id, ([], []))
+            readings.append((family, data_packet, message.publish_time))
+            messages.append(message)
+            self.received += 1
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(len(messages) for _, messages in self._pending.values())
+
+    def flush(self):
+        """Hand the queued readings over and settle their messages. Returns the number of devices."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        if not pending:
+            return 0
+
+        processed = []
+        failed = []
+        for device_id, (readings, messages) in pending.items():
+            try:
+                self.process_readings(device_id, readings)
+                processed.extend(messages)
+            except Exception as e:
+                logger.error(
+                    f"Unable to process {len(readings)} reading(s) from {device_id}. Error: {e}"
+                )
+                failed.extend(messages)
+
+        for message in processed:
+            message.ack()
+        for message in failed:
+            message.nack()
+
+        with self._lock:
+            self.batches += 1
+            self.triggers += len(pending)
+            self.acked += len(processed)
+            self.nacked += len(failed)
+        logger.debug(
+            f"Processed readings of {len(pending)} device(s), acked {len(processed)} message(s)"
+        )
+        return len(pending)
+
+    def run(self):
+        while not self._stopped.wait(self.batch_window):
+            self.flush()
+        # Don't leave readings behind that were received before stopping
+        self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        logger.info("Started ingestion dispatcher.")
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "received": self.received,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "triggers": self.triggers,
+                "acked": self.acked,
+                "nacked": self.nacked,
+            }
+
+    def __str__(self):
+        return f"<IngestionDispatcher: {self.received} received, {self.triggers} triggers>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -1,6 +1,7 @@
 from enum import Enum
 
-import jsonschema
+import store
+import validation
 
 
 class InstructionConstant(Enum):
@@ -23,24 +24,38 @@ class InstructionConstant(Enum):
 
 
 class BaseInstruction:
+    # Instructions are part of the rule template and only keep what they need
+    # to evaluate, the raw condition data isn't kept around
+    __slots__ = ()
 
     name = "BASE_INSTRUCTION"
-    rule = None
+    # Relative cost of evaluating this instruction, 0 for instructions that
+    # don't need to read anything from the backend. Cheaper operands of a
+    # logical operator are evaluated first.
+    cost = 1
+    # Instructions that schedule the rule's next evaluation as a side effect.
+    # They're evaluated even when short-circuiting decides the result without them.
+    schedules = False
 
-    def __init__(self, json_data, rule):
-        self.json_data = json_data
-        self.rule = rule
-        self.validate_data()
+    def transition_channels(self):
+        """(device_id, channel) pairs whose transitions this instruction looks up."""
+        return ()
 
-    def evaluate(self, vm_instance):
+    def __init__(self, json_data):
+        self.validate_data(json_data)
+
+    def evaluate(self, vm_instance, context=None):
         pass
 
-    def validate_data(self):
+    @staticmethod
+    def data_source(context):
+        """Device data is read through the evaluation context when there is one."""
+        return store if context is None else context
+
+    def validate_data(self, json_data):
         # This will raise ValidationError or SchemaError,
         # both of which we'll allow to propagate upwards
-        jsonschema.validate(
-            self.json_data, self.schema, format_checker=jsonschema.draft7_format_checker
-        )
+        validation.validate(json_data, type(self))
 
     def __str__(self):
         return f"<Instruction '{self.name}'>"
@@ -0,0 +1,147 @@
+import trio
+from loguru import logger
+
+from .base import InstructionConstant
+from .base import InstructionException
+
+
+class InstructionNode:
+    """Leaf of an evaluation tree, wraps a single operand instruction."""
+
+    __slots__ = ("instruction", "cost", "scheduling_leaves")
+
+    def __init__(self, instruction):
+        self.instruction = instruction
+        self.cost = instruction.cost
+        self.scheduling_leaves = (self,) if instruction.schedules else ()
+
+    async def evaluate(self, vm_instance, context=None, results=None):
+        if results is not None and self in results:
+            return results[self]
+        return await self.instruction.evaluate(vm_instance, context)
+
+    def leaves(self):
+        return [self]
+
+    def __str__(self):
+        return str(self.instruction)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class LogicalNode:
+    __slots__ = ("cost", "operands", "scheduling_leaves")
+    operator = None
+
+    def __init__(self, left, right):
+        self.cost = left.cost + right.cost
+        self.scheduling_leaves = left.scheduling_leaves + right.scheduling_leaves
+        # Evaluate the cheaper operand first. If it decides the result, the
+        # expensive one (usually a Firestore read) is never evaluated.
+        if left.cost <= right.cost:
+            self.operands = (left, right)
+        else:
+            self.operands = (right, left)
+
+    def leaves(self):
+        return self.operands[0].leaves() + self.operands[1].leaves()
+
+    @staticmethod
+    async def skip(node, vm_instance, context=None, results=None):
+        """Skip `node`, only its scheduling leaves are evaluated so the rule's next run isn't lost."""
+        for leaf in node.scheduling_leaves:
+            await leaf.evaluate(vm_instance, context, results)
+
+    def __str__(self):
+        return f"({self.operands[0]} {self.operator} {self.operands[1]})"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class LogicalAndNode(LogicalNode):
+    __slots__ = ()
+    operator = "AND"
+
+    async def evaluate(self, vm_instance, context=None, results=None):
+        first, second = self.operands
+        if not await first.evaluate(vm_instance, context, results):
+            logger.debug(f"{first} is False. Skipping evaluation of {second}")
+            await self.skip(second, vm_instance, context, results)
+            return False
+
+        return bool(await second.evaluate(vm_instance, context, results))
+
+
+class LogicalOrNode(LogicalNode):
+    __slots__ = ()
+    operator = "OR"
+
+    async def evaluate(self, vm_instance, context=None, results=None):
+        first, second = self.operands
+        if await first.evaluate(vm_instance, context, results):
+            logger.debug(f"{first} is True. Skipping evaluation of {second}")
+            await self.skip(second, vm_instance, context, results)
+            return True
+
+        return bool(await second.evaluate(vm_instance, context, results))
+
+
+def compile_instruction_stream(instruction_stream):
+    """Build an evaluation tree from a postfix instruction stream.
+
+    Returns None for an empty stream.
+    """
+    stack = []
+
+    for instruction in instruction_stream:
+        if instruction.instruction_type in (
+            InstructionConstant.LOGICAL_AND,
+            InstructionConstant.LOGICAL_OR,
+        ):
+            if len(stack) < 2:
+                raise InstructionException(
+                    f"{instruction.name} requires two operands"
+                )
+
+            right = stack.pop()
+            left = stack.pop()
+            if instruction.instruction_type == InstructionConstant.LOGICAL_AND:
+                stack.append(LogicalAndNode(left, right))
+            else:
+                stack.append(LogicalOrNode(left, right))
+
+        else:
+            stack.append(InstructionNode(instruction))
+
+    if len(stack) > 1:
+        # Same as the old stack based executor, only the last operand is used
+        logger.warning(
+            f"Operands {stack[:-1]} are not joined by a logical operator. Ignoring them."
+        )
+
+    return stack.pop() if stack else None
+
+
+async def evaluate_concurrently(tree, vm_instance, max_concurrency, context=None):
+    """Evaluate `tree` with its backend reading leaves fetched concurrently.
+
+    Every leaf with a non zero cost is evaluated up front in a nursery, at most
+    `max_concurrency` at a time, and the results are then combined by the
+    tree. This trades short-circuiting (all leaves are read) for latency (the
+    reads overlap instead of adding up).
+    """
+    results = {}
+    limiter = trio.CapacityLimiter(max_concurrency)
+
+    async def evaluate_leaf(node):
+        async with limiter:
+            results[node] = await node.evaluate(vm_instance, context)
+
+    async with trio.open_nursery() as nursery:
+        for node in tree.leaves():
+            if node.cost > 0:
+                nursery.start_soon(evaluate_leaf, node)
+
+    return await tree.evaluate(vm_instance, context, results)
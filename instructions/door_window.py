@@ -1,10 +1,11 @@
+from sys import intern
 from typing import Dict
 
 from loguru import logger
 
-import store
 import datetime
 import pytz
+import transitions
 from .base import BaseInstruction
 from .base import InstructionConstant
 
@@ -24,13 +25,15 @@ class DoorWindowState(BaseInstruction):
         "required": ["operation", "device_id", "state"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(DoorWindowState, self).__init__(json_data, rule)
-        self.target_state = self.json_data["state"].lower()
-        self.device_id = self.json_data["device_id"]
+    __slots__ = ("target_state", "device_id")
 
-    async def evaluate(self, vm_instance):
-        current_state = await self.get_current_state()
+    def __init__(self, json_data: Dict):
+        super(DoorWindowState, self).__init__(json_data)
+        self.target_state = intern(json_data["state"].lower())
+        self.device_id = intern(json_data["device_id"])
+
+    async def evaluate(self, vm_instance, context=None):
+        current_state = await self.get_current_state(context)
         logger.debug(
             f"Comparing door window state {current_state} == {self.target_state}"
         )
@@ -39,9 +42,11 @@ class DoorWindowState(BaseInstruction):
 
         return False
 
-    async def get_current_state(self):
-        logger.debug(f"Getting current state for {self.json_data['device_id']}")
-        document = await store.get_generated_data(self.json_data["device_id"], 1)
+    async def get_current_state(self, context=None):
+        logger.debug(f"Getting current state for {self.device_id}")
+        document = await self.data_source(context).get_generated_data(
+            self.device_id, 1
+        )
         state = document[0]["status"].lower()
         logger.debug(f"Current state of is {state}")
         return state
@@ -65,14 +70,19 @@ class DoorWindowStateFor(BaseInstruction):
         "required": ["operation", "device_id", "state", "for"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(DoorWindowStateFor, self).__init__(json_data, rule)
-        self.target_state = json_data["state"].lower()
-        self.device_id = json_data["device_id"]
+    __slots__ = ("target_state", "device_id", "target_state_for")
+
+    def __init__(self, json_data: Dict):
+        super(DoorWindowStateFor, self).__init__(json_data)
+        self.target_state = intern(json_data["state"].lower())
+        self.device_id = intern(json_data["device_id"])
         self.target_state_for = json_data["for"]
 
-    async def evaluate(self, vm_instance):
-        current_state, current_state_for = await self.get_current_state_for()
+    def transition_channels(self):
+        return ((self.device_id, transitions.DOOR_WINDOW_STATUS),)
+
+    async def evaluate(self, vm_instance, context=None):
+        current_state, current_state_for = await self.get_current_state_for(context)
 
         logger.debug(
             f"The door is {current_state.upper()} for {current_state_for:.2f} minutes."
@@ -88,12 +98,12 @@ class DoorWindowStateFor(BaseInstruction):
             else:
                 # There is some finite time in which this rule
                 # can evaluate to True if everything goes well.
-                if self.rule.periodic_execution:
+                if context.rule.periodic_execution:
                     time_to_next_invocation = (
                         self.target_state_for - current_state_for
                     ) * 60
                     vm_instance.add_rule_for_future_exec(
-                        self.rule, time_to_next_invocation
+                        context.rule, time_to_next_invocation
                     )
 
         # Current state and the target state are not the same
@@ -102,9 +112,21 @@ class DoorWindowStateFor(BaseInstruction):
         # automatically be invoked.
         return False
 
-    async def get_current_state_for(self):
-        logger.debug(f"Getting current state for {self.json_data['device_id']}")
-        document = await store.get_generated_data(self.json_data["device_id"], 1)
+    async def get_current_state_for(self, context=None):
+        logger.debug(f"Getting current state for {self.device_id}")
+        if context is not None:
+            # Time since the door/window last changed state, if it's known
+            channel_state = context.state_since(
+                self.device_id, transitions.DOOR_WINDOW_STATUS
+            )
+            if channel_state is not None:
+                current_dt = datetime.datetime.now(pytz.timezone("UTC"))
+                delta = current_dt - channel_state.since
+                return channel_state.state, delta.total_seconds() / 60
+
+        document = await self.data_source(context).get_generated_data(
+            self.device_id, 1
+        )
 
         creation_timestamp = document[0]["creation_timestamp"]
         current_dt = datetime.datetime.now(pytz.timezone("UTC"))
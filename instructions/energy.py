@@ -1,13 +1,15 @@
 from .base import BaseInstruction
 from .base import InstructionConstant
+from sys import intern
 from typing import Dict
-import store
+import operator
 from loguru import logger
 
 
 class EnergyMeter(BaseInstruction):
     instruction_type = InstructionConstant.ENERGY_METER
     name = "ENERGY_METER"
+    COMPARISON_OPERATORS = {"=": operator.eq, ">": operator.gt, "<": operator.lt}
     schema = {
         "$schema": "http://json-schema.org/draft-07/schema",
         "type": "object",
@@ -32,31 +34,24 @@ class EnergyMeter(BaseInstruction):
         "required": ["operation", "device_id", "variable", "comparison_op", "value"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(EnergyMeter, self).__init__(json_data, rule)
-        self.device_id = self.json_data["device_id"]
-        self.variable = self.json_data["variable"]
-        self.value = self.json_data["value"]
-        self.comparison_op = self.json_data["comparison_op"]
+    __slots__ = ("device_id", "variable", "value", "comparison_op", "compare")
 
-    async def evaluate(self, vm_instance):
-        doc = await store.get_device_document(self.device_id)
-        document = doc.to_dict()
-
-        if self.comparison_op == "=":
-            logger.debug(
-                f"{self.rule}: Evaluating (current_{self.variable} == target_{self.value}) -> {document[self.variable]} = {self.value}"
-            )
-            return document[self.variable] == self.value
+    def __init__(self, json_data: Dict):
+        super(EnergyMeter, self).__init__(json_data)
+        self.device_id = intern(json_data["device_id"])
+        self.variable = intern(json_data["variable"])
+        self.value = json_data["value"]
+        self.comparison_op = intern(json_data["comparison_op"])
+        self.compare = self.COMPARISON_OPERATORS[self.comparison_op]
 
-        elif self.comparison_op == ">":
-            logger.debug(
-                f"{self.rule}: Evaluating (current_{self.variable} > target_{self.value}) -> {document[self.variable]} > {self.value}"
-            )
-            return document[self.variable] > self.value
+    async def evaluate(self, vm_instance, context=None):
+        doc = await self.data_source(context).get_device_document(
+            self.device_id, fields=(self.variable,)
+        )
+        document = doc.to_dict()
 
-        elif self.comparison_op == "<":
-            logger.debug(
-                f"{self.rule}: Evaluating (current_{self.variable} < target_{self.value}) -> {document[self.variable]} < {self.value}"
-            )
-            return document[self.variable] < self.value
+        current_value = document[self.variable]
+        logger.debug(
+            f"{self.device_id}: Evaluating (current_{self.variable} {self.comparison_op} target_{self.value}) -> {current_value} {self.comparison_op} {self.value}"
+        )
+        return self.compare(current_value, self.value)
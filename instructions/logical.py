@@ -6,6 +6,7 @@ from typing import Dict
 class LogicalAnd(BaseInstruction):
     instruction_type = InstructionConstant.LOGICAL_AND
     name = "LOGICAL_AND"
+    __slots__ = ()
 
     def __init__(self, ins_data: Dict):
         # We don't use ins_data for this instruction
@@ -18,6 +19,7 @@ class LogicalAnd(BaseInstruction):
 class LogicalOr(BaseInstruction):
     instruction_type = InstructionConstant.LOGICAL_OR
     name = "LOGICAL_OR"
+    __slots__ = ()
 
     def __init__(self, ins_data: Dict):
         # We don't use ins_data for this instruction
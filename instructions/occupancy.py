@@ -1,11 +1,13 @@
+from sys import intern
 from typing import Dict
 
 import arrow
+from async_generator import aclosing
 from loguru import logger
 
 import datetime
 import pytz
-import store
+import transitions
 from .base import BaseInstruction
 from .base import InstructionConstant
 import math
@@ -28,13 +30,15 @@ class CheckOccupancy(BaseInstruction):
         "required": ["operation", "device_id", "state"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(CheckOccupancy, self).__init__(json_data, rule)
-        self.target_state = self.json_data["state"].lower()
-        self.device_id = self.json_data["device_id"]
+    __slots__ = ("target_state", "device_id")
 
-    async def evaluate(self, vm_instance):
-        current_state = await self.get_current_state()
+    def __init__(self, json_data: Dict):
+        super(CheckOccupancy, self).__init__(json_data)
+        self.target_state = intern(json_data["state"].lower())
+        self.device_id = intern(json_data["device_id"])
+
+    async def evaluate(self, vm_instance, context=None):
+        current_state = await self.get_current_state(context)
         logger.debug(
             f"Evaluating occupancy sensor (current_state == target_state) -> {current_state} == {self.target_state}"
         )
@@ -43,9 +47,11 @@ class CheckOccupancy(BaseInstruction):
 
         return False
 
-    async def get_current_state(self):
-        logger.debug(f"Getting current state for {self.json_data['device_id']}")
-        document = await store.get_generated_data(self.json_data["device_id"], 1)
+    async def get_current_state(self, context=None):
+        logger.debug(f"Getting current state for {self.device_id}")
+        document = await self.data_source(context).get_generated_data(
+            self.device_id, 1
+        )
         gen_datetime = arrow.get(document[0]["creation_timestamp"])
         curr_datetime = arrow.now("UTC")
 
@@ -53,10 +59,10 @@ class CheckOccupancy(BaseInstruction):
         logger.debug(f"Last message from device was received {delta} seconds ago")
 
         if delta < self.OCCUPANCY_SENSOR_DATA_INTERVAL:
-            logger.info(f"{self.json_data['device_id']} is currently occupied")
+            logger.info(f"{self.device_id} is currently occupied")
             return "occupied"
         else:
-            logger.info(f"{self.json_data['device_id']} is currently unoccupied")
+            logger.info(f"{self.device_id} is currently unoccupied")
             return "unoccupied"
 
     def __eq__(self, other):
@@ -69,6 +75,7 @@ class CheckOccupancyFor(BaseInstruction):
     OCCUPANCY_SENSOR_DATA_INTERVAL = (
         2 * 60
     )  # Device sends data every 1 minute, till the device is on
+    HISTORY_PAGE_SIZE = 30  # generatedData documents fetched per read
     schema = {
         "$schema": "http://json-schema.org/draft-07/schema",
         "type": "object",
@@ -81,14 +88,19 @@ class CheckOccupancyFor(BaseInstruction):
         "required": ["operation", "device_id", "state", "for"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(CheckOccupancyFor, self).__init__(json_data, rule)
-        self.target_state = json_data["state"].lower()
-        self.device_id = json_data["device_id"]
+    __slots__ = ("target_state", "device_id", "target_state_for")
+
+    def __init__(self, json_data: Dict):
+        super(CheckOccupancyFor, self).__init__(json_data)
+        self.target_state = intern(json_data["state"].lower())
+        self.device_id = intern(json_data["device_id"])
         self.target_state_for = json_data["for"]
 
-    async def evaluate(self, vm_instance):
-        current_state, current_state_for = await self.get_current_state_for()
+    def transition_channels(self):
+        return ((self.device_id, transitions.PRESENCE),)
+
+    async def evaluate(self, vm_instance, context=None):
+        current_state, current_state_for = await self.get_current_state_for(context)
         logger.debug(
             f"{self.device_id} has state {current_state.upper()} for {current_state_for} minutes."
         )
@@ -102,21 +114,35 @@ class CheckOccupancyFor(BaseInstruction):
             else:
                 # There is some finite time in which this rule
                 # can evaluate to True if everything goes well.
-                if self.rule.periodic_execution:
+                if context.rule.periodic_execution:
                     time_to_next_invocation = (
                         self.target_state_for - current_state_for
                     ) * 60
                     vm_instance.add_rule_for_future_exec(
-                        self.rule, time_to_next_invocation
+                        context.rule, time_to_next_invocation
                     )
 
         # If all other cases return False
         return False
 
-    async def get_current_state_for(self):
+    async def get_current_state_for(self, context=None):
         # Fetch the last generated data
-        logger.debug(f"Getting current state for {self.json_data['device_id']}")
-        latest_document = await store.get_generated_data(self.json_data["device_id"], 1)
+        logger.debug(f"Getting current state for {self.device_id}")
+        if context is not None:
+            # No need to look at the history if the start of the occupied period is known
+            presence = context.state_since(self.device_id, transitions.PRESENCE)
+            if presence is not None:
+                logger.debug(f"{self.device_id} presence is {presence}")
+                current_dt = datetime.datetime.now(pytz.timezone("UTC"))
+                since_last_seen = (current_dt - presence.last_seen).total_seconds()
+                if since_last_seen < self.OCCUPANCY_SENSOR_DATA_INTERVAL:
+                    delta = current_dt - presence.since
+                    return "occupied", delta.total_seconds() / 60
+                return "unoccupied", since_last_seen / 60
+
+        latest_document = await self.data_source(context).get_generated_data(
+            self.device_id, 1
+        )
 
         creation_timestamp = latest_document[0]["creation_timestamp"]
         current_dt = datetime.datetime.now(pytz.timezone("UTC"))
@@ -137,39 +163,42 @@ class CheckOccupancyFor(BaseInstruction):
             # documents
             logger.info(f"{self.device_id} currently detects the area is occupied")
 
-            generated_data = (
-                store.store.collection("devices")
-                .document(self.device_id)
-                .collection("generatedData")
-                .order_by(
-                    "creation_timestamp", direction=store.firestore.Query.DESCENDING
+            # Pages through the history, served from memory when possible
+            async with aclosing(
+                self.data_source(context).iter_generated_data(
+                    self.device_id,
+                    page_size=self.HISTORY_PAGE_SIZE,
+                    limit=math.ceil(self.target_state_for) + 1,
                 )
-                .limit(math.ceil(self.target_state_for) + 1)
-                .stream()
-            )
-
-            prev_document = latest_document[0]
-            for doc in generated_data:
-                # Each document should have a time difference of at max OCCUPANCY_SENSOR_INTERVAL minutes
-                logger.info(f"Fetched document {doc.id}")
-                doc_dict = doc.to_dict()
-                prev_document_dt = prev_document["creation_timestamp"]
-                next_document_dt = doc_dict["creation_timestamp"]
-
-                time_diff = (prev_document_dt - next_document_dt).total_seconds()
-                logger.debug(
-                    f"Time difference between previous and present document({doc.id}) is {time_diff} seconds or {time_diff/60} minutes."
-                )
-                if time_diff <= self.OCCUPANCY_SENSOR_DATA_INTERVAL:
-                    # If the difference between adjacent
-                    logger.debug("Added 1 minute to calculated_occupied_time")
-                    calculated_occupied_time += 1
-
-                else:
-                    logger.debug("Exiting out of for loop.")
-                    break
-
-                prev_document = doc_dict
+            ) as generated_data:
+                prev_document = latest_document[0]
+                async for doc_dict in generated_data:
+                    # Each document should have a time difference of at max OCCUPANCY_SENSOR_INTERVAL minutes
+                    prev_document_dt = prev_document["creation_timestamp"]
+                    next_document_dt = doc_dict["creation_timestamp"]
+
+                    time_diff = (prev_document_dt - next_document_dt).total_seconds()
+                    logger.debug(
+                        f"Time difference between previous and present document({next_document_dt}) is {time_diff} seconds or {time_diff/60} minutes."
+                    )
+                    if time_diff <= self.OCCUPANCY_SENSOR_DATA_INTERVAL:
+                        # If the difference between adjacent
+                        logger.debug("Added 1 minute to calculated_occupied_time")
+                        calculated_occupied_time += 1
+
+                    else:
+                        logger.debug("Exiting out of for loop.")
+                        # The occupied period started with the previous document, remember it
+                        if context is not None:
+                            context.seed_state(
+                                self.device_id,
+                                transitions.PRESENCE,
+                                transitions.OCCUPIED,
+                                prev_document_dt,
+                            )
+                        break
+
+                    prev_document = doc_dict
             logger.debug(f"calculated occupied time is: {calculated_occupied_time}")
             return "occupied", calculated_occupied_time
 
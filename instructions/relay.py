@@ -1,7 +1,8 @@
 from .base import BaseInstruction
 from .base import InstructionConstant
+from async_generator import aclosing
 from loguru import logger
-import store
+from sys import intern
 from typing import Dict
 import pytz
 import datetime
@@ -23,24 +24,28 @@ class IsRelayState(BaseInstruction):
         "required": ["operation", "device_id", "relay_index", "state"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(IsRelayState, self).__init__(json_data, rule)
-        self.device_id = self.json_data["device_id"]
-        self.relay_index = int(self.json_data["relay_index"])
-        self.target_state = self.json_data["state"]
+    __slots__ = ("device_id", "relay_index", "target_state")
 
-    async def evaluate(self, vm_instance):
-        current_state = await self.get_current_state(self.relay_index)
+    def __init__(self, json_data: Dict):
+        super(IsRelayState, self).__init__(json_data)
+        self.device_id = intern(json_data["device_id"])
+        self.relay_index = int(json_data["relay_index"])
+        self.target_state = json_data["state"]
+
+    async def evaluate(self, vm_instance, context=None):
+        current_state = await self.get_current_state(self.relay_index, context)
         logger.debug(
-            f"{self.rule}: Evaluating relay state(current_state == target_state) -> {current_state} == {self.target_state}"
+            f"{self.device_id}: Evaluating relay state(current_state == target_state) -> {current_state} == {self.target_state}"
         )
         if current_state == self.target_state:
             return True
 
         return False
 
-    async def get_current_state(self, relay_index):
-        document = await store.get_device_document(self.device_id)
+    async def get_current_state(self, relay_index, context=None):
+        document = await self.data_source(context).get_device_document(
+            self.device_id, fields=("relayStatus",)
+        )
         relay_status = document.to_dict()["relayStatus"]
         return relay_status[relay_index]
 
@@ -54,6 +59,7 @@ class IsRelayStateFor(BaseInstruction):
     SWITCH_STATE_UPDATE_INTERVAL = (
         1 * 60
     )  # How often the device will send state values to server
+    HISTORY_PAGE_SIZE = 30  # generatedData documents fetched per read
     name = "RELAY_STATE_FOR"
     schema = {
         "$schema": "http://json-schema.org/draft-07/schema",
@@ -68,16 +74,39 @@ class IsRelayStateFor(BaseInstruction):
         "required": ["operation", "device_id", "relay_index", "state", "for"],
     }
 
-    def __init__(self, json_data: Dict, rule):
+    __slots__ = (
+        "target_state",
+        "device_id",
+        "relay_index",
+        "target_state_for",
+        "relay_key",
+        "max_documents_to_fetch",
+    )
+
+    def __init__(self, json_data: Dict):
         json_data["state"] = int(json_data["state"])
-        super(IsRelayStateFor, self).__init__(json_data, rule)
+        super(IsRelayStateFor, self).__init__(json_data)
         self.target_state = json_data["state"]
-        self.device_id = json_data["device_id"]
+        self.device_id = intern(json_data["device_id"])
         self.relay_index = int(json_data["relay_index"])
         self.target_state_for = json_data["for"]
 
-    async def evaluate(self, vm_instance):
-        current_state, current_state_for = await self.get_current_state_for()
+        # Index for the relays are like `relay1`, `relay2`, `relay3` and `relay3`
+        self.relay_key = intern(f"relay{self.relay_index + 1}")
+        # 1chpm device does not have mutiple relays
+        if self.device_id.startswith("switch-pod-1chpm-"):
+            self.relay_key = "relay_status"
+
+        self.max_documents_to_fetch = int(
+            (self.target_state_for / (self.SWITCH_STATE_UPDATE_INTERVAL / 60))
+            + 3  # fetching 3 extra documents for buffer
+        )
+
+    def transition_channels(self):
+        return ((self.device_id, self.relay_key),)
+
+    async def evaluate(self, vm_instance, context=None):
+        current_state, current_state_for = await self.get_current_state_for(context)
         logger.debug(
             f"{self.device_id} has state {current_state} @ relay index {self.relay_index} for {current_state_for} minutes."
         )
@@ -92,29 +121,37 @@ class IsRelayStateFor(BaseInstruction):
             else:
                 # There is some finite time in which this rule
                 # can evaluate to True if everything goes well.
-                if self.rule.periodic_execution:
+                if context.rule.periodic_execution:
                     time_to_next_invocation = (
                         self.target_state_for - current_state_for
                     ) * 60
                     vm_instance.add_rule_for_future_exec(
-                        self.rule, time_to_next_invocation
+                        context.rule, time_to_next_invocation
                     )
         # In all other cases, return False
         return False
 
-    async def get_current_state_for(self):
+    async def get_current_state_for(self, context=None):
         logger.debug(f"Getting current state for {self.device_id}")
-        latest_document = await store.get_generated_data(self.device_id, 1)
+        if context is not None:
+            # No need to look at the history if the last transition is known
+            channel_state = context.state_since(self.device_id, self.relay_key)
+            if channel_state is not None:
+                logger.debug(f"{self.device_id} {self.relay_key} is {channel_state}")
+                if channel_state.state != self.target_state:
+                    return channel_state.state, 0
+                current_dt = datetime.datetime.now(pytz.timezone("UTC"))
+                delta = current_dt - channel_state.since
+                return channel_state.state, delta.total_seconds() / 60
+
+        latest_document = await self.data_source(context).get_generated_data(
+            self.device_id, 1
+        )
 
         # Check whether the latest document has the given state for the relay index
         parsed_latest_document = latest_document[0]
 
-        # Index for the relays are like `relay1`, `relay2`, `relay3` and `relay3`
-        relay_key = f"relay{self.relay_index + 1}"
-
-        # 1chpm device does not have mutiple relays 
-        if (self.device_id.startswith("switch-pod-1chpm-")):
-            relay_key = f"relay_status"
+        relay_key = self.relay_key
         current_state = parsed_latest_document[relay_key]
 
         # If the current_state and target_state match only then go ahead and calculate the time
@@ -139,46 +176,46 @@ class IsRelayStateFor(BaseInstruction):
                 logger.debug(
                     "We need to look at other generatedData to find the actual current_state time."
                 )
-                max_documents_to_fetch = int(
-                    (self.target_state_for / (self.SWITCH_STATE_UPDATE_INTERVAL / 60))
-                    + 3  # fetching 3 extra documents for buffer
-                )
+                max_documents_to_fetch = self.max_documents_to_fetch
                 logger.debug(f"We'll fetch at max {max_documents_to_fetch} documents.")
-                generated_data = (
-                    store.store.collection("devices")
-                    .document(self.device_id)
-                    .collection("generatedData")
-                    .order_by(
-                        "creation_timestamp", direction=store.firestore.Query.DESCENDING
+                # Pages through the history, served from memory when possible
+                async with aclosing(
+                    self.data_source(context).iter_generated_data(
+                        self.device_id,
+                        page_size=self.HISTORY_PAGE_SIZE,
+                        limit=max_documents_to_fetch,
                     )
-                    .limit(max_documents_to_fetch)
-                    .stream()
-                )
-
-                required_state_earliest_dt = creation_dt
-                for doc in generated_data:
-                    logger.debug(f"Fetched {doc.id} document")
-                    doc_data = doc.to_dict()
-                    if doc_data[relay_key] == self.target_state:
-                        required_state_earliest_dt = doc_data["creation_timestamp"]
-                        # Compute the current time diff and see if it exceeds target_state_for time
-                        current_dt = datetime.datetime.now(
-                            pytz.timezone("UTC")
-                        )  # Update the current_dt variable again as sometimes the difference becomes negative in VM Logs
-                        diff = (current_dt - required_state_earliest_dt).total_seconds()
-                        logger.debug(
-                            f"Current time difference is {diff/60:.2f} and required is {self.target_state_for}"
-                        )
-                        if diff >= (self.target_state_for * 60):
+                ) as generated_data:
+                    required_state_earliest_dt = creation_dt
+                    async for doc_data in generated_data:
+                        if doc_data[relay_key] == self.target_state:
+                            required_state_earliest_dt = doc_data["creation_timestamp"]
+                            # Compute the current time diff and see if it exceeds target_state_for time
+                            current_dt = datetime.datetime.now(
+                                pytz.timezone("UTC")
+                            )  # Update the current_dt variable again as sometimes the difference becomes negative in VM Logs
+                            diff = (current_dt - required_state_earliest_dt).total_seconds()
+                            logger.debug(
+                                f"Current time difference is {diff/60:.2f} and required is {self.target_state_for}"
+                            )
+                            if diff >= (self.target_state_for * 60):
+                                logger.debug(
+                                    "Condition can now be satisfied. We'll NOT look back at anymore documents."
+                                )
+                                break
+                        else:
                             logger.debug(
-                                "Condition can now be satisfied. We'll NOT look back at anymore documents."
+                                "Current documents relay index state did not match with target state. Exiting."
                             )
+                            # This is where the relay changed state, remember it
+                            if context is not None:
+                                context.seed_state(
+                                    self.device_id,
+                                    relay_key,
+                                    current_state,
+                                    required_state_earliest_dt,
+                                )
                             break
-                    else:
-                        logger.debug(
-                            "Current documents relay index state did not match with target state. Exiting."
-                        )
-                        break
 
                 # Now we have the earliest timestamp with the target_state
                 # Calculate the time difference and return
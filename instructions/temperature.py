@@ -5,8 +5,10 @@ from .base import InstructionConstant
 class CheckTemperature(BaseInstruction):
     instruction_type = InstructionConstant.TEMPERATURE
     name = "TEMPERATURE"
+    __slots__ = ()
 
 
 class CheckTemperatureFor(BaseInstruction):
     instruction_type = InstructionConstant.TEMPERATURE_FOR
     name = "TEMPERATURE_FOR"
+    __slots__ = ()
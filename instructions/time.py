@@ -1,3 +1,4 @@
+from sys import intern
 from typing import Dict
 
 import arrow
@@ -11,6 +12,8 @@ from .base import InstructionConstant
 class AtTime(BaseInstruction):
     instruction_type = InstructionConstant.AT_TIME
     name = "AT_TIME"
+    cost = 0
+    schedules = True
 
     # TODO `time` format accepts values without timezone. Fix this by making a custom validator.
     schema = {
@@ -23,33 +26,39 @@ class AtTime(BaseInstruction):
         "required": ["operation", "time"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(AtTime, self).__init__(json_data, rule)
-        self.time_string = self.json_data["time"]
-        self.target_time = None
+    # The instruction is shared by every handle of the rule, so nothing
+    # computed during an evaluation is kept on it
+    __slots__ = ("time_string", "time_of_day")
+
+    def __init__(self, json_data: Dict):
+        super(AtTime, self).__init__(json_data)
+        self.time_string = intern(json_data["time"])
+        # Expected time, 09:42:32+05:30. Parsed once, only the date changes between evaluations.
+        self.time_of_day = arrow.get(self.time_string, "HH:mm:ssZZ")
+
+    def current_and_target_time(self):
+        """The current time and today's target time, in the target's timezone."""
+        current_time = arrow.now(self.time_of_day.tzinfo)
+        target_time = self.time_of_day.shift(
+            years=current_time.year - 1,
+            months=current_time.month - 1,
+            days=current_time.day - 1,
+        )
+        return current_time, target_time
 
-    async def evaluate(self, vm_instance):
+    async def evaluate(self, vm_instance, context=None):
         # Find the difference between target time and current time in UTC
-
-        # Convert this to parsed time string
-        # Expected time, 09:42:32+05:30
-        temp = arrow.get(self.time_string, "HH:mm:ssZZ")
-        self.current_time = arrow.now(temp.tzinfo)
-        self.target_time = temp.shift(
-            years=self.current_time.year - 1,
-            months=self.current_time.month - 1,
-            days=self.current_time.day - 1,
-        )
+        current_time, target_time = self.current_and_target_time()
 
         # Add rule for future execution
-        if self.rule.periodic_execution:
-            time_to_next_invocation = self.time_to_next_evaluation()
-            vm_instance.add_rule_for_future_exec(self.rule, time_to_next_invocation)
+        if context.rule.periodic_execution:
+            time_to_next_invocation = self.time_to_next_evaluation(current_time, target_time)
+            vm_instance.add_rule_for_future_exec(context.rule, time_to_next_invocation)
 
         logger.debug(
-            f"Evaluating {self.instruction_type}. Current time({self.current_time}) and Target time({self.target_time})"
+            f"Evaluating {self.instruction_type}. Current time({current_time}) and Target time({target_time})"
         )
-        if self.current_time > self.target_time:
+        if current_time > target_time:
             # delta = current_time - self.target_time
             # Since we are in the same day, if current time is greater than
             # target time, we should execute the rule
@@ -61,13 +70,14 @@ class AtTime(BaseInstruction):
             # behind, return false.
             return False
 
-    def time_to_next_evaluation(self):
-        if self.current_time > self.target_time:
-            new_target_time = self.target_time.shift(days=1)
-            delta = new_target_time - self.current_time
+    @staticmethod
+    def time_to_next_evaluation(current_time, target_time):
+        if current_time > target_time:
+            new_target_time = target_time.shift(days=1)
+            delta = new_target_time - current_time
             return delta.seconds
         else:
-            delta = self.target_time - self.current_time
+            delta = target_time - current_time
             return delta.seconds
 
     def __eq__(self, other):
@@ -88,54 +98,56 @@ class AtTimeWithOccurrence(AtTime):
         "required": ["operation", "time"],
     }
 
-    def __init__(self, json_data: Dict, rule):
-        super(AtTimeWithOccurrence, self).__init__(json_data, rule)
-        self.occurrence: int = self.json_data["occurrence"]
+    __slots__ = ("occurrence",)
+
+    def __init__(self, json_data: Dict):
+        super(AtTimeWithOccurrence, self).__init__(json_data)
+        # Occurrences left when the rule was loaded. What is left now is kept
+        # on the rule handle and in the rule document, see `remaining`.
+        self.occurrence: int = json_data["occurrence"]
 
-    async def decrement_occurrence(self):
-        if self.rule.id != "immediate":
-            rule_doc = await self.rule.get_rule_document()
+    def remaining(self, rule):
+        """Occurrences left for this handle of the rule."""
+        return rule.remaining_occurrences.get(self.time_string, self.occurrence)
+
+    async def decrement_occurrence(self, rule):
+        remaining = self.remaining(rule)
+        # Counted on the handle before anything is awaited, the rule document
+        # is rebuilt into a new template once Firestore has the new value
+        rule.remaining_occurrences[self.time_string] = remaining - 1
+        logger.debug(f"Decremented occurrence count for {rule} to {remaining - 1}")
+
+        if rule.id != "immediate":
+            rule_doc = await rule.get_rule_document()
             rule_doc_dict = rule_doc.to_dict()
             for cond in rule_doc_dict["conditions"]:
                 if (
-                    cond["occurrence"] == self.occurrence
-                    and cond["operation"].lower() == self.json_data["operation"].lower()
-                    and cond["time"] == self.json_data["time"]
+                    cond["operation"].upper() == self.name
+                    and cond["time"] == self.time_string
+                    and cond["occurrence"] == remaining
                 ):
-                    cond["occurrence"] -= 1
-                    self.occurrence -= 1
-                    logger.debug(
-                        f"Decremented occurrence count for {self.rule} to {self.occurrence}"
-                    )
+                    cond["occurrence"] = remaining - 1
 
             # Update the document finally
             await store.update_document("rules", rule_doc.id, rule_doc_dict)
-            logger.debug(
-                f"Updated Firestore with new occurrence value: {self.occurrence}"
-            )
-
-        else:
-            self.occurrence -= 1
-            logger.debug(
-                f"Decremented occurrence count for {self.rule} to {self.occurrence}"
-            )
+            logger.debug(f"Updated Firestore with new occurrence value: {remaining - 1}")
 
-    async def evaluate(self, vm_instance):
+    async def evaluate(self, vm_instance, context=None):
         # Call to super automatically evaluates the next time for evaluation
         # To turn it off, disable periodic execution and then make the
         # call to super class
-        self.rule.set_periodic_execution(False)
+        context.rule.set_periodic_execution(False)
         # gives true or false if it is the time to execute
-        current_exec_eval = await super().evaluate(vm_instance)
-        self.rule.set_periodic_execution(True)
+        current_exec_eval = await super().evaluate(vm_instance, context)
+        context.rule.set_periodic_execution(True)
 
         # Scheduling the rule to be evaluated in future
-        time_to_next_eval = self.time_to_next_evaluation()
-        vm_instance.add_rule_for_future_exec(self.rule, time_to_next_eval)
+        time_to_next_eval = self.time_to_next_evaluation(*self.current_and_target_time())
+        vm_instance.add_rule_for_future_exec(context.rule, time_to_next_eval)
 
 
-        if current_exec_eval and self.occurrence > 0:
-            await self.decrement_occurrence()
+        if current_exec_eval and self.remaining(context.rule) > 0:
+            await self.decrement_occurrence(context.rule)
             return True
         else:
             return False
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+
+import msgpack
+import trio
+from loguru import logger
+
+# Record types, a record is [type, rule_id, due]
+SCHEDULE = "s"
+CANCEL = "c"
+
+
+class FutureTaskJournal:
+    """Append-only journal of future task schedule/cancel records.
+
+    Records are buffered in memory and appended to `path` every
+    `flush_interval` seconds with a single fsync. Once the journal holds more
+    than `compact_after` records it is rewritten with one record per pending
+    task, atomically through a temporary file. `replay` returns the tasks that
+    were pending when the journal was last written, as {rule_id: due}.
+    """
+
+    def __init__(self, path, flush_interval=1, compact_after=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        # run() and VM.stop() may flush at the same time, a compaction must not
+        # replace the file while records are appended to it
+        self._flush_lock = trio.Lock()
+        # rule_id -> due, the state the journal describes
+        self._live = {}
+        self._buffer = []
+        self._records_on_disk = 0
+        self._file = None
+        self.flushes = 0
+        self.compactions = 0
+
+    def replay(self):
+        """Read the journal into memory. Must be called before `open`."""
+        live = {}
+        records = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                unpacker = msgpack.Unpacker(f, raw=False)
+                try:
+                    for record_type, rule_id, due in unpacker:
+                        records += 1
+                        if record_type == SCHEDULE:
+                            live[rule_id] = due
+                        else:
+                            live.pop(rule_id, None)
+                except (ValueError, msgpack.UnpackException) as e:
+                    # A record that was cut short by a crash, everything before it is valid
+                    logger.error(f"{self.path} is corrupt after {records} records. Error: {e}")
+
+        logger.info(f"Replayed {records} records from {self.path}, {len(live)} future task(s) pending.")
+        self._live = dict(live)
+        return live
+
+    def open(self):
+        # Start from a compacted journal, this also drops a corrupt tail
+        self._compact(dict(self._live))
+        self._file = open(self.path, "ab")
+
+    def schedule(self, rule_id: str, due: float):
+        with self._lock:
+            self._live[rule_id] = due
+            self._buffer.append(msgpack.packb([SCHEDULE, rule_id, due]))
+
+    def cancel(self, rule_id: str):
+        with self._lock:
+            if self._live.pop(rule_id, None) is None:
+                return
+            self._buffer.append(msgpack.packb([CANCEL, rule_id, None]))
+
+    @property
+    def pending(self):
+        return len(self._live)
+
+    async def flush(self):
+        async with self._flush_lock:
+            with self._lock:
+                if not self._buffer:
+                    return
+                records = self._buffer
+                self._buffer = []
+                # The snapshot already includes the buffered records
+                live = None
+                if self._records_on_disk + len(records) > self.compact_after:
+                    live = dict(self._live)
+
+            if live is not None:
+                await trio.to_thread.run_sync(self._compact, live)
+            else:
+                await trio.to_thread.run_sync(self._append, records)
+            self.flushes += 1
+
+    async def run(self):
+        while True:
+            await trio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _append(self, records):
+        self._file.write(b"".join(records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records_on_disk += len(records)
+
+    def _compact(self, live):
+        start = time.monotonic()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for rule_id, due in live.items():
+                f.write(msgpack.packb([SCHEDULE, rule_id, due]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_path, self.path)
+        if self._file is not None:
+            self._file = open(self.path, "ab")
+        self._records_on_disk = len(live)
+        self.compactions += 1
+        logger.debug(
+            f"Compacted {self.path} to {len(live)} records in {time.monotonic() - start:.3f} seconds"
+        )
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __str__(self):
+        return f"<FutureTaskJournal {self.path}: {self.pending} pending>"
+
+    def __repr__(self):
+        return self.__str__()
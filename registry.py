@@ -0,0 +1,96 @@
+import threading
+
+
+class RuleRegistry:
+    """Rules loaded in the VM, keyed by rule id and indexed by dependent device.
+
+    The registry is written from the Firestore watcher thread and read from the
+    PubSub callback threads, so every operation takes a lock. All operations are
+    O(1) apart from the work needed to keep the device index in sync.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # rule_id -> rule_obj
+        self._rules = {}
+        # device_id -> {rule_id: rule_obj}
+        self._device_index = {}
+        # Incremented on every change, cheap way to detect modifications
+        self.version = 0
+
+    def add(self, rule_obj):
+        """Add `rule_obj` if no rule with the same id is loaded. Returns True if it was added."""
+        with self._lock:
+            if rule_obj.id in self._rules:
+                return False
+
+            self._insert(rule_obj)
+            return True
+
+    def replace(self, rule_obj):
+        """Add or replace the rule with the same id. Returns the replaced rule, if any."""
+        with self._lock:
+            previous = self._rules.get(rule_obj.id)
+            if previous is not None:
+                self._unindex(previous)
+
+            self._insert(rule_obj)
+            return previous
+
+    def remove(self, rule_id):
+        """Remove the rule with `rule_id`. Returns the removed rule or None."""
+        with self._lock:
+            previous = self._rules.pop(rule_id, None)
+            if previous is not None:
+                self._unindex(previous)
+                self.version += 1
+
+            return previous
+
+    def get(self, rule_id):
+        return self._rules.get(rule_id)
+
+    def rules_for_device(self, device_id):
+        """Rules whose evaluation depends on the state of `device_id`."""
+        with self._lock:
+            return list(self._device_index.get(device_id, {}).values())
+
+    def devices(self):
+        """Every device id at least one loaded rule depends on."""
+        with self._lock:
+            return set(self._device_index)
+
+    def rules(self):
+        with self._lock:
+            return list(self._rules.values())
+
+    def _insert(self, rule_obj):
+        self._rules[rule_obj.id] = rule_obj
+        for device_id in rule_obj.dependent_devices:
+            self._device_index.setdefault(device_id, {})[rule_obj.id] = rule_obj
+        self.version += 1
+
+    def _unindex(self, rule_obj):
+        for device_id in rule_obj.dependent_devices:
+            dependent_rules = self._device_index.get(device_id)
+            if dependent_rules is None:
+                continue
+
+            dependent_rules.pop(rule_obj.id, None)
+            if not dependent_rules:
+                del self._device_index[device_id]
+
+    def __contains__(self, rule_id):
+        return rule_id in self._rules
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __iter__(self):
+        return iter(self.rules())
+
+    def __str__(self):
+        return f"<RuleRegistry: {len(self)} rules>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -3,10 +3,14 @@ import datetime
 from loguru import logger
 
 import store
+from context import EvaluationContext
 from actions.lut import ACTION_LUT
 from instructions import InstructionConstant
+from instructions.compiler import compile_instruction_stream
+from instructions.compiler import evaluate_concurrently
 from instructions.lut import INSTRUCTION_LUT
-import uuid
+import itertools
+import sys
 
 
 class RuleParsingException(Exception):
@@ -17,7 +21,28 @@ class InvalidInstructionException(RuleParsingException):
     pass
 
 
-class Rule:
+class RuleTemplate:
+    """The parsed part of a rule, shared by every Rule handle of it.
+
+    Conditions and actions are parsed, validated and compiled once, when the
+    rule document is loaded. Nothing in here changes afterwards, anything that
+    changes between executions lives in the Rule handle. The raw conditions
+    and actions are not kept, only the instructions and actions built from them.
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "description",
+        "enabled",
+        "max_concurrency",
+        "dependent_devices",
+        "transition_channels",
+        "instruction_stream",
+        "action_stream",
+        "evaluation_tree",
+    )
+
     def __init__(
         self,
         id=None,
@@ -26,38 +51,45 @@ class Rule:
         enabled=True,
         conditions=[],
         actions=[],
-        last_execution=None,
-        execution_count=0,
+        max_concurrency=1,
     ):
-        # Generate and assign a unique ID for this rule
-        # Same rules might have different UUID's
-        self.rule_uuid = uuid.uuid4()
-        self.id = id
+        # Rule ids are also used as keys all over the VM, share one copy
+        self.id = sys.intern(id) if isinstance(id, str) else id
         self.name = name
         self.description = description
         self.enabled = enabled
-        self.conditions = conditions
-        self.actions = actions
-        self.last_execution = last_execution
-        self.execution_count = execution_count
+        # How many instructions can read from the backend at the same time,
+        # 1 evaluates them one after another with short-circuiting
+        self.max_concurrency = max_concurrency
         # Devices that this rule uses for final evaluation
         self.dependent_devices = []
 
         self.instruction_stream = []
         self.action_stream = []
+        # Compiled once from instruction_stream, used for every evaluation
+        self.evaluation_tree = None
 
-        self.parse_conditions()
-        self.parse_actions()
+        self.parse_conditions(conditions)
+        self.parse_actions(actions)
         self.determine_device_dependencies()
-        self.periodic_execution = True
+
+        self.instruction_stream = tuple(self.instruction_stream)
+        self.action_stream = tuple(self.action_stream)
+        self.dependent_devices = tuple(self.dependent_devices)
+        # State transitions the VM has to track for this rule
+        self.transition_channels = tuple(
+            channel
+            for ins in self.instruction_stream
+            for channel in ins.transition_channels()
+        )
         logger.debug(f"{self} dependent devices -> {self.dependent_devices}")
 
-    def parse_conditions(self):
-        for ins_data in self.conditions:
+    def parse_conditions(self, conditions):
+        for ins_data in conditions:
             operation = ins_data["operation"].upper()
             if operation in INSTRUCTION_LUT:
                 Instruction = INSTRUCTION_LUT[operation]
-                self.instruction_stream.append(Instruction(ins_data, self))
+                self.instruction_stream.append(Instruction(ins_data))
 
             else:
                 logger.error(f"Incorrect/Unknown operation: {operation}")
@@ -66,6 +98,7 @@ class Rule:
                 )
 
         self.infix_to_postfix()
+        self.evaluation_tree = compile_instruction_stream(self.instruction_stream)
 
     def infix_to_postfix(self):
         """Perform infix to postfix conversion to make it easier for the VM to evaluate the rule"""
@@ -100,9 +133,9 @@ class Rule:
             if hasattr(ins, "device_id"):
                 self.dependent_devices.append(ins.device_id)
 
-    def parse_actions(self):
+    def parse_actions(self, actions):
         i = 0
-        for action_data in self.actions:
+        for action_data in actions:
             if "type" in action_data:
                 operation = action_data["type"].upper()
                 if operation in ACTION_LUT:
@@ -121,6 +154,141 @@ class Rule:
 
             i += 1
 
+    def __str__(self):
+        return f"<RuleTemplate: {self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# Handle ids only have to be unique within the process
+_handle_ids = itertools.count()
+
+
+class Rule:
+    """A handle to a RuleTemplate, with the state of one rule or scheduled execution.
+
+    Scheduling a rule for a future execution creates a new handle (with its
+    own `rule_uuid`) for the same template, nothing is parsed again.
+    """
+
+    __slots__ = (
+        "template",
+        "rule_uuid",
+        "last_execution",
+        "execution_count",
+        "periodic_execution",
+        "remaining_occurrences",
+    )
+
+    def __init__(
+        self,
+        id=None,
+        name=None,
+        description=None,
+        enabled=True,
+        conditions=[],
+        actions=[],
+        last_execution=None,
+        execution_count=0,
+        max_concurrency=1,
+        template=None,
+    ):
+        if template is None:
+            template = RuleTemplate(
+                id=id,
+                name=name,
+                description=description,
+                enabled=enabled,
+                conditions=conditions,
+                actions=actions,
+                max_concurrency=max_concurrency,
+            )
+        self.template = template
+        # Generate and assign a unique ID for this handle
+        # Handles of the same rule have different UUID's
+        self.rule_uuid = next(_handle_ids)
+        self.last_execution = last_execution
+        self.execution_count = execution_count
+        self.periodic_execution = True
+        # AT_TIME_WITH_OCCURRENCE time -> occurrences left, for the ones used
+        # since the template was built. Templates are shared, they don't change.
+        self.remaining_occurrences = {}
+
+    @classmethod
+    def from_template(
+        cls, template, last_execution=None, execution_count=0, remaining_occurrences=None
+    ):
+        rule_obj = cls(
+            last_execution=last_execution,
+            execution_count=execution_count,
+            template=template,
+        )
+        if remaining_occurrences:
+            rule_obj.remaining_occurrences = dict(remaining_occurrences)
+        return rule_obj
+
+    @property
+    def id(self):
+        return self.template.id
+
+    @property
+    def name(self):
+        return self.template.name
+
+    @property
+    def description(self):
+        return self.template.description
+
+    @property
+    def enabled(self):
+        return self.template.enabled
+
+    @property
+    def max_concurrency(self):
+        return self.template.max_concurrency
+
+    @property
+    def dependent_devices(self):
+        return self.template.dependent_devices
+
+    @property
+    def transition_channels(self):
+        return self.template.transition_channels
+
+    @property
+    def instruction_stream(self):
+        return self.template.instruction_stream
+
+    @property
+    def action_stream(self):
+        return self.template.action_stream
+
+    @property
+    def evaluation_tree(self):
+        return self.template.evaluation_tree
+
+    async def evaluate(self, vm_instance, context=None):
+        """Evaluate the conditions of this rule.
+
+        Logical operators short-circuit, unless `max_concurrency` allows
+        instructions to be read concurrently.
+        """
+        if self.evaluation_tree is None:
+            logger.warning(f"{self} has no conditions to evaluate.")
+            return False
+
+        # Instructions find the rule they are evaluated for in the context
+        if context is None:
+            context = EvaluationContext(self)
+
+        if self.max_concurrency > 1:
+            return await evaluate_concurrently(
+                self.evaluation_tree, vm_instance, self.max_concurrency, context
+            )
+
+        return await self.evaluation_tree.evaluate(vm_instance, context)
+
     async def get_rule_document(self):
         return await store.get_document("rules", self.id)
 
@@ -134,37 +302,30 @@ class Rule:
         self.periodic_execution = value
 
     def update_rule_uuid(self):
-        self.rule_uuid = uuid.uuid4()
+        self.rule_uuid = next(_handle_ids)
 
     def create_clone(self):
-        """Create a new copy of this object"""
-        return Rule(
-            id=self.id,
-            name=self.name,
-            description=self.description,
-            enabled=self.enabled,
-            conditions=self.conditions,
-            actions=self.actions,
+        """Create a new handle for the same rule, sharing its template"""
+        return Rule.from_template(
+            self.template,
             last_execution=self.last_execution,
             execution_count=self.execution_count,
+            remaining_occurrences=self.remaining_occurrences,
         )
 
-    async def update_execution_info(self):
+    def record_execution(self):
+        """Update the execution info in memory. Returns the fields to write to the rule document."""
         import pytz
         india_tz = pytz.timezone('Asia/Kolkata')
         self.execution_count += 1
         self.last_execution = datetime.datetime.now(india_tz)
-        await store.update_document(
-            "rules",
-            self.id,
-            {
-                "last_executed": self.last_execution,
-                "execution_count": self.execution_count,
-            },
-        )
         logger.debug(
             f"Rule execution count({self.execution_count}) and last executed datetime ({self.last_execution}) updated."
         )
+        return {
+            "last_executed": self.last_execution,
+            "execution_count": self.execution_count,
+        }
 
     def __str__(self):
         return f"<Rule({self.rule_uuid}): {self.id}>"
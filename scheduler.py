@@ -0,0 +1,299 @@
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+
+import trio
+from loguru import logger
+
+
+class Timer:
+    """A single pending entry of the FutureScheduler."""
+
+    __slots__ = ("due", "key", "payload", "cancelled")
+
+    def __init__(self, due, key, payload):
+        self.due = due
+        self.key = key
+        self.payload = payload
+        self.cancelled = False
+
+    def __str__(self):
+        return f"<Timer {self.key} due at {self.due:.3f}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class FutureScheduler:
+    """Runs every future rule execution from a single trio task.
+
+    Timers live in a binary heap ordered by their absolute (wall clock) due
+    time, so inserting and cancelling a timer is O(log n) regardless of how many
+    are pending. Cancelled timers are dropped lazily when they reach the top of
+    the heap. The scheduler wakes up on tick boundaries of `resolution` seconds
+    and hands every timer due in that tick to `callback` as one batch.
+
+    `schedule` and `cancel` can be called from any thread. Calls made outside the
+    trio thread running `run()` are handed over through the trio token.
+    """
+
+    # Rebuild the heap once more than this fraction of it is cancelled timers
+    COMPACTION_RATIO = 0.5
+
+    def __init__(self, callback, resolution=1.0):
+        self.callback = callback
+        self.resolution = resolution
+        self._heap = []
+        # key -> Timer, for every timer that is neither cancelled nor fired
+        self._timers = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._cancelled_in_heap = 0
+
+        self._trio_token = None
+        self._thread_id = None
+        self._cancel_scope = None
+        self._wakeup_at = math.inf
+
+    @property
+    def pending(self):
+        """Number of timers waiting to fire."""
+        return len(self._timers)
+
+    def schedule(self, key, due, payload):
+        """Fire `payload` at the absolute unix time `due`.
+
+        An already pending timer with the same key is cancelled first.
+        """
+        with self._lock:
+            previous = self._timers.pop(key, None)
+            if previous is not None:
+                self._discard(previous)
+
+            timer = Timer(due, key, payload)
+            self._timers[key] = timer
+            heapq.heappush(self._heap, (due, next(self._sequence), timer))
+
+        if self._tick_for(due) < self._wakeup_at:
+            self._wake_up()
+        return timer
+
+    def cancel(self, key):
+        """Cancel the pending timer with `key`. Returns True if one was pending."""
+        with self._lock:
+            timer = self._timers.pop(key, None)
+            if timer is None:
+                return False
+
+            self._discard(timer)
+            return True
+
+    def get(self, key):
+        return self._timers.get(key)
+
+    def next_due(self):
+        with self._lock:
+            self._drop_cancelled_head()
+            if self._heap:
+                return self._heap[0][0]
+            return None
+
+    def pop_due(self, now):
+        """Remove and return the payloads of every timer due at or before `now`."""
+        due_payloads = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, timer = heapq.heappop(self._heap)
+                if timer.cancelled:
+                    self._cancelled_in_heap -= 1
+                    continue
+
+                del self._timers[timer.key]
+                due_payloads.append(timer.payload)
+
+        return due_payloads
+
+    async def run(self):
+        self._trio_token = trio.lowlevel.current_trio_token()
+        self._thread_id = threading.get_ident()
+
+        while True:
+            next_due = self.next_due()
+            self._wakeup_at = math.inf if next_due is None else self._tick_for(next_due)
+
+            with trio.CancelScope(deadline=self._to_trio_time(self._wakeup_at)) as scope:
+                self._cancel_scope = scope
+                await trio.sleep_forever()
+            self._cancel_scope = None
+
+            due_payloads = self.pop_due(time.time())
+            if due_payloads:
+                logger.debug(
+                    f"{len(due_payloads)} future task(s) are due. {self.pending} still pending."
+                )
+                self.callback(due_payloads)
+
+    def _tick_for(self, due):
+        """Round `due` up to the tick it will fire in."""
+        return math.ceil(due / self.resolution) * self.resolution
+
+    def _to_trio_time(self, unix_time):
+        if unix_time == math.inf:
+            return math.inf
+        return trio.current_time() + max(0, unix_time - time.time())
+
+    def _wake_up(self):
+        if self._trio_token is None:
+            # run() hasn't started yet, it'll pick up the timer when it does
+            return
+
+        if threading.get_ident() == self._thread_id:
+            self._reset_deadline()
+        else:
+            self._trio_token.run_sync_soon(self._reset_deadline)
+
+    def _reset_deadline(self):
+        next_due = self.next_due()
+        if next_due is None or self._cancel_scope is None:
+            return
+
+        self._wakeup_at = self._tick_for(next_due)
+        self._cancel_scope.deadline = self._to_trio_time(self._wakeup_at)
+
+    def _discard(self, timer):
+        timer.cancelled = True
+        self._cancelled_in_heap += 1
+        if self._cancelled_in_heap > len(self._heap) * self.COMPACTION_RATIO:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled_in_heap = 0
+
+    def _drop_cancelled_head(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled_in_heap -= 1
+
+    def __len__(self):
+        return self.pending
+
+    def __str__(self):
+        return f"<FutureScheduler: {self.pending} pending timers>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class PendingFutureTask:
+    __slots__ = ("rule", "due")
+
+    def __init__(self, rule, due):
+        self.rule = rule
+        self.due = due
+
+    def __str__(self):
+        return f"<PendingFutureTask {self.rule} due at {self.due:.3f}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class PendingFutureTasks:
+    """Rules waiting for a future execution, indexed by rule id and rule_uuid.
+
+    A rule has at most one pending future task. Adding a task for a rule that
+    already has one replaces it, the caller is handed the replaced entry so it
+    can cancel the matching timer.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # rule_id -> PendingFutureTask
+        self._by_id = {}
+        # rule_uuid -> PendingFutureTask
+        self._by_uuid = {}
+        # Incremented on every change, cheap way to detect modifications
+        self.version = 0
+
+    def add(self, rule_obj, due):
+        """Track `rule_obj` as the pending task of its rule. Returns the replaced task, if any."""
+        task = PendingFutureTask(rule_obj, due)
+        with self._lock:
+            previous = self._by_id.pop(rule_obj.id, None)
+            if previous is not None:
+                del self._by_uuid[previous.rule.rule_uuid]
+
+            self._by_id[rule_obj.id] = task
+            self._by_uuid[rule_obj.rule_uuid] = task
+            self.version += 1
+
+        return previous
+
+    def get(self, rule_id):
+        return self._by_id.get(rule_id)
+
+    def remove_by_id(self, rule_id):
+        with self._lock:
+            task = self._by_id.pop(rule_id, None)
+            if task is not None:
+                del self._by_uuid[task.rule.rule_uuid]
+                self.version += 1
+
+        return task
+
+    def remove_by_uuid(self, rule_uuid):
+        with self._lock:
+            task = self._by_uuid.pop(rule_uuid, None)
+            if task is not None:
+                del self._by_id[task.rule.id]
+                self.version += 1
+
+        return task
+
+    def has_rule(self, rule_id):
+        return rule_id in self._by_id
+
+    def tasks(self):
+        with self._lock:
+            return list(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter([task.rule for task in self.tasks()])
+
+    def __str__(self):
+        return f"<PendingFutureTasks: {len(self)} rules>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class BacklogPacer:
+    """Spreads overdue work out to at most `rate` items per second.
+
+    `due(now)` returns when the next overdue item should run: one slot after
+    the previous one, plus up to `jitter` seconds so items with the same slot
+    don't line up on the same scheduler tick.
+    """
+
+    def __init__(self, rate, jitter=0.0):
+        self.interval = 1 / rate
+        self.jitter = jitter
+        self._next_slot = 0.0
+        self.paced = 0
+
+    def due(self, now):
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        self.paced += 1
+        return slot + random.uniform(0, self.jitter)
+
+    def __str__(self):
+        return f"<BacklogPacer: {1 / self.interval} per second, {self.paced} paced>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,241 @@
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from loguru import logger
+
+
+def partition_of(key: str, partitions: int) -> int:
+    """Partition of `key`, the same in every process (unlike hash())."""
+    return zlib.crc32(key.encode("utf-8")) % partitions
+
+
+def home_key(rule_id, device_ids):
+    """The key that decides which partition owns a rule.
+
+    A rule is owned by the partition of the first (sorted) device it depends on,
+    so every rule of a device lives in the same worker. Rules that depend on
+    devices of several partitions still have a single owner, every worker gets
+    the readings of every device (see ShardedVM). Rules without devices
+    (AT_TIME only) are spread by their id.
+    """
+    if device_ids:
+        return min(device_ids)
+    return rule_id
+
+
+def rule_home_key(rule_id, conditions):
+    """home_key of a rule document, from its raw conditions so it doesn't have to be parsed."""
+    return home_key(
+        rule_id,
+        [
+            cond["device_id"]
+            for cond in conditions
+            if isinstance(cond, dict) and isinstance(cond.get("device_id"), str)
+        ],
+    )
+
+
+class HashPartition:
+    """One of `partitions` hash partitions of the rule set."""
+
+    def __init__(self, index, partitions):
+        if not 0 <= index < partitions:
+            raise ValueError(f"Partition index {index} out of range for {partitions} partitions")
+        self.index = index
+        self.partitions = partitions
+        # Tells apart the files of partitions running side by side
+        self.name = str(index)
+
+    def owns_key(self, key):
+        return partition_of(key, self.partitions) == self.index
+
+    def owns_rule(self, rule_id, conditions):
+        return self.owns_key(rule_home_key(rule_id, conditions))
+
+    def __str__(self):
+        return f"<HashPartition: {self.index + 1} of {self.partitions}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class ThroughputMeter:
+    """Per worker counters of one kind of work, turned into rates between two reports."""
+
+    def __init__(self, workers):
+        self._lock = threading.Lock()
+        self._totals = [0] * workers
+        self._reported = [0] * workers
+        self._reported_at = time.monotonic()
+
+    def update(self, worker, total):
+        # Workers send running totals, so a lost update costs nothing
+        with self._lock:
+            self._totals[worker] = total
+
+    def totals(self):
+        with self._lock:
+            return list(self._totals)
+
+    def rates(self, now=None):
+        """Per worker rates (per second) since the previous call."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            elapsed = max(now - self._reported_at, 1e-9)
+            rates = [
+                (total - reported) / elapsed
+                for total, reported in zip(self._totals, self._reported)
+            ]
+            self._reported = list(self._totals)
+            self._reported_at = now
+            return rates
+
+
+def run_worker(index, workers, inbox, outbox, load_rules_from_disk, report_interval):
+    """Entry point of a worker process, runs a VM for one partition."""
+    # Imported here, the parent process doesn't need a VM (or Firestore)
+    from vm import VM
+
+    rule_vm = VM(load_rules_from_disk, partition=HashPartition(index, workers))
+    rule_vm.sync_rules()
+    processed = 0
+
+    def report():
+        # Every worker gets every reading, its throughput is the rules it triggered
+        # and evaluated for its own partition
+        while True:
+            outbox.put(("triggered", index, rule_vm.triggered_rules))
+            outbox.put(("evaluated", index, rule_vm.evaluated_rules))
+            time.sleep(report_interval)
+
+    threading.Thread(target=report, daemon=True).start()
+    logger.info(f"Worker {index} started for {rule_vm.partition}")
+
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+
+        device_id, readings = batch
+        rule_vm.process_readings(device_id, readings)
+        processed += len(readings)
+
+    rule_vm.waited_stop()
+    logger.info(
+        f"Worker {index} stopped after {processed} reading(s), "
+        f"{rule_vm.triggered_rules} trigger(s) and {rule_vm.evaluated_rules} evaluation(s)."
+    )
+
+
+class ShardedVM:
+    """Runs the rules in `workers` processes, each owning a hash partition of them.
+
+    Has the same entry points for PubSub readings as the VM (process_readings).
+    Every reading is forwarded to every worker: caching it is cheap, and a
+    worker that only saw the devices of its current rules would hold stale
+    state for a device once a rule on it moves there. Only the owner of a rule
+    evaluates it, which is where the time goes, so the throughput of a worker
+    is the rules it triggered and evaluated, not the readings it received.
+    Workers are started with the spawn method, so the parent's threads (PubSub,
+    Firestore) are never forked into them.
+    """
+
+    # Workers report their throughput this often (in seconds)
+    REPORT_INTERVAL = 10
+    # Batches of readings buffered per worker before process_readings blocks
+    WORKER_QUEUE_SIZE = 1000
+
+    def __init__(self, workers, load_rules_from_disk=True):
+        self.workers = workers
+        # Kind of report -> per worker meter
+        self.throughput = {
+            "triggered": ThroughputMeter(workers),
+            "evaluated": ThroughputMeter(workers),
+        }
+        context = multiprocessing.get_context("spawn")
+        self.outbox = context.Queue()
+        self.inboxes = []
+        self.processes = []
+        for index in range(workers):
+            inbox = context.Queue(self.WORKER_QUEUE_SIZE)
+            process = context.Process(
+                target=run_worker,
+                args=(
+                    index,
+                    workers,
+                    inbox,
+                    self.outbox,
+                    load_rules_from_disk,
+                    self.REPORT_INTERVAL,
+                ),
+                name=f"rule-vm-worker-{index}",
+            )
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        logger.info(f"Started {workers} VM worker processes.")
+
+        self.run_router_thread = True
+        self.router_thread = threading.Thread(target=self.__collect_reports, daemon=True)
+        self.router_thread.start()
+
+    def sync_rules(self):
+        # Every worker watches the rules collection for its own partition
+        pass
+
+    def process_reading(self, device_id, family, data_packet, timestamp=None):
+        self.process_readings(device_id, [(family, data_packet, timestamp)])
+
+    def process_readings(self, device_id, readings):
+        for inbox in self.inboxes:
+            inbox.put((device_id, readings))
+
+    def __collect_reports(self):
+        last_report = time.monotonic()
+        while self.run_router_thread:
+            try:
+                kind, worker, value = self.outbox.get(timeout=1)
+            except queue.Empty:
+                kind = None
+
+            if kind in self.throughput:
+                self.throughput[kind].update(worker, value)
+
+            if time.monotonic() - last_report >= self.REPORT_INTERVAL:
+                last_report = time.monotonic()
+                self.report_throughput()
+
+    def stats(self):
+        """Per worker rates since the previous call and totals, by kind of report."""
+        return {
+            kind: {"rates": meter.rates(), "totals": meter.totals()}
+            for kind, meter in self.throughput.items()
+        }
+
+    def report_throughput(self):
+        stats = self.stats()
+        for worker in range(self.workers):
+            logger.info(
+                f"Worker {worker}: "
+                f"{stats['triggered']['rates'][worker]:.1f} triggers/s, "
+                f"{stats['evaluated']['rates'][worker]:.1f} evaluations/s, "
+                f"{stats['evaluated']['totals'][worker]} evaluations in total"
+            )
+
+    def stop(self):
+        logger.info(f"Stopping {self.workers} VM worker processes.")
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+        self.run_router_thread = False
+        self.router_thread.join()
+
+    def __str__(self):
+        return f"<ShardedVM: {self.workers} workers>"
+
+    def __repr__(self):
+        return self.__str__()
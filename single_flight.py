@@ -0,0 +1,72 @@
+import trio
+
+
+class _Call:
+    __slots__ = ("done", "finished", "value", "error")
+
+    def __init__(self):
+        self.done = trio.Event()
+        # False if the call was cancelled before it finished
+        self.finished = False
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one in-flight call.
+
+    The first caller for a key runs the call, every caller that arrives while
+    it is in flight waits for it and gets the same result (or exception).
+    Nothing is cached, once the call finishes the next caller starts a new one.
+    Must be used from a single trio run.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        # Calls that were actually made
+        self.calls = 0
+        # Calls that were answered by another caller's in-flight call
+        self.coalesced = 0
+
+    async def run(self, key, async_fn, *args):
+        while key in self._in_flight:
+            call = self._in_flight[key]
+            await call.done.wait()
+            if call.finished:
+                self.coalesced += 1
+                if call.error is not None:
+                    raise call.error
+                return call.value
+            # The call was cancelled before it finished, try again
+
+        call = _Call()
+        self._in_flight[key] = call
+        self.calls += 1
+        try:
+            call.value = await async_fn(*args)
+        except trio.Cancelled:
+            raise
+        except Exception as e:
+            call.error = e
+            call.finished = True
+            raise
+        else:
+            call.finished = True
+        finally:
+            del self._in_flight[key]
+            call.done.set()
+
+        return call.value
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+        }
+
+    def __str__(self):
+        return f"<SingleFlight: {self.calls} calls, {self.coalesced} coalesced>"
+
+    def __repr__(self):
+        return self.__str__()
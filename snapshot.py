@@ -0,0 +1,159 @@
+import datetime
+import os
+import threading
+
+import msgpack
+import trio
+from loguru import logger
+
+# Bumped whenever the layout of the snapshot changes, older snapshots are ignored
+SNAPSHOT_FORMAT = 1
+
+# Fields of a rule document needed to build the Rule
+RULE_FIELDS = (
+    "name",
+    "description",
+    "enabled",
+    "conditions",
+    "actions",
+    "execution_count",
+    "max_concurrency",
+)
+
+
+def document_version(document):
+    """Version of a Firestore document (its update time) as something msgpack can store."""
+    update_time = document.update_time
+    if hasattr(update_time, "ToNanoseconds"):
+        return update_time.ToNanoseconds()
+    if isinstance(update_time, datetime.datetime):
+        return update_time.isoformat()
+    return update_time
+
+
+class SnapshotDocument:
+    """Stands in for a Firestore DocumentSnapshot of a rule read from the snapshot."""
+
+    exists = True
+
+    def __init__(self, id, update_time, data):
+        self.id = id
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+    def __str__(self):
+        return f"<SnapshotDocument {self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class RuleSnapshot:
+    """Local copy of the `rules` collection, so the VM can start without waiting on Firestore.
+
+    Each rule document is stored with its update time. On start the rules are
+    built from the snapshot, and when Firestore delivers the collection only
+    documents whose update time differs have to be rebuilt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # rule_id -> (version, fields)
+        self._documents = {}
+        self._dirty = False
+        self.saves = 0
+
+    def load(self):
+        """Read the snapshot from disk. Returns a list of SnapshotDocument."""
+        if not os.path.exists(self.path):
+            logger.info(f"{self.path} not found. Starting without a rule snapshot.")
+            return []
+
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = msgpack.unpackb(f.read(), raw=False)
+            if snapshot.get("format") != SNAPSHOT_FORMAT:
+                logger.warning(f"{self.path} has an unsupported format. Ignoring it.")
+                return []
+            documents = {
+                rule_id: (version, fields)
+                for rule_id, (version, fields) in snapshot["rules"].items()
+            }
+        except Exception as e:
+            logger.error(f"Unable to read {self.path}. Error: {e}")
+            return []
+
+        with self._lock:
+            self._documents = documents
+        logger.info(f"Loaded {len(documents)} rule(s) from {self.path}")
+        return [
+            SnapshotDocument(rule_id, version, fields)
+            for rule_id, (version, fields) in documents.items()
+        ]
+
+    def version(self, rule_id):
+        entry = self._documents.get(rule_id)
+        return entry[0] if entry is not None else None
+
+    def update(self, document):
+        """Record the current version of a rule document."""
+        data = document.to_dict()
+        fields = {field: data[field] for field in RULE_FIELDS if field in data}
+        with self._lock:
+            self._documents[document.id] = (document_version(document), fields)
+            self._dirty = True
+
+    def remove(self, rule_id):
+        with self._lock:
+            if self._documents.pop(rule_id, None) is not None:
+                self._dirty = True
+
+    def rule_ids(self):
+        return list(self._documents)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {
+                "format": SNAPSHOT_FORMAT,
+                "rules": {
+                    rule_id: [version, fields]
+                    for rule_id, (version, fields) in self._documents.items()
+                },
+            }
+            self._dirty = False
+
+        try:
+            data = msgpack.packb(snapshot, use_bin_type=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.saves += 1
+            logger.debug(f"Saved {len(snapshot['rules'])} rule(s) to {self.path}")
+
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            logger.error(f"Unable to save the rule snapshot. Error: {e}")
+
+    async def run(self, interval):
+        while True:
+            await trio.sleep(interval)
+            await trio.to_thread.run_sync(self.save)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __str__(self):
+        return f"<RuleSnapshot {self.path}: {len(self)} rules>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -3,14 +3,20 @@ from typing import Dict
 import firebase_admin
 import trio
 from firebase_admin import firestore, credentials
+from google.api_core.exceptions import NotFound
 from loguru import logger
 
+from single_flight import SingleFlight
+
 FIREBASE_CREDENTIALS_FILE = "firebase_creds.json"
 
 cred = credentials.Certificate(FIREBASE_CREDENTIALS_FILE)
 firebase_app = firebase_admin.initialize_app(cred)
 store = firestore.client()
 
+# Identical reads that are in flight at the same time share one Firestore call
+reads_in_flight = SingleFlight()
+
 
 async def get_document(collection: str, document: str):
     # Connect to firebase and get that information somehow here
@@ -19,7 +25,9 @@ async def get_document(collection: str, document: str):
     def f():
         return store.collection(collection).document(document).get()
 
-    doc = await trio.to_thread.run_sync(f)
+    doc = await reads_in_flight.run(
+        ("document", collection, document), trio.to_thread.run_sync, f
+    )
 
     if doc.exists:
         return doc
@@ -27,8 +35,9 @@ async def get_document(collection: str, document: str):
         return False
 
 
-async def get_device_document(device_id: str):
+async def get_device_document(device_id: str, fields=()):
     # Get the document from Firebase somehow
+    # `fields` is only a hint for caches, Firestore returns the whole document
     return await get_document("devices", device_id)
 
 
@@ -42,24 +51,69 @@ def get_device_document_sync(device_id: str):
         return False
 
 
+def _generated_data_query(device_id: str):
+    return (
+        store.collection("devices")
+        .document(device_id)
+        .collection("generatedData")
+        .order_by("creation_timestamp", direction=firestore.Query.DESCENDING)
+    )
+
+
 async def get_generated_data(device_id: str, count=5):
     def f():
-        return (
-            store.collection("devices")
-            .document(device_id)
-            .collection("generatedData")
-            .order_by("creation_timestamp", direction=firestore.Query.DESCENDING)
-            .limit(count)
-            .get()
-        )
+        # Consume the stream in the worker thread, iterating it makes the requests
+        return list(_generated_data_query(device_id).limit(count).stream())
+
+    async def fetch():
+        data = await trio.to_thread.run_sync(f)
+        list_of_docs = []
+        for x in data:
+            logger.debug(f"Fetched {x.id} document")
+            list_of_docs.append(x.to_dict())
+
+        return list_of_docs
+
+    list_of_docs = await reads_in_flight.run(
+        ("generatedData", device_id, count), fetch
+    )
+    # Callers sharing the read each get their own list
+    return list(list_of_docs)
+
+
+async def iter_generated_data(device_id: str, page_size=20, limit=None):
+    """Yield `generatedData` of a device, newest first, `page_size` documents per read.
+
+    Pages are fetched in a worker thread and only when the previous page is
+    used up, so a caller that stops early doesn't pay for the rest. At most
+    `limit` documents are yielded. Use with `async_generator.aclosing`.
+    """
+    fetched = 0
+    last_snapshot = None
 
-    data = await trio.to_thread.run_sync(f)
-    list_of_docs = []
-    for x in data:
-        logger.debug(f"Fetched {x.id} document")
-        list_of_docs.append(x.to_dict())
+    def f(count, start_after):
+        query = _generated_data_query(device_id).limit(count)
+        if start_after is not None:
+            query = query.start_after(start_after)
+        return list(query.stream())
 
-    return list_of_docs
+    while limit is None or fetched < limit:
+        count = page_size if limit is None else min(page_size, limit - fetched)
+        page = await trio.to_thread.run_sync(f, count, last_snapshot)
+        for snapshot in page:
+            logger.debug(f"Fetched {snapshot.id} document")
+            fetched += 1
+            yield snapshot.to_dict()
+
+        if len(page) < count:
+            # No more documents
+            return
+        last_snapshot = page[-1]
+
+
+def read_stats():
+    """How many reads were made and how many were answered by an identical in-flight read."""
+    return reads_in_flight.stats()
 
 
 def get_all_rules():
@@ -68,6 +122,38 @@ def get_all_rules():
     return data
 
 
+# Firestore accepts at most 500 writes per batch
+MAX_BATCH_SIZE = 500
+
+
+async def batch_update_documents(updates):
+    """Apply a list of (collection, document, data) updates using batched writes.
+
+    Returns the (collection, document) pairs that no longer exist, their updates are skipped.
+    """
+
+    def f():
+        missing = []
+        for i in range(0, len(updates), MAX_BATCH_SIZE):
+            chunk = updates[i : i + MAX_BATCH_SIZE]
+            batch = store.batch()
+            for collection, document, data in chunk:
+                batch.update(store.collection(collection).document(document), data)
+            try:
+                batch.commit()
+            except NotFound:
+                # A batch is atomic, one deleted document fails all of it.
+                # Write this chunk one by one to find and skip the missing ones.
+                for collection, document, data in chunk:
+                    try:
+                        store.collection(collection).document(document).update(data)
+                    except NotFound:
+                        missing.append((collection, document))
+        return missing
+
+    return await trio.to_thread.run_sync(f)
+
+
 async def update_document(collection, document, data):
     def f():
         doc = store.collection(collection).document(document)
@@ -0,0 +1,33 @@
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def is_repo_module(module):
+    path = getattr(module, "__file__", None) or ""
+    return path.startswith(ROOT) and not path.startswith(os.path.join(ROOT, "tests"))
+
+
+@pytest.fixture
+def stub_store(monkeypatch):
+    """Replaces `store` (Firebase is initialized when it is imported) with an empty module.
+
+    Modules of the repo are imported again during the test, bound to the stub.
+    They are unloaded afterwards and the ones loaded before are put back, so
+    the stub doesn't leak into other tests.
+    """
+    for name, module in list(sys.modules.items()):
+        if is_repo_module(module):
+            monkeypatch.delitem(sys.modules, name)
+    loaded = set(sys.modules)
+    fake = types.ModuleType("store")
+    monkeypatch.setitem(sys.modules, "store", fake)
+    yield fake
+
+    for name in set(sys.modules) - loaded:
+        if is_repo_module(sys.modules[name]):
+            del sys.modules[name]
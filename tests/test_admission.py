@@ -0,0 +1,132 @@
+import pytest
+import trio
+
+from admission import AdmissionQueue
+from admission import BULK
+from admission import DROP_NEWEST
+from admission import DROP_OLDEST
+from admission import TIMER
+from admission import TRIGGER
+
+
+def make_queue(trigger_capacity=3, trigger_policy=DROP_OLDEST, on_drop=None):
+    return AdmissionQueue(
+        [
+            (TIMER, 10, DROP_NEWEST),
+            (TRIGGER, trigger_capacity, trigger_policy),
+            (BULK, 10, DROP_NEWEST),
+        ],
+        on_drop=on_drop,
+    )
+
+
+class TestAdmissionQueue:
+    def test_lanes_are_taken_by_priority(self):
+        queue = make_queue()
+        queue.offer(BULK, "rule-1", "bulk-1")
+        queue.offer(TRIGGER, "rule-2", "trigger-2")
+        queue.offer(TRIGGER, "rule-3", "trigger-3")
+        queue.offer(TIMER, 1, "timer-1")
+
+        assert [queue.take() for _ in range(5)] == [
+            (TIMER, "timer-1"),
+            (TRIGGER, "trigger-2"),
+            (TRIGGER, "trigger-3"),
+            (BULK, "bulk-1"),
+            None,
+        ]
+
+    def test_same_key_coalesces(self):
+        queue = make_queue()
+        queue.offer(TRIGGER, "rule-1", "first", now=0)
+        queue.offer(TRIGGER, "rule-2", "other", now=1)
+        assert queue.offer(TRIGGER, "rule-1", "second", now=2)
+
+        assert queue.take(now=5) == (TRIGGER, "second")
+        stats = queue.stats(now=5)[TRIGGER]
+        assert stats["coalesced"] == 1
+        assert stats["admitted"] == 2
+        # Waited since it was first offered
+        assert stats["max_wait"] == 5
+
+    def test_drop_oldest(self):
+        dropped = []
+        queue = make_queue(on_drop=lambda lane, item: dropped.append((lane, item)))
+        for i in range(4):
+            assert queue.offer(TRIGGER, f"rule-{i}", i)
+
+        assert dropped == [(TRIGGER, 0)]
+        assert [queue.take()[1] for _ in range(3)] == [1, 2, 3]
+
+    def test_drop_newest(self):
+        dropped = []
+        queue = make_queue(
+            trigger_policy=DROP_NEWEST,
+            on_drop=lambda lane, item: dropped.append((lane, item)),
+        )
+        results = [queue.offer(TRIGGER, f"rule-{i}", i) for i in range(4)]
+
+        assert results == [True, True, True, False]
+        assert dropped == [(TRIGGER, 3)]
+        assert queue.stats()[TRIGGER]["dropped"] == 1
+        assert queue.depth == 3
+
+    def test_promote_to_higher_priority_lane(self):
+        queue = make_queue()
+        queue.offer(TRIGGER, "rule-2", "trigger-2")
+        queue.offer(BULK, "rule-1", "bulk-1")
+
+        assert queue.promote("rule-1", TRIGGER)
+        # Already in a higher priority lane, or not waiting at all
+        assert not queue.promote("rule-1", BULK)
+        assert not queue.promote("rule-3", TRIGGER)
+
+        assert queue.take() == (TRIGGER, "trigger-2")
+        assert queue.take() == (TRIGGER, "bulk-1")
+        assert queue.stats()[TRIGGER]["promoted"] == 1
+
+    def test_wait_metrics(self):
+        queue = make_queue()
+        queue.offer(BULK, "rule-1", "a", now=0)
+        queue.offer(BULK, "rule-2", "b", now=2)
+        assert queue.stats(now=3)[BULK]["oldest_wait"] == 3
+
+        queue.take(now=4)
+        queue.take(now=4)
+        stats = queue.stats(now=4)[BULK]
+        assert stats["depth"] == 0
+        assert stats["taken"] == 2
+        assert stats["mean_wait"] == 3
+        assert stats["max_wait"] == 4
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            AdmissionQueue([(TIMER, 10, "block")])
+
+    async def test_get_is_woken_from_another_thread(self):
+        queue = make_queue()
+        received = []
+
+        async def consumer():
+            for _ in range(2):
+                received.append(await queue.get())
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(consumer)
+            await trio.sleep(0.01)
+            await trio.to_thread.run_sync(queue.offer, TRIGGER, "rule-1", "trigger-1")
+            await trio.sleep(0.01)
+            # From the trio thread itself
+            queue.offer(TIMER, 1, "timer-1")
+
+        assert received == [(TRIGGER, "trigger-1"), (TIMER, "timer-1")]
+
+    def test_unbounded_lane_never_drops(self):
+        dropped = []
+        queue = AdmissionQueue(
+            [(TIMER, None, DROP_NEWEST)],
+            on_drop=lambda lane, item: dropped.append(item),
+        )
+        assert all(queue.offer(TIMER, i, i) for i in range(5000))
+        assert dropped == []
+        assert queue.stats()[TIMER]["depth"] == 5000
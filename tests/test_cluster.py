@@ -0,0 +1,156 @@
+from cluster import FileLockCoordinator
+from cluster import HashRing
+from cluster import InProcessCoordinator
+from cluster import ShardAssignment
+
+KEYS = [f"device-{i}" for i in range(1000)]
+
+
+class TestHashRing:
+    def test_keys_are_spread_over_nodes(self):
+        ring = HashRing(["node-a", "node-b", "node-c"])
+        owners = [ring.node_for(key) for key in KEYS]
+        for node in ("node-a", "node-b", "node-c"):
+            assert owners.count(node) > 200
+
+    def test_join_only_moves_keys_to_the_new_node(self):
+        ring = HashRing(["node-a", "node-b", "node-c"])
+        before = {key: ring.node_for(key) for key in KEYS}
+        ring.add("node-d")
+        moved = [key for key in KEYS if ring.node_for(key) != before[key]]
+        assert moved
+        assert all(ring.node_for(key) == "node-d" for key in moved)
+        assert len(moved) < len(KEYS) / 2
+
+    def test_leave_only_moves_keys_of_the_leaving_node(self):
+        ring = HashRing(["node-a", "node-b", "node-c"])
+        before = {key: ring.node_for(key) for key in KEYS}
+        ring.remove("node-b")
+        for key in KEYS:
+            if before[key] != "node-b":
+                assert ring.node_for(key) == before[key]
+            else:
+                assert ring.node_for(key) in ("node-a", "node-c")
+
+    def test_empty_ring(self):
+        assert HashRing().node_for("device-1") is None
+
+
+class TestCoordinators:
+    def test_members_expire(self):
+        coordinator = InProcessCoordinator(ttl=30)
+        assert coordinator.heartbeat("node-a", now=0) == {"node-a"}
+        assert coordinator.heartbeat("node-b", now=20) == {"node-a", "node-b"}
+        assert coordinator.members(now=40) == {"node-b"}
+        coordinator.leave("node-b")
+        assert coordinator.members(now=40) == set()
+
+    def test_file_lock_coordinator_is_shared_through_the_file(self, tmp_path):
+        path = str(tmp_path / "cluster.json")
+        first = FileLockCoordinator(path, ttl=30)
+        second = FileLockCoordinator(path, ttl=30)
+        first.heartbeat("node-a", now=0)
+        assert second.heartbeat("node-b", now=10) == {"node-a", "node-b"}
+        second.leave("node-a")
+        assert first.members(now=10) == {"node-b"}
+
+
+class TestShardAssignment:
+    def test_nodes_split_the_rules(self):
+        coordinator = InProcessCoordinator()
+        nodes = [ShardAssignment(name, coordinator) for name in ("node-a", "node-b")]
+        for node in nodes:
+            node.join(now=0)
+        nodes[0].refresh(now=0)
+
+        conditions = [{"operation": "relay_state", "device_id": "device-1"}]
+        owners = [node for node in nodes if node.owns_rule("rule-1", conditions)]
+        assert len(owners) == 1
+        assert owners[0].owns_key("device-1")
+
+    def test_rebalance_on_join_and_leave(self):
+        coordinator = InProcessCoordinator(ttl=30)
+        node_a = ShardAssignment("node-a", coordinator)
+        assert not node_a.refresh(now=0)
+        # Alone, it owns everything
+        assert all(node_a.owns_key(key) for key in KEYS)
+
+        node_b = ShardAssignment("node-b", coordinator)
+        assert node_b.join(now=1)
+        assert node_a.refresh(now=1)
+        assert node_a.generation == 1
+        owned_by_a = {key for key in KEYS if node_a.owns_key(key)}
+        owned_by_b = {key for key in KEYS if node_b.owns_key(key)}
+        assert owned_by_a and owned_by_b
+        assert owned_by_a | owned_by_b == set(KEYS)
+        assert not owned_by_a & owned_by_b
+
+        # node-b stops sending heartbeats
+        assert node_a.refresh(now=40)
+        assert node_a.members == {"node-a"}
+        assert all(node_a.owns_key(key) for key in KEYS)
+
+
+class RuleDocument:
+    def __init__(self, rule_id, device_id):
+        self.id = rule_id
+        self.update_time = None
+        self._data = {
+            "name": rule_id,
+            "description": "",
+            # Never evaluated, only loaded
+            "enabled": False,
+            "conditions": [
+                {"operation": "relay_state", "device_id": device_id, "relay_index": 0, "state": 1}
+            ],
+            "actions": [],
+        }
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class TestClusteredVMs:
+    def test_vms_in_one_process_split_the_rules(self, stub_store, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        documents = [RuleDocument(f"rule-{i}", f"device-{i}") for i in range(40)]
+        stub_store.get_all_rules = lambda: documents
+
+        async def batch_update_documents(updates):
+            return []
+
+        stub_store.batch_update_documents = batch_update_documents
+        from vm import VM
+
+        coordinator = InProcessCoordinator()
+        node_a = ShardAssignment("node-a", coordinator)
+        node_a.join()
+        vm_a = VM(load_rules_from_disk=False, partition=node_a)
+        vm_b = None
+        try:
+            vm_a.rebalance()
+            assert len(vm_a.RULE_REGISTRY) == 40
+
+            node_b = ShardAssignment("node-b", coordinator)
+            node_b.join()
+            vm_b = VM(load_rules_from_disk=False, partition=node_b)
+            assert vm_b.RULE_REGISTRY is not vm_a.RULE_REGISTRY
+            vm_b.rebalance()
+            node_a.refresh()
+            vm_a.rebalance()
+
+            rules_a = {rule_obj.id for rule_obj in vm_a.RULE_REGISTRY.rules()}
+            rules_b = {rule_obj.id for rule_obj in vm_b.RULE_REGISTRY.rules()}
+            assert rules_a and rules_b
+            assert not rules_a & rules_b
+            assert rules_a | rules_b == {document.id for document in documents}
+
+            # node-b leaves, node-a takes its rules back
+            node_b.leave()
+            node_a.refresh()
+            vm_a.rebalance()
+            assert len(vm_a.RULE_REGISTRY) == 40
+        finally:
+            vm_a.stop()
+            if vm_b is not None:
+                vm_b.stop()
@@ -0,0 +1,42 @@
+from coalescer import RuleCoalescer
+
+
+class TestRuleCoalescer:
+    def test_trigger_while_queued_is_suppressed(self):
+        coalescer = RuleCoalescer()
+        assert coalescer.admit("rule-1")
+        assert not coalescer.admit("rule-1")
+        assert not coalescer.admit("rule-1")
+        assert coalescer.admit("rule-2")
+        assert coalescer.suppressed == 2
+
+        coalescer.start("rule-1")
+        assert not coalescer.finish("rule-1")
+        assert coalescer.admit("rule-1")
+
+    def test_triggers_while_running_cause_one_rerun(self):
+        coalescer = RuleCoalescer()
+        coalescer.admit("rule-1")
+        coalescer.start("rule-1")
+        assert not coalescer.admit("rule-1")
+        assert not coalescer.admit("rule-1")
+
+        assert coalescer.finish("rule-1")
+        # The re-run is queued, further triggers are suppressed
+        assert not coalescer.admit("rule-1")
+        coalescer.start("rule-1")
+        assert not coalescer.finish("rule-1")
+        assert len(coalescer) == 0
+        assert coalescer.stats() == {
+            "queued": 0,
+            "running": 0,
+            "suppressed": 3,
+            "reruns": 1,
+        }
+
+    def test_discard(self):
+        coalescer = RuleCoalescer()
+        coalescer.admit("rule-1")
+        coalescer.discard("rule-1")
+        assert coalescer.state("rule-1") is None
+        assert coalescer.admit("rule-1")
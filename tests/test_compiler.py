@@ -0,0 +1,130 @@
+import pytest
+import trio
+
+
+class FakeInstruction:
+    # Anything that isn't a logical operator is an operand
+    instruction_type = None
+
+    def __init__(self, name, result, cost=1, schedules=False, delay=0):
+        self.name = name
+        self.result = result
+        self.cost = cost
+        self.schedules = schedules
+        self.delay = delay
+        self.evaluations = 0
+
+    async def evaluate(self, vm_instance, context=None):
+        self.evaluations += 1
+        await trio.sleep(self.delay)
+        return self.result
+
+    def __str__(self):
+        return self.name
+
+
+def at_time(result):
+    return FakeInstruction("AT_TIME", result, cost=0, schedules=True)
+
+
+@pytest.fixture
+def compiler(stub_store):
+    # The instructions package imports store, which initializes Firebase
+    from instructions import compiler
+
+    return compiler
+
+
+@pytest.fixture
+def ops(compiler):
+    """The logical operators, (AND, OR)."""
+    from instructions.logical import LogicalAnd
+    from instructions.logical import LogicalOr
+
+    return LogicalAnd({}), LogicalOr({})
+
+
+class TestCompileInstructionStream:
+    def test_postfix_stream(self, compiler, ops):
+        AND, OR = ops
+        r1, r2, r3 = (FakeInstruction(f"R{i}", True) for i in range(1, 4))
+        tree = compiler.compile_instruction_stream([r1, r2, AND, r3, OR])
+
+        assert isinstance(tree, compiler.LogicalOrNode)
+        assert isinstance(tree.operands[1], compiler.LogicalAndNode)
+        assert str(tree) == "(R3 OR (R1 AND R2))"
+        assert [leaf.instruction for leaf in tree.leaves()] == [r3, r1, r2]
+
+    def test_empty_stream(self, compiler):
+        assert compiler.compile_instruction_stream([]) is None
+
+    def test_missing_operand(self, compiler, ops):
+        AND, _ = ops
+        with pytest.raises(compiler.InstructionException):
+            compiler.compile_instruction_stream([FakeInstruction("R1", True), AND])
+
+    def test_cheaper_operand_first(self, compiler, ops):
+        AND, _ = ops
+        cheap = FakeInstruction("cheap", True, cost=0)
+        expensive = FakeInstruction("expensive", True, cost=1)
+        tree = compiler.compile_instruction_stream([expensive, cheap, AND])
+
+        assert [node.instruction for node in tree.operands] == [cheap, expensive]
+        assert tree.cost == 1
+
+
+class TestEvaluation:
+    async def test_and_short_circuits(self, compiler, ops):
+        AND, _ = ops
+        r1 = FakeInstruction("R1", False)
+        r2 = FakeInstruction("R2", True)
+        tree = compiler.compile_instruction_stream([r1, r2, AND])
+
+        assert not await tree.evaluate(None)
+        assert (r1.evaluations, r2.evaluations) == (1, 0)
+
+    async def test_or_short_circuits(self, compiler, ops):
+        _, OR = ops
+        r1 = FakeInstruction("R1", True)
+        r2 = FakeInstruction("R2", False)
+        tree = compiler.compile_instruction_stream([r1, r2, OR])
+
+        assert await tree.evaluate(None)
+        assert (r1.evaluations, r2.evaluations) == (1, 0)
+
+    async def test_scheduling_leaves_are_never_skipped(self, compiler, ops):
+        AND, OR = ops
+        # AT_TIME AND R1 AND R2 OR R3, R3 is cheaper than the AND subtree and decides the result
+        timer = at_time(False)
+        r1, r2, r3 = FakeInstruction("R1", True), FakeInstruction("R2", True), FakeInstruction("R3", True)
+        tree = compiler.compile_instruction_stream([timer, r1, AND, r2, AND, r3, OR])
+
+        assert tree.operands[0].instruction is r3
+        assert await tree.evaluate(None)
+        assert timer.evaluations == 1
+        # Only the scheduling leaf of the skipped subtree is evaluated
+        assert (r1.evaluations, r2.evaluations) == (0, 0)
+
+    async def test_concurrent_evaluation(self, compiler, ops):
+        AND, _ = ops
+        leaves = [FakeInstruction(f"R{i}", True, delay=0.1) for i in range(4)]
+        timer = at_time(True)
+        tree = compiler.compile_instruction_stream(
+            [leaves[0], leaves[1], AND, leaves[2], AND, leaves[3], AND, timer, AND]
+        )
+
+        start = trio.current_time()
+        assert await compiler.evaluate_concurrently(tree, None, max_concurrency=4)
+        # The reads overlapped, every leaf was evaluated once
+        assert trio.current_time() - start < 0.3
+        assert [leaf.evaluations for leaf in leaves] == [1, 1, 1, 1]
+        assert timer.evaluations == 1
+
+    async def test_concurrent_evaluation_reads_every_leaf(self, compiler, ops):
+        AND, _ = ops
+        r1 = FakeInstruction("R1", False)
+        r2 = FakeInstruction("R2", True)
+        tree = compiler.compile_instruction_stream([r1, r2, AND])
+
+        assert not await compiler.evaluate_concurrently(tree, None, max_concurrency=1)
+        assert (r1.evaluations, r2.evaluations) == (1, 1)
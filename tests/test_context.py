@@ -0,0 +1,152 @@
+import pytest
+import trio
+
+
+class FirestoreDocument:
+    def __init__(self, id, data):
+        self.id = id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+def relay_condition(relay_index, state):
+    return {
+        "operation": "relay_state",
+        "device_id": "device-1",
+        "relay_index": relay_index,
+        "state": state,
+    }
+
+
+@pytest.fixture
+def firestore(stub_store):
+    """Device documents served by the stubbed store, every read is counted."""
+
+    class Firestore:
+        reads = 0
+        relay_status = [1, 1]
+
+    async def get_device_document(device_id):
+        Firestore.reads += 1
+        status = list(Firestore.relay_status)
+        await trio.sleep(0.01)
+        return FirestoreDocument(device_id, {"relayStatus": status})
+
+    stub_store.get_device_document = get_device_document
+    return Firestore
+
+
+def make_rule(max_concurrency):
+    from rule import Rule
+
+    return Rule(
+        id="rule-1",
+        name="rule-1",
+        description="",
+        conditions=[relay_condition(0, 1), {"operation": "logical_and"}, relay_condition(1, 1)],
+        max_concurrency=max_concurrency,
+    )
+
+
+class TestEvaluationContext:
+    @pytest.mark.parametrize("max_concurrency", [1, 2])
+    async def test_device_is_read_once_per_evaluation(self, firestore, max_concurrency):
+        from context import EvaluationContext
+
+        rule_obj = make_rule(max_concurrency)
+        assert await rule_obj.evaluate(None, EvaluationContext(rule_obj))
+        # Both relays of device-1, also when they are read concurrently
+        assert firestore.reads == 1
+
+    async def test_new_evaluation_reads_again(self, firestore):
+        from context import EvaluationContext
+
+        rule_obj = make_rule(1)
+        assert await rule_obj.evaluate(None, EvaluationContext(rule_obj))
+
+        firestore.relay_status = [1, 0]
+        assert not await rule_obj.evaluate(None, EvaluationContext(rule_obj))
+        assert firestore.reads == 2
+
+    async def test_invalidated_document_is_read_again(self, firestore):
+        from context import EvaluationContext
+
+        context = EvaluationContext()
+        await context.get_device_document("device-1")
+        await context.get_device_document("device-1")
+        assert firestore.reads == 1
+
+        # After an action wrote to the device
+        context.invalidate_device_document("device-1")
+        await context.get_device_document("device-1")
+        assert firestore.reads == 2
+
+
+@pytest.fixture
+def generated_data(stub_store):
+    """generatedData of device-1 served by the stubbed store, newest first. Pages read are counted."""
+    import datetime
+
+    start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+    class GeneratedData:
+        pages = 0
+        documents = [
+            {"creation_timestamp": start - datetime.timedelta(minutes=minute), "minute": minute}
+            for minute in range(50)
+        ]
+
+    async def iter_generated_data(device_id, page_size=20, limit=None):
+        documents = GeneratedData.documents[:limit]
+        for offset in range(0, len(documents), page_size):
+            GeneratedData.pages += 1
+            for document in documents[offset:offset + page_size]:
+                yield document
+
+    stub_store.iter_generated_data = iter_generated_data
+    return GeneratedData
+
+
+class TestHistoryBackfill:
+    async def read(self, context, limit, stop_at=None):
+        from async_generator import aclosing
+
+        minutes = []
+        async with aclosing(
+            context.iter_generated_data("device-1", page_size=10, limit=limit)
+        ) as documents:
+            async for document in documents:
+                minutes.append(document["minute"])
+                if document["minute"] == stop_at:
+                    break
+        return minutes
+
+    async def test_early_stop_while_backfilling(self, generated_data):
+        from context import EvaluationContext
+        from history import DeviceHistory
+
+        history = DeviceHistory(capacity=720)
+        assert await self.read(EvaluationContext(history=history), 100, stop_at=4) == list(range(5))
+        # Only the first page was read, and the history only knows those readings
+        assert generated_data.pages == 1
+        assert history.recent("device-1", 10) == generated_data.documents[:5]
+        assert not history.needs_backfill("device-1", 5)
+        assert history.needs_backfill("device-1", 6)
+
+        # Served from memory
+        assert await self.read(EvaluationContext(history=history), 5) == list(range(5))
+        assert generated_data.pages == 1
+
+    async def test_complete_backfill(self, generated_data):
+        from context import EvaluationContext
+        from history import DeviceHistory
+
+        history = DeviceHistory(capacity=720)
+        assert await self.read(EvaluationContext(history=history), 100) == list(range(50))
+        assert generated_data.pages == 5
+        # Fewer documents than the limit is all the history there is
+        assert not history.needs_backfill("device-1", 700)
+        assert await self.read(EvaluationContext(history=history), 100) == list(range(50))
+        assert generated_data.pages == 5
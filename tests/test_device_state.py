@@ -0,0 +1,91 @@
+from device_state import SENSE_POD
+from device_state import SWITCH_POD_1CHPM
+from device_state import SWITCH_POD_4CH
+from device_state import DeviceStateCache
+
+
+class FirestoreDocument:
+    def __init__(self, id, data):
+        self.id = id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class TestDeviceStateCache:
+    def test_hit_and_miss(self):
+        cache = DeviceStateCache()
+        assert cache.get_device_document("device-1") is None
+        assert cache.get_latest_reading("device-1") is None
+
+        cache.update("device-1", SENSE_POD, {"temperature": 21.5}, timestamp=1)
+        document = cache.get_device_document("device-1")
+        assert document.id == "device-1"
+        assert document.to_dict() == {"temperature": 21.5}
+        assert cache.get_latest_reading("device-1") == {
+            "temperature": 21.5,
+            "creation_timestamp": 1,
+        }
+        assert (cache.hits, cache.misses) == (2, 2)
+
+    def test_readings_update_the_device_document(self):
+        cache = DeviceStateCache()
+        cache.update(
+            "device-1", SWITCH_POD_4CH, {"relay1": 1, "relay2": 0, "relay3": 0, "relay4": 1}
+        )
+        cache.update("device-1", SWITCH_POD_4CH, {"voltage": 230})
+        assert cache.get_device_document("device-1").to_dict()["relayStatus"] == [1, 0, 0, 1]
+        # Fields of earlier readings are kept, the latest reading is only the last one
+        assert cache.get_device_document("device-1").to_dict()["voltage"] == 230
+        assert "relay1" not in cache.get_latest_reading("device-1")
+
+        cache.update("device-2", SWITCH_POD_1CHPM, {"relay_status": 1})
+        assert cache.get_device_document("device-2").to_dict()["relayStatus"] == [1]
+        assert len(cache) == 2
+
+    def test_stale_and_invalidated_documents(self):
+        cache = DeviceStateCache(max_age=-1)
+        cache.update("device-1", SENSE_POD, {"temperature": 21.5})
+        assert cache.get_device_document("device-1") is None
+        # Readings don't go stale, they are timestamped
+        assert cache.get_latest_reading("device-1") is not None
+
+        cache = DeviceStateCache()
+        cache.update("device-1", SENSE_POD, {"temperature": 21.5})
+        cache.invalidate_device_document("device-1")
+        assert cache.get_device_document("device-1") is None
+
+    def test_missing_fields_are_a_miss(self):
+        cache = DeviceStateCache()
+        # A partial 4ch message has no relayStatus
+        cache.update("device-1", SWITCH_POD_4CH, {"relay1": 1})
+        assert cache.get_device_document("device-1", fields=("relayStatus",)) is None
+        assert cache.get_device_document("device-1", fields=("relay1",)) is not None
+
+    async def test_relay_action_falls_back_to_firestore(self, stub_store):
+        # The cached document without relayStatus used to be returned, and the
+        # KeyError in ChangeRelayState killed the VM nursery
+        updates = []
+
+        async def get_device_document(device_id):
+            return FirestoreDocument(device_id, {"relayStatus": [0, 0, 0, 0]})
+
+        async def update_document(collection, document, data):
+            updates.append((collection, document, data))
+
+        stub_store.get_device_document = get_device_document
+        stub_store.update_document = update_document
+        from actions.relay import ChangeRelayState
+        from context import EvaluationContext
+
+        cache = DeviceStateCache()
+        cache.update("device-1", SWITCH_POD_4CH, {"relay1": 1})
+        action = ChangeRelayState(
+            {"type": "change_relay_state", "device_id": "device-1", "relay_index": 0, "state": 1}
+        )
+        await action.perform(EvaluationContext(device_state=cache))
+
+        assert updates == [
+            ("devices", "device-1", {"relay_state": 1, "insertedBy": "dashboard"})
+        ]
@@ -0,0 +1,54 @@
+import datetime
+
+from history import DeviceHistory
+
+START = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def reading(minute, **fields):
+    return {"creation_timestamp": START + datetime.timedelta(minutes=minute), **fields}
+
+
+class TestDeviceHistory:
+    def test_recent_is_newest_first(self):
+        history = DeviceHistory(capacity=3)
+        for minute in range(5):
+            history.record("sense-1", reading(minute))
+
+        assert [r["creation_timestamp"].minute for r in history.recent("sense-1", 5)] == [4, 3, 2]
+        assert [r["creation_timestamp"].minute for r in history.recent("sense-1", 1)] == [4]
+        assert history.recent("unknown", 5) == []
+
+    def test_out_of_order_reading(self):
+        history = DeviceHistory(capacity=3)
+        history.record("sense-1", reading(0))
+        history.record("sense-1", reading(2))
+        history.record("sense-1", reading(1))
+        assert [r["creation_timestamp"].minute for r in history.recent("sense-1", 3)] == [2, 1, 0]
+
+        # Full buffer, the oldest reading makes room
+        history.record("sense-1", reading(1.5))
+        assert [r["creation_timestamp"].minute for r in history.recent("sense-1", 3)] == [2, 1, 1]
+
+    def test_backfill_skips_recorded_readings(self):
+        history = DeviceHistory()
+        history.record("sense-1", reading(10, source="pubsub"))
+        assert history.needs_backfill("sense-1", 5)
+
+        # Firestore copy of the PubSub reading is a few seconds apart
+        documents = [reading(10.02, source="firestore")] + [
+            reading(minute, source="firestore") for minute in (9, 8, 7, 6)
+        ]
+        history.backfill("sense-1", documents, 5)
+
+        recent = history.recent("sense-1", 10)
+        assert [r["source"] for r in recent] == ["pubsub"] + ["firestore"] * 4
+        assert not history.needs_backfill("sense-1", 5)
+        assert history.needs_backfill("sense-1", 6)
+
+    def test_short_backfill_is_complete_history(self):
+        history = DeviceHistory(capacity=100)
+        history.backfill("sense-1", [reading(1), reading(0)], 10)
+        assert not history.needs_backfill("sense-1", 50)
+        # More than the buffer can hold always goes to Firestore
+        assert not history.needs_backfill("sense-1", 101)
@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+
+from fake_pubsub import FakeSubscriber
+from fake_pubsub import FlowControl
+from ingestion import IngestionDispatcher
+
+SUBSCRIPTION = FakeSubscriber.subscription_path("project", "switch-pod-4ch-state-sub")
+
+
+def publish(subscriber, device_id, data):
+    subscriber.publish(
+        SUBSCRIPTION, json.dumps(data).encode("utf-8"), {"deviceId": device_id}
+    )
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class RecordingSink:
+    def __init__(self, fail_for=()):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.fail_for = set(fail_for)
+
+    def __call__(self, device_id, readings):
+        if device_id in self.fail_for:
+            self.fail_for.discard(device_id)
+            raise RuntimeError("VM is not running")
+        with self.lock:
+            self.calls.append((device_id, [data for _, data, _ in readings]))
+
+
+class TestIngestionDispatcher:
+    def test_burst_from_a_device_is_one_trigger(self):
+        sink = RecordingSink()
+        dispatcher = IngestionDispatcher(sink)
+        with FakeSubscriber() as subscriber:
+            dispatcher.subscribe(subscriber, SUBSCRIPTION, "SWITCH_POD_4CH", FlowControl(10))
+            for i in range(5):
+                publish(subscriber, "device-1", {"relay1": i})
+            publish(subscriber, "device-2", {"relay1": 1})
+            wait_for(lambda: dispatcher.received == 6)
+
+            # Nothing is acked before the batch is processed
+            assert subscriber.acked == 0
+            assert dispatcher.flush() == 2
+            assert subscriber.wait_until_acked(6, timeout=1)
+
+        assert sorted(sink.calls) == [
+            ("device-1", [{"relay1": i} for i in range(5)]),
+            ("device-2", [{"relay1": 1}]),
+        ]
+        assert dispatcher.stats() == {
+            "received": 6,
+            "rejected": 0,
+            "batches": 1,
+            "triggers": 2,
+            "acked": 6,
+            "nacked": 0,
+        }
+
+    def test_flow_control_window(self):
+        dispatcher = IngestionDispatcher(RecordingSink())
+        with FakeSubscriber() as subscriber:
+            dispatcher.subscribe(subscriber, SUBSCRIPTION, "SWITCH_POD_4CH", FlowControl(3))
+            for i in range(5):
+                publish(subscriber, "device-1", {"relay1": i})
+            wait_for(lambda: dispatcher.received == 3)
+            time.sleep(0.1)
+            assert dispatcher.received == 3
+
+            # Acking the batch opens the window again
+            dispatcher.flush()
+            wait_for(lambda: dispatcher.received == 5)
+
+    def test_undecodable_message_is_dropped(self):
+        sink = RecordingSink()
+        dispatcher = IngestionDispatcher(sink)
+        with FakeSubscriber() as subscriber:
+            dispatcher.subscribe(subscriber, SUBSCRIPTION, "SWITCH_POD_4CH", FlowControl(10))
+            subscriber.publish(SUBSCRIPTION, b"{not json", {"deviceId": "device-1"})
+            assert subscriber.wait_until_acked(1, timeout=1)
+
+        assert dispatcher.rejected == 1
+        assert dispatcher.flush() == 0
+        assert sink.calls == []
+
+    def test_failed_readings_are_redelivered(self):
+        sink = RecordingSink(fail_for={"device-1"})
+        dispatcher = IngestionDispatcher(sink)
+        with FakeSubscriber() as subscriber:
+            dispatcher.subscribe(subscriber, SUBSCRIPTION, "SWITCH_POD_4CH", FlowControl(10))
+            publish(subscriber, "device-1", {"relay1": 1})
+            wait_for(lambda: dispatcher.received == 1)
+            dispatcher.flush()
+            assert subscriber.nacked == 1
+
+            wait_for(lambda: dispatcher.received == 2)
+            dispatcher.flush()
+            assert subscriber.wait_until_acked(1, timeout=1)
+
+        assert sink.calls == [("device-1", [{"relay1": 1}])]
+
+    def test_background_flush(self):
+        sink = RecordingSink()
+        dispatcher = IngestionDispatcher(sink, batch_window=0.01)
+        dispatcher.start()
+        with FakeSubscriber() as subscriber:
+            dispatcher.subscribe(subscriber, SUBSCRIPTION, "SWITCH_POD_4CH", FlowControl(10))
+            for i in range(20):
+                publish(subscriber, f"device-{i % 4}", {"relay1": i})
+            assert subscriber.wait_until_acked(20, timeout=2)
+        dispatcher.stop()
+
+        assert sum(len(readings) for _, readings in sink.calls) == 20
@@ -0,0 +1,90 @@
+import time
+
+import msgpack
+import trio
+
+from journal import FutureTaskJournal
+
+
+class TestFutureTaskJournal:
+    async def test_replay_after_restart(self, tmp_path):
+        path = str(tmp_path / "future_tasks.journal")
+        journal = FutureTaskJournal(path)
+        assert journal.replay() == {}
+        journal.open()
+        journal.schedule("rule-1", 100.0)
+        journal.schedule("rule-2", 200.0)
+        journal.schedule("rule-1", 150.0)
+        journal.cancel("rule-2")
+        await journal.flush()
+        journal.close()
+
+        restarted = FutureTaskJournal(path)
+        assert restarted.replay() == {"rule-1": 150.0}
+
+    async def test_compaction(self, tmp_path):
+        path = str(tmp_path / "future_tasks.journal")
+        journal = FutureTaskJournal(path, compact_after=10)
+        journal.replay()
+        journal.open()
+        for i in range(20):
+            journal.schedule(f"rule-{i % 3}", float(i))
+        await journal.flush()
+        journal.close()
+
+        assert journal.compactions == 2
+        with open(path, "rb") as f:
+            assert len(list(msgpack.Unpacker(f, raw=False))) == 3
+        assert FutureTaskJournal(path).replay() == {
+            "rule-0": 18.0,
+            "rule-1": 19.0,
+            "rule-2": 17.0,
+        }
+
+    def test_truncated_record_is_dropped(self, tmp_path):
+        path = str(tmp_path / "future_tasks.journal")
+        journal = FutureTaskJournal(path)
+        journal.replay()
+        journal.open()
+        journal.schedule("rule-1", 100.0)
+        journal._append(journal._buffer)
+        journal._file.write(b"\x93\xa1s")
+        journal.close()
+
+        assert FutureTaskJournal(path).replay() == {"rule-1": 100.0}
+
+    async def test_flush_during_compaction(self, tmp_path):
+        path = str(tmp_path / "future_tasks.journal")
+        journal = FutureTaskJournal(path, compact_after=5)
+        journal.replay()
+        journal.open()
+
+        writing = []
+        overlapped = []
+
+        def slow(write):
+            def wrapper(*args):
+                overlapped.append(bool(writing))
+                writing.append(write)
+                time.sleep(0.05)
+                write(*args)
+                writing.pop()
+
+            return wrapper
+
+        journal._compact = slow(journal._compact)
+        journal._append = slow(journal._append)
+
+        for i in range(10):
+            journal.schedule(f"rule-{i}", float(i))
+        async with trio.open_nursery() as nursery:
+            # Compacts, the second flush comes in while it is running
+            nursery.start_soon(journal.flush)
+            await trio.sleep(0.01)
+            journal.schedule("rule-10", 10.0)
+            nursery.start_soon(journal.flush)
+        journal.close()
+
+        assert journal.flushes == 2
+        assert overlapped == [False, False]
+        assert FutureTaskJournal(path).replay() == {f"rule-{i}": float(i) for i in range(11)}
@@ -0,0 +1,43 @@
+from registry import RuleRegistry
+
+
+class FakeRule:
+    def __init__(self, id, dependent_devices):
+        self.id = id
+        self.dependent_devices = dependent_devices
+
+
+class TestRuleRegistry:
+    def test_add_is_keyed_by_id(self):
+        registry = RuleRegistry()
+        assert registry.add(FakeRule("rule-1", ["switch-1"]))
+        assert not registry.add(FakeRule("rule-1", ["switch-2"]))
+        assert len(registry) == 1
+        assert "rule-1" in registry
+
+    def test_rules_for_device(self):
+        registry = RuleRegistry()
+        registry.add(FakeRule("rule-1", ["switch-1", "sense-1"]))
+        registry.add(FakeRule("rule-2", ["switch-1"]))
+        assert {r.id for r in registry.rules_for_device("switch-1")} == {
+            "rule-1",
+            "rule-2",
+        }
+        assert [r.id for r in registry.rules_for_device("sense-1")] == ["rule-1"]
+        assert registry.rules_for_device("unknown") == []
+
+    def test_replace_reindexes_devices(self):
+        registry = RuleRegistry()
+        registry.add(FakeRule("rule-1", ["switch-1"]))
+        previous = registry.replace(FakeRule("rule-1", ["switch-2"]))
+        assert previous.dependent_devices == ["switch-1"]
+        assert registry.rules_for_device("switch-1") == []
+        assert [r.id for r in registry.rules_for_device("switch-2")] == ["rule-1"]
+
+    def test_remove(self):
+        registry = RuleRegistry()
+        registry.add(FakeRule("rule-1", ["switch-1", "switch-1"]))
+        assert registry.remove("rule-1").id == "rule-1"
+        assert registry.remove("rule-1") is None
+        assert registry.devices() == set()
+        assert len(registry) == 0
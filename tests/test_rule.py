@@ -0,0 +1,129 @@
+import arrow
+import pytest
+
+TIME = "09:30:00+05:30"
+
+
+class FirestoreDocument:
+    def __init__(self, id, data):
+        self.id = id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class RecordingVM:
+    def __init__(self):
+        self.scheduled = []
+
+    def add_rule_for_future_exec(self, rule_obj, time_to_execution):
+        self.scheduled.append(rule_obj)
+
+
+def occurrence_condition(occurrence):
+    return {"operation": "at_time_with_occurrence", "time": TIME, "occurrence": occurrence}
+
+
+@pytest.fixture
+def firestore(stub_store, monkeypatch):
+    """The rule document, kept by the stubbed store. Evaluations are always past the target time."""
+    rules = {}
+
+    async def get_document(collection, document):
+        return FirestoreDocument(document, rules[document])
+
+    async def update_document(collection, document, data):
+        rules[document] = data
+
+    stub_store.get_document = get_document
+    stub_store.update_document = update_document
+
+    from instructions.time import AtTime
+
+    def current_and_target_time(self):
+        target_time = arrow.get(f"2026-01-01T{self.time_string}")
+        return target_time.shift(seconds=1), target_time
+
+    monkeypatch.setattr(AtTime, "current_and_target_time", current_and_target_time)
+    return rules
+
+
+def make_rule(rules, occurrence):
+    from rule import Rule
+
+    conditions = [occurrence_condition(occurrence)]
+    rules["rule-1"] = {"conditions": conditions}
+    return Rule(id="rule-1", name="rule-1", description="", conditions=conditions)
+
+
+class TestRuleHandles:
+    def test_clones_share_the_template(self, stub_store):
+        from rule import Rule
+
+        rule_obj = Rule(
+            id="rule-1",
+            name="rule-1",
+            description="",
+            conditions=[{"operation": "at_time", "time": TIME}],
+        )
+        rule_obj.set_execution_count(3)
+        clone = rule_obj.create_clone()
+
+        assert clone.template is rule_obj.template
+        assert clone.evaluation_tree is rule_obj.evaluation_tree
+        assert clone.id == rule_obj.id
+        assert clone.execution_count == 3
+        assert clone.rule_uuid != rule_obj.rule_uuid
+
+    def test_transition_channels(self, stub_store):
+        from rule import Rule
+
+        rule_obj = Rule(
+            id="rule-1",
+            name="rule-1",
+            description="",
+            conditions=[
+                {"operation": "relay_state_for", "device_id": "switch-1", "relay_index": 1, "state": 1, "for": 5},
+                {"operation": "logical_and"},
+                {"operation": "relay_state", "device_id": "switch-2", "relay_index": 0, "state": 1},
+            ],
+        )
+        # Only *_FOR conditions look up transitions
+        assert rule_obj.transition_channels == (("switch-1", "relay2"),)
+
+    async def test_occurrences_are_counted_per_handle(self, firestore):
+        from context import EvaluationContext
+
+        vm = RecordingVM()
+        rule_obj = make_rule(firestore, 2)
+        clone = rule_obj.create_clone()
+        instruction = rule_obj.instruction_stream[0]
+
+        assert await rule_obj.evaluate(vm, EvaluationContext(rule_obj))
+        assert rule_obj.remaining_occurrences == {TIME: 1}
+        # The shared template and the other handle are left alone
+        assert instruction.occurrence == 2
+        assert clone.remaining_occurrences == {}
+        assert firestore["rule-1"]["conditions"][0]["occurrence"] == 1
+
+        assert await rule_obj.evaluate(vm, EvaluationContext(rule_obj))
+        assert not await rule_obj.evaluate(vm, EvaluationContext(rule_obj))
+        assert rule_obj.remaining_occurrences == {TIME: 0}
+        assert firestore["rule-1"]["conditions"][0]["occurrence"] == 0
+
+        # Every evaluation scheduled the next one
+        assert vm.scheduled == [rule_obj] * 3
+
+    async def test_clone_keeps_the_remaining_occurrences(self, firestore):
+        from context import EvaluationContext
+
+        rule_obj = make_rule(firestore, 1)
+        assert await rule_obj.evaluate(RecordingVM(), EvaluationContext(rule_obj))
+
+        clone = rule_obj.create_clone()
+        assert clone.remaining_occurrences == {TIME: 0}
+        assert not await clone.evaluate(RecordingVM(), EvaluationContext(clone))
+        # Copied, not shared
+        clone.remaining_occurrences[TIME] = 5
+        assert rule_obj.remaining_occurrences == {TIME: 0}
@@ -0,0 +1,89 @@
+import time
+
+import trio
+
+from scheduler import BacklogPacer, FutureScheduler, PendingFutureTasks
+
+
+class TestFutureScheduler:
+    def test_pop_due_in_deadline_order(self):
+        fired = []
+        future_scheduler = FutureScheduler(fired.extend)
+        now = time.time()
+        future_scheduler.schedule("b", now - 1, "b")
+        future_scheduler.schedule("a", now - 2, "a")
+        future_scheduler.schedule("c", now + 60, "c")
+        assert future_scheduler.pending == 3
+        assert future_scheduler.pop_due(now) == ["a", "b"]
+        assert future_scheduler.pending == 1
+
+    def test_cancel(self):
+        future_scheduler = FutureScheduler(lambda payloads: None)
+        now = time.time()
+        future_scheduler.schedule("a", now - 1, "a")
+        assert future_scheduler.cancel("a")
+        assert not future_scheduler.cancel("a")
+        assert future_scheduler.pending == 0
+        assert future_scheduler.pop_due(now) == []
+
+    def test_schedule_replaces_same_key(self):
+        future_scheduler = FutureScheduler(lambda payloads: None)
+        now = time.time()
+        future_scheduler.schedule("a", now - 1, "first")
+        future_scheduler.schedule("a", now - 1, "second")
+        assert future_scheduler.pending == 1
+        assert future_scheduler.pop_due(now) == ["second"]
+
+    async def test_fires_due_timers_as_one_batch(self):
+        batches = []
+        future_scheduler = FutureScheduler(batches.append, resolution=0.1)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(future_scheduler.run)
+            await trio.sleep(0)
+            due = time.time() + 0.2
+            for key in range(3):
+                future_scheduler.schedule(key, due, key)
+            await trio.sleep(0.5)
+            nursery.cancel_scope.cancel()
+
+        assert batches == [[0, 1, 2]]
+        assert future_scheduler.pending == 0
+
+
+class FakeRule:
+    def __init__(self, id, rule_uuid):
+        self.id = id
+        self.rule_uuid = rule_uuid
+
+
+class TestPendingFutureTasks:
+    def test_one_pending_task_per_rule(self):
+        pending = PendingFutureTasks()
+        assert pending.add(FakeRule("rule-1", "uuid-1"), 10) is None
+        replaced = pending.add(FakeRule("rule-1", "uuid-2"), 20)
+        assert replaced.rule.rule_uuid == "uuid-1"
+        assert len(pending) == 1
+        assert pending.get("rule-1").due == 20
+        assert pending.remove_by_uuid("uuid-1") is None
+
+    def test_remove_by_uuid_and_id(self):
+        pending = PendingFutureTasks()
+        pending.add(FakeRule("rule-1", "uuid-1"), 10)
+        pending.add(FakeRule("rule-2", "uuid-2"), 10)
+        assert pending.remove_by_uuid("uuid-1").rule.id == "rule-1"
+        assert not pending.has_rule("rule-1")
+        assert pending.remove_by_id("rule-2").rule.rule_uuid == "uuid-2"
+        assert len(pending) == 0
+
+
+class TestBacklogPacer:
+    def test_overdue_items_are_spread_out(self):
+        pacer = BacklogPacer(rate=4)
+        assert [pacer.due(100) for _ in range(4)] == [100, 100.25, 100.5, 100.75]
+        # Once the backlog is cleared items run right away again
+        assert pacer.due(200) == 200
+
+    def test_jitter(self):
+        pacer = BacklogPacer(rate=1, jitter=0.5)
+        for i in range(10):
+            assert 100 + i <= pacer.due(100) <= 100 + i + 0.5
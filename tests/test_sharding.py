@@ -0,0 +1,57 @@
+import pytest
+
+from sharding import HashPartition
+from sharding import ThroughputMeter
+from sharding import partition_of
+from sharding import rule_home_key
+
+
+def relay_condition(device_id):
+    return {
+        "operation": "relay_state",
+        "device_id": device_id,
+        "relay_index": 0,
+        "state": 1,
+    }
+
+
+class TestHashPartition:
+    def test_partition_is_stable(self):
+        # crc32, not the salted builtin hash
+        assert partition_of("switch-pod-4ch-1", 4) == partition_of("switch-pod-4ch-1", 4)
+        assert partition_of("switch-pod-4ch-1", 1) == 0
+        assert {partition_of(f"device-{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+    def test_rule_is_owned_by_its_first_device(self):
+        conditions = [
+            relay_condition("device-b"),
+            {"operation": "and"},
+            relay_condition("device-a"),
+        ]
+        assert rule_home_key("rule-1", conditions) == "device-a"
+        # Rules without devices are spread by their id
+        assert rule_home_key("rule-1", [{"operation": "at_time", "time": "10:00"}]) == "rule-1"
+
+    def test_every_rule_has_exactly_one_owner(self):
+        partitions = [HashPartition(index, 3) for index in range(3)]
+        for i in range(50):
+            conditions = [relay_condition(f"device-{i}"), relay_condition(f"device-{i + 1}")]
+            owners = [p for p in partitions if p.owns_rule(f"rule-{i}", conditions)]
+            assert len(owners) == 1
+
+    def test_index_out_of_range(self):
+        with pytest.raises(ValueError):
+            HashPartition(3, 3)
+
+
+class TestThroughputMeter:
+    def test_rates_between_reports(self):
+        meter = ThroughputMeter(2)
+        meter.rates(now=0)
+        meter.update(0, 100)
+        meter.update(1, 20)
+        assert meter.rates(now=10) == [10, 2]
+
+        meter.update(0, 150)
+        assert meter.rates(now=20) == [5, 0]
+        assert meter.totals() == [150, 20]
@@ -0,0 +1,71 @@
+import pytest
+import trio
+
+from single_flight import SingleFlight
+
+
+class TestSingleFlight:
+    async def test_concurrent_calls_share_one_call(self):
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        async def fetch(key):
+            calls.append(key)
+            await trio.sleep(0.1)
+            return f"value of {key}"
+
+        async def caller():
+            results.append(await flights.run("key", fetch, "key"))
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(5):
+                nursery.start_soon(caller)
+
+        assert calls == ["key"]
+        assert results == ["value of key"] * 5
+        assert flights.stats() == {"calls": 1, "coalesced": 4, "in_flight": 0}
+
+    async def test_different_keys_are_not_shared(self):
+        flights = SingleFlight()
+
+        async def fetch(key):
+            await trio.sleep(0.01)
+            return key
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(flights.run, "a", fetch, "a")
+            nursery.start_soon(flights.run, "b", fetch, "b")
+
+        assert flights.calls == 2
+        assert flights.coalesced == 0
+
+    async def test_exception_is_shared(self):
+        flights = SingleFlight()
+        errors = []
+
+        async def fetch():
+            await trio.sleep(0.01)
+            raise ValueError("Firestore is down")
+
+        async def caller():
+            with pytest.raises(ValueError):
+                await flights.run("key", fetch)
+            errors.append(True)
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(3):
+                nursery.start_soon(caller)
+
+        assert len(errors) == 3
+        assert flights.calls == 1
+
+    async def test_calls_are_not_cached(self):
+        flights = SingleFlight()
+
+        async def fetch():
+            return 1
+
+        await flights.run("key", fetch)
+        await flights.run("key", fetch)
+        assert flights.calls == 2
@@ -0,0 +1,57 @@
+import datetime
+
+from snapshot import RuleSnapshot, SnapshotDocument, document_version
+
+
+class FakeDocument:
+    def __init__(self, id, update_time, data):
+        self.id = id
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+RULE = {
+    "name": "Balcony lights",
+    "description": "",
+    "enabled": True,
+    "conditions": [{"operation": "at_time", "time": "18:00:00+05:30"}],
+    "actions": [],
+    "last_executed": datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc),
+}
+
+
+class TestRuleSnapshot:
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / "rules.snapshot")
+        updated = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        snapshot = RuleSnapshot(path)
+        snapshot.update(FakeDocument("rule-1", updated, RULE))
+        snapshot.update(FakeDocument("rule-2", updated, RULE))
+        snapshot.remove("rule-2")
+        snapshot.save()
+
+        documents = RuleSnapshot(path).load()
+        assert [d.id for d in documents] == ["rule-1"]
+        # Only the fields needed to build the rule are kept
+        assert "last_executed" not in documents[0].to_dict()
+        assert documents[0].to_dict()["conditions"] == RULE["conditions"]
+        assert document_version(documents[0]) == updated.isoformat()
+
+    def test_save_only_when_changed(self, tmp_path):
+        snapshot = RuleSnapshot(str(tmp_path / "rules.snapshot"))
+        snapshot.save()
+        assert snapshot.saves == 0
+        snapshot.update(SnapshotDocument("rule-1", 1, RULE))
+        snapshot.save()
+        snapshot.save()
+        assert snapshot.saves == 1
+        assert snapshot.version("rule-1") == 1
+
+    def test_unreadable_snapshot_is_ignored(self, tmp_path):
+        path = tmp_path / "rules.snapshot"
+        path.write_bytes(b"not msgpack")
+        assert RuleSnapshot(str(path)).load() == []
+        assert RuleSnapshot(str(tmp_path / "missing")).load() == []
@@ -1,3 +1,5 @@
+from async_generator import aclosing
+
 import store
 import trio
 
@@ -24,3 +26,70 @@ class TestStore:
         await trio.sleep(1)
         end_time = trio.current_time()
         assert end_time - start_time >= 1
+
+
+class FakeSnapshot:
+    def __init__(self, index):
+        self.id = f"document-{index}"
+        self.index = index
+
+    def to_dict(self):
+        return {"index": self.index}
+
+
+class FakeQuery:
+    """generatedData query over `documents` snapshots, newest first."""
+
+    def __init__(self, documents, pages, count=None, start=0):
+        self.documents = documents
+        self.pages = pages
+        self.count = count
+        self.start = start
+
+    def limit(self, count):
+        return FakeQuery(self.documents, self.pages, count, self.start)
+
+    def start_after(self, snapshot):
+        return FakeQuery(self.documents, self.pages, self.count, snapshot.index + 1)
+
+    def stream(self):
+        self.pages.append((self.start, self.count))
+        return iter(self.documents[self.start:self.start + self.count])
+
+
+class TestIterGeneratedData:
+    def fake_collection(self, monkeypatch, size):
+        pages = []
+        documents = [FakeSnapshot(index) for index in range(size)]
+        monkeypatch.setattr(
+            store, "_generated_data_query", lambda device_id: FakeQuery(documents, pages)
+        )
+        return pages
+
+    async def test_pages(self, monkeypatch):
+        pages = self.fake_collection(monkeypatch, 45)
+        async with aclosing(store.iter_generated_data("device-1", page_size=20)) as documents:
+            indexes = [document["index"] async for document in documents]
+
+        assert indexes == list(range(45))
+        assert pages == [(0, 20), (20, 20), (40, 20)]
+
+    async def test_limit(self, monkeypatch):
+        pages = self.fake_collection(monkeypatch, 100)
+        async with aclosing(
+            store.iter_generated_data("device-1", page_size=20, limit=30)
+        ) as documents:
+            indexes = [document["index"] async for document in documents]
+
+        assert indexes == list(range(30))
+        # The last page only asks for what is left
+        assert pages == [(0, 20), (20, 10)]
+
+    async def test_early_stop_reads_no_more_pages(self, monkeypatch):
+        pages = self.fake_collection(monkeypatch, 100)
+        async with aclosing(store.iter_generated_data("device-1", page_size=20)) as documents:
+            async for document in documents:
+                if document["index"] == 5:
+                    break
+
+        assert pages == [(0, 20)]
@@ -0,0 +1,89 @@
+import datetime
+
+from transitions import OCCUPIED, PRESENCE, StateTransitionTracker
+
+START = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def at(minute):
+    return START + datetime.timedelta(minutes=minute)
+
+
+def tracker_for(*channels):
+    tracker = StateTransitionTracker()
+    tracker.subscribe(channels)
+    return tracker
+
+
+class TestStateTransitionTracker:
+    def test_transition_is_exact_once_observed(self):
+        tracker = tracker_for(("switch-1", "relay1"))
+        tracker.observe("switch-1", "relay1", 0, at(0))
+        tracker.observe("switch-1", "relay1", 0, at(1))
+        state = tracker.state_since("switch-1", "relay1")
+        assert (state.state, state.since, state.exact) == (0, at(0), False)
+
+        tracker.observe("switch-1", "relay1", 1, at(2))
+        tracker.observe("switch-1", "relay1", 1, at(3))
+        state = tracker.state_since("switch-1", "relay1")
+        assert (state.state, state.since, state.last_seen, state.exact) == (
+            1,
+            at(2),
+            at(3),
+            True,
+        )
+
+    def test_late_reading_is_ignored(self):
+        tracker = tracker_for(("switch-1", "relay1"))
+        tracker.observe("switch-1", "relay1", 1, at(5))
+        tracker.observe("switch-1", "relay1", 0, at(4))
+        assert tracker.state_since("switch-1", "relay1").state == 1
+
+    def test_seed(self):
+        tracker = tracker_for(("switch-1", "relay1"))
+        tracker.observe("switch-1", "relay1", 1, at(5))
+        # Stale, the relay is in another state now
+        tracker.seed("switch-1", "relay1", 0, at(1))
+        assert not tracker.state_since("switch-1", "relay1").exact
+
+        tracker.seed("switch-1", "relay1", 1, at(1))
+        state = tracker.state_since("switch-1", "relay1")
+        assert (state.since, state.exact) == (at(1), True)
+
+    def test_observe_reading(self):
+        tracker = tracker_for(
+            ("sense-1", PRESENCE), ("sense-1", "status"), ("sense-1", "relay1")
+        )
+        for minute in (0, 1, 2, 6, 7):
+            tracker.observe_reading(
+                "sense-1",
+                {"creation_timestamp": at(minute), "relay1": 1, "status": "OPEN"},
+            )
+
+        presence = tracker.state_since("sense-1", PRESENCE)
+        # No reading for 4 minutes, a new occupied period started
+        assert (presence.state, presence.since, presence.exact) == (OCCUPIED, at(6), True)
+        assert tracker.state_since("sense-1", "status").state == "open"
+        assert tracker.snapshot()["sense-1"]["relay1"] == {
+            "state": 1,
+            "since": at(0).isoformat(),
+            "last_seen": at(7).isoformat(),
+            "exact": False,
+        }
+
+    def test_only_subscribed_channels_are_tracked(self):
+        tracker = tracker_for(("sense-1", PRESENCE))
+        tracker.observe_reading("sense-1", {"creation_timestamp": at(0), "relay1": 1})
+        tracker.observe_reading("sense-2", {"creation_timestamp": at(0)})
+        tracker.seed("sense-2", PRESENCE, OCCUPIED, at(0))
+        assert len(tracker) == 1
+        assert tracker.state_since("sense-2", PRESENCE) is None
+
+        # Two rules read the channel, it is forgotten when both are gone
+        tracker.subscribe([("sense-1", PRESENCE)])
+        tracker.unsubscribe([("sense-1", PRESENCE)])
+        assert tracker.state_since("sense-1", PRESENCE) is not None
+        tracker.unsubscribe([("sense-1", PRESENCE)])
+        assert len(tracker) == 0
+        tracker.observe_reading("sense-1", {"creation_timestamp": at(1)})
+        assert len(tracker) == 0
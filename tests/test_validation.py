@@ -0,0 +1,45 @@
+import jsonschema
+import pytest
+
+import validation
+
+
+class Instruction:
+    schema = {
+        "$schema": "http://json-schema.org/draft-07/schema",
+        "type": "object",
+        "properties": {
+            "operation": {"type": "string", "enum": ["relay_state"]},
+            "state": {"type": "integer", "minimum": 0, "maximum": 1},
+        },
+        "required": ["operation", "state"],
+    }
+
+
+class BrokenInstruction:
+    schema = {"type": "not a type"}
+
+
+class TestValidation:
+    def test_validator_is_built_once(self):
+        assert validation.validator_for(Instruction) is validation.validator_for(
+            Instruction
+        )
+
+    def test_valid_and_invalid_data(self):
+        validation.validate({"operation": "relay_state", "state": 1}, Instruction)
+        with pytest.raises(jsonschema.ValidationError):
+            validation.validate({"operation": "relay_state", "state": 2}, Instruction)
+        with pytest.raises(jsonschema.ValidationError):
+            validation.validate({"operation": "relay_state"}, Instruction)
+
+    def test_broken_schema(self):
+        with pytest.raises(jsonschema.SchemaError):
+            validation.validate({}, BrokenInstruction)
+
+    def test_formats_are_not_enforced(self):
+        # Same as jsonschema.validate, AT_TIME accepts times its "time" format would reject
+        class TimedInstruction:
+            schema = {"type": "object", "properties": {"time": {"type": "string", "format": "time"}}}
+
+        validation.validate({"time": "9:42"}, TimedInstruction)
@@ -0,0 +1,91 @@
+import trio
+
+from write_behind import WriteBehindBuffer
+
+
+class TestWriteBehindBuffer:
+    async def test_updates_to_a_document_are_merged(self):
+        commits = []
+
+        async def commit(updates):
+            commits.append(updates)
+
+        buffer = WriteBehindBuffer(commit)
+        buffer.record("rules", "a", {"execution_count": 1, "last_executed": 1})
+        buffer.record("rules", "a", {"execution_count": 2})
+        buffer.record("rules", "b", {"execution_count": 1})
+        await buffer.flush()
+
+        assert commits == [
+            [
+                ("rules", "a", {"execution_count": 2, "last_executed": 1}),
+                ("rules", "b", {"execution_count": 1}),
+            ]
+        ]
+        assert buffer.pending == 0
+        assert buffer.flushed_updates == 2
+
+    async def test_flushes_when_max_pending_is_reached(self):
+        commits = []
+
+        async def commit(updates):
+            commits.append(updates)
+
+        buffer = WriteBehindBuffer(commit, flush_interval=60, max_pending=2)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(buffer.run)
+            buffer.record("rules", "a", {"execution_count": 1})
+            await trio.sleep(0.1)
+            assert commits == []
+
+            buffer.record("rules", "b", {"execution_count": 1})
+            await trio.sleep(0.1)
+            assert len(commits) == 1
+            nursery.cancel_scope.cancel()
+
+    async def test_failed_flush_keeps_newer_updates(self):
+        async def commit(updates):
+            buffer.record("rules", "a", {"execution_count": 3})
+            raise RuntimeError("unavailable")
+
+        buffer = WriteBehindBuffer(commit)
+        buffer.record("rules", "a", {"execution_count": 2, "last_executed": 1})
+        await buffer.flush()
+
+        assert buffer.failed_flushes == 1
+        assert buffer._pending == {
+            ("rules", "a"): {"execution_count": 3, "last_executed": 1}
+        }
+
+    async def test_missing_documents_are_not_retried(self):
+        commits = []
+
+        async def commit(updates):
+            commits.append(updates)
+            return [("rules", "deleted")]
+
+        buffer = WriteBehindBuffer(commit)
+        buffer.record("rules", "a", {"execution_count": 1})
+        buffer.record("rules", "deleted", {"execution_count": 1})
+        await buffer.flush()
+        await buffer.flush()
+
+        assert len(commits) == 1
+        assert buffer.pending == 0
+        assert buffer.flushed_updates == 1
+        assert buffer.missing_documents == 1
+
+    async def test_discard(self):
+        commits = []
+
+        async def commit(updates):
+            commits.append(updates)
+
+        buffer = WriteBehindBuffer(commit)
+        buffer.record("rules", "a", {"execution_count": 1})
+        buffer.record("rules", "b", {"execution_count": 1})
+        buffer.discard("rules", "a")
+        buffer.discard("rules", "unknown")
+        await buffer.flush()
+
+        assert commits == [[("rules", "b", {"execution_count": 1})]]
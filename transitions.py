@@ -0,0 +1,163 @@
+import datetime
+import threading
+from typing import Dict
+
+# Channels derived from a reading, besides the relay keys
+DOOR_WINDOW_STATUS = "status"
+PRESENCE = "presence"
+OCCUPIED = "occupied"
+UNOCCUPIED = "unoccupied"
+
+# Keys holding relay states, `relay_status` is sent by 1chpm devices
+RELAY_KEYS = ("relay1", "relay2", "relay3", "relay4", "relay_status")
+
+
+class ChannelState:
+    """State of one channel of a device and when it last changed."""
+
+    __slots__ = ("state", "since", "last_seen", "exact")
+
+    def __init__(self, state, since, exact=False):
+        self.state = state
+        self.since = since
+        self.last_seen = since
+        # False until a transition was observed (or seeded). Before that,
+        # `since` is only when the VM first saw the state.
+        self.exact = exact
+
+    def copy(self):
+        copy = ChannelState(self.state, self.since, self.exact)
+        copy.last_seen = self.last_seen
+        return copy
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "since": self.since.isoformat(),
+            "last_seen": self.last_seen.isoformat(),
+            "exact": self.exact,
+        }
+
+    def __str__(self):
+        return f"<ChannelState {self.state} since {self.since}{'' if self.exact else ' (or earlier)'}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class StateTransitionTracker:
+    """Current state of every (device, channel) pair and the time of its last transition.
+
+    Updated from readings as they arrive, so "how long has it been in this
+    state" is a lookup instead of a walk through `generatedData`. Presence is
+    a state that has to be refreshed: a reading more than `presence_timeout`
+    after the previous one starts a new occupied period.
+
+    Only channels that loaded rules `subscribe` to are tracked, a channel is
+    forgotten once the last of them unsubscribes.
+    """
+
+    def __init__(self, presence_timeout=datetime.timedelta(minutes=2)):
+        self.presence_timeout = presence_timeout
+        self._lock = threading.Lock()
+        # (device_id, channel) -> ChannelState
+        self._channels = {}
+        # (device_id, channel) -> number of subscriptions
+        self._subscriptions = {}
+
+    def subscribe(self, channels):
+        """Start tracking (device_id, channel) pairs."""
+        with self._lock:
+            for key in channels:
+                self._subscriptions[key] = self._subscriptions.get(key, 0) + 1
+
+    def unsubscribe(self, channels):
+        """Undo a `subscribe`, channels nothing subscribes to anymore are forgotten."""
+        with self._lock:
+            for key in channels:
+                count = self._subscriptions.get(key, 0) - 1
+                if count > 0:
+                    self._subscriptions[key] = count
+                else:
+                    self._subscriptions.pop(key, None)
+                    self._channels.pop(key, None)
+
+    def observe(self, device_id: str, channel: str, state, timestamp, max_gap=None):
+        with self._lock:
+            if (device_id, channel) not in self._subscriptions:
+                return
+            current = self._channels.get((device_id, channel))
+            if current is None:
+                self._channels[(device_id, channel)] = ChannelState(state, timestamp)
+                return
+
+            if timestamp < current.last_seen:
+                # Late reading, the state it carried has already been superseded
+                return
+
+            if current.state != state or (
+                max_gap is not None and timestamp - current.last_seen > max_gap
+            ):
+                current.state = state
+                current.since = timestamp
+                current.exact = True
+            current.last_seen = timestamp
+
+    def observe_reading(self, device_id: str, reading: Dict):
+        """Update every channel carried by a reading with a `creation_timestamp`."""
+        timestamp = reading["creation_timestamp"]
+        for key in RELAY_KEYS:
+            if key in reading:
+                self.observe(device_id, key, reading[key], timestamp)
+
+        if DOOR_WINDOW_STATUS in reading:
+            self.observe(
+                device_id,
+                DOOR_WINDOW_STATUS,
+                str(reading[DOOR_WINDOW_STATUS]).lower(),
+                timestamp,
+            )
+
+        # Occupancy sensors only send data while they detect someone
+        self.observe(
+            device_id, PRESENCE, OCCUPIED, timestamp, max_gap=self.presence_timeout
+        )
+
+    def seed(self, device_id: str, channel: str, state, since):
+        """Record a transition found by looking back at history.
+
+        Ignored if the channel has moved on to another state or already knows
+        its transition.
+        """
+        with self._lock:
+            if (device_id, channel) not in self._subscriptions:
+                return
+            current = self._channels.get((device_id, channel))
+            if current is None:
+                self._channels[(device_id, channel)] = ChannelState(state, since, exact=True)
+            elif current.state == state and not current.exact:
+                current.since = min(current.since, since)
+                current.exact = True
+
+    def state_since(self, device_id: str, channel: str):
+        """ChannelState of the channel, or None if nothing was observed on it."""
+        with self._lock:
+            current = self._channels.get((device_id, channel))
+            return current.copy() if current is not None else None
+
+    def snapshot(self):
+        """Every tracked channel as {device_id: {channel: {...}}}, for debugging."""
+        with self._lock:
+            snapshot = {}
+            for (device_id, channel), state in self._channels.items():
+                snapshot.setdefault(device_id, {})[channel] = state.to_dict()
+            return snapshot
+
+    def __len__(self):
+        return len(self._channels)
+
+    def __str__(self):
+        return f"<StateTransitionTracker: {len(self)} channels>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,23 @@
+import jsonschema
+
+# Class -> Draft7Validator for its `schema`, built the first time the class validates data
+_validators = {}
+
+
+def validator_for(owner):
+    """Compiled validator of an instruction or action class. The schema is checked only once."""
+    validator = _validators.get(owner)
+    if validator is None:
+        # Raises SchemaError for a broken schema, just like jsonschema.validate
+        jsonschema.Draft7Validator.check_schema(owner.schema)
+        # No format checker, jsonschema.validate doesn't check "format" either
+        validator = jsonschema.Draft7Validator(owner.schema)
+        _validators[owner] = validator
+    return validator
+
+
+def validate(instance, owner):
+    """Same as jsonschema.validate(instance, owner.schema), with the validator reused."""
+    error = jsonschema.exceptions.best_match(validator_for(owner).iter_errors(instance))
+    if error is not None:
+        raise error
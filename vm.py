@@ -1,28 +1,60 @@
 import json
-import queue
 import sys
 import threading
 import time
-import pickle
-import os
 
 import trio
 from jsonschema import ValidationError, SchemaError
 from loguru import logger
 from parse import compile as pc
 
+import admission
+import coalescer
+import device_state
+import history
+import journal
 import instructions
+import registry
+from context import EvaluationContext
 import rule
+import scheduler
+import sharding
+import snapshot
 import store
+import transitions
+import write_behind
 
 
 class VM:
-    TASK_QUEUE_BUFFER_SIZE = 10
-    FUTURE_TASK_QUEUE_BUFFER_SIZE = 10
-    LIST_OF_RULES = []
-    FUTURE_TASKS_AWAITING_COMPLETION = []
-    TASKS_RUNNING = 0
-    FUTURE_TASK_COUNT = 0
+    # Rules waiting to be executed are admitted to one of these lanes, highest
+    # priority first: (lane, capacity, what is dropped when it is full). Timers
+    # are never dropped, AT_TIME rules only schedule their next run when evaluated.
+    ADMISSION_LANES = (
+        (admission.TIMER, None, admission.DROP_NEWEST),
+        (admission.TRIGGER, 200, admission.DROP_OLDEST),
+        (admission.BULK, 1000, admission.DROP_NEWEST),
+    )
+    # Rules evaluated at the same time, the others wait in their lane
+    MAX_RUNNING_RULES = 50
+    # Future tasks due within the same tick are executed together
+    FUTURE_TASK_RESOLUTION = 1
+    # Add 2 seconds for definite execution next time
+    FUTURE_TASK_GRACE_PERIOD = 2
+    # Pending future tasks are journaled here so they survive a restart
+    FUTURE_TASK_JOURNAL = "future_tasks.journal"
+    # Restored future tasks that became due while the VM was down are replayed
+    # at this many per second, each delayed by up to the jitter (in seconds)
+    RESTORED_BACKLOG_RATE = 5
+    RESTORED_BACKLOG_JITTER = 0.5
+    # Local copy of the rules collection for warm starts, saved this often (in seconds)
+    RULE_SNAPSHOT = "rules.snapshot"
+    RULE_SNAPSHOT_INTERVAL = 30
+    # Readings kept in memory per device, enough for *_FOR conditions of 12 hours
+    DEVICE_HISTORY_CAPACITY = 720
+    # Rule execution info is written back in batches, at least this often (in seconds)
+    EXECUTION_INFO_FLUSH_INTERVAL = 5
+    # ...or as soon as this many rules have pending execution info
+    EXECUTION_INFO_MAX_PENDING = 100
     # Used for parsing rules in string format
     instructions_pattern = [
         pc("AT_TIME {time}"),
@@ -45,47 +77,130 @@ class VM:
         pc("ENERGY_METER {device_id} FREQUENCY {comparison_op} {value:f}"),
     ]
 
-    def __init__(self, load_rules_from_disk=True):
+    def __init__(self, load_rules_from_disk=True, partition=None):
         self.run_vm_thread = True
         self.load_rules_from_disk = load_rules_from_disk
-        self.last_serialized_rules = []  # To prevent useless writing to disk
-        self.task_queue = queue.Queue(self.TASK_QUEUE_BUFFER_SIZE)
-        self.future_task_queue = queue.Queue(self.FUTURE_TASK_QUEUE_BUFFER_SIZE)
-
+        # Rules keyed by id and indexed by the devices they depend on. Kept per
+        # VM, several VMs (partitions or nodes) may run in one process.
+        self.RULE_REGISTRY = registry.RuleRegistry()
+        # At most one pending future task per rule, indexed by rule id and rule_uuid
+        self.FUTURE_TASKS_AWAITING_COMPLETION = scheduler.PendingFutureTasks()
+        self.TASKS_RUNNING = 0
+        # Only rules owned by this partition (sharding.HashPartition or
+        # cluster.ShardAssignment) are loaded, None loads every rule
+        self.partition = partition
+        # Rules are handed to the VM thread through these lanes, so due timers
+        # don't wait behind sensor noise. Producers never block, a full lane drops.
+        self.task_admission = admission.AdmissionQueue(
+            self.ADMISSION_LANES, on_drop=self.__dropped_task
+        )
+        self.future_scheduler = scheduler.FutureScheduler(
+            self.__run_future_tasks, resolution=self.FUTURE_TASK_RESOLUTION
+        )
+        # At most one queued and one running execution of each rule
+        self.rule_coalescer = coalescer.RuleCoalescer()
+        # Latest state of each device, fed from PubSub messages
+        self.device_state = device_state.DeviceStateCache()
+        # Recent readings of each device, for conditions that look back in time
+        self.device_history = history.DeviceHistory(self.DEVICE_HISTORY_CAPACITY)
+        # Current state of each device channel and when it last changed
+        self.state_transitions = transitions.StateTransitionTracker()
+        # Keeps execution_count/last_executed writes off the path to the actions
+        self.execution_info_writer = write_behind.WriteBehindBuffer(
+            store.batch_update_documents,
+            flush_interval=self.EXECUTION_INFO_FLUSH_INTERVAL,
+            max_pending=self.EXECUTION_INFO_MAX_PENDING,
+        )
+        # Rules triggered by readings and rules evaluated, the work this VM actually did
+        self.triggered_rules = 0
+        self.evaluated_rules = 0
+        self.nursery = None
+        self.trio_token = None
+        self.vm_thread_id = None
+        self.vm_thread_started = threading.Event()
+
+        self.future_task_journal = journal.FutureTaskJournal(
+            self.partition_file(self.FUTURE_TASK_JOURNAL)
+        )
+        # Future tasks pending before the restart, rule_id -> due. They are
+        # scheduled again when their rule is loaded.
+        self.restored_future_tasks = {}
         if self.load_rules_from_disk:
-            self.load_future_rules_from_disk_to_queue()
+            self.restored_future_tasks = self.future_task_journal.replay()
+            self.report_restored_backlog()
+        self.future_task_journal.open()
+        self.restored_backlog_pacer = scheduler.BacklogPacer(
+            self.RESTORED_BACKLOG_RATE, self.RESTORED_BACKLOG_JITTER
+        )
+        self.rule_snapshot = snapshot.RuleSnapshot(self.partition_file(self.RULE_SNAPSHOT))
+        # Rules loaded from the snapshot that Firestore hasn't confirmed yet
+        self.unconfirmed_snapshot_rules = set()
 
         self.vm_thread = threading.Thread(target=lambda: trio.run(self.__starter))
         self.vm_thread.start()
         logger.info("Started VM thread.")
-        self.FUTURE_TASK_LIST_FILE_HANDLER = open(
-            "future_task_list.pickle", "wb", buffering=0
+
+    def partition_file(self, path):
+        # Partitions may run side by side, each needs its own files
+        if self.partition is None:
+            return path
+        return f"{path}.{self.partition.name}"
+
+    def owns_rule_document(self, document):
+        if self.partition is None:
+            return True
+        return self.partition.owns_rule(
+            document.id, document.to_dict().get("conditions", [])
         )
 
-    def load_future_rules_from_disk_to_queue(self):
-        if os.path.exists("future_task_list.pickle"):
+    def report_restored_backlog(self):
+        now = time.time()
+        overdue = [now - due for due in self.restored_future_tasks.values() if due <= now]
+        if not overdue:
+            logger.info(f"{len(self.restored_future_tasks)} future task(s) restored, none are overdue.")
+            return
+
+        logger.warning(
+            f"{len(overdue)} of {len(self.restored_future_tasks)} restored future task(s) are overdue, "
+            f"the VM is {max(overdue):.0f} seconds behind. Replaying them at "
+            f"{self.RESTORED_BACKLOG_RATE} per second, this takes about "
+            f"{len(overdue) / self.RESTORED_BACKLOG_RATE:.0f} seconds."
+        )
 
-            f = open("future_task_list.pickle", "rb")
-            try:
-                self.last_serialized_rules = pickle.load(f)
-                for rule in self.last_serialized_rules:
-                    logger.debug(f"Retrieved rule from disk ->  {rule}")
-                    self.task_queue.put(rule)
+    @property
+    def FUTURE_TASK_COUNT(self):
+        return self.future_scheduler.pending
 
-            except EOFError:
-                logger.error("EOFError. future_task_list.pickle file is empty.")
+    @property
+    def SUPPRESSED_TRIGGER_COUNT(self):
+        return self.rule_coalescer.suppressed
 
-            f.close()
-        else:
-            logger.error("future_task_list.pickle file not found on disk.")
+    @property
+    def ADMISSION_STATS(self):
+        """Depth, drops and wait times of each admission lane."""
+        return self.task_admission.stats()
 
     async def __starter(self):
         async with trio.open_nursery() as nursery:
+            self.nursery = nursery
+            self.trio_token = trio.lowlevel.current_trio_token()
+            self.vm_thread_id = threading.get_ident()
+            self.vm_thread_started.set()
+
             nursery.start_soon(self.task_spawner, nursery)
             logger.info("Started task spawner.")
 
-            nursery.start_soon(self.future_task_serializer)
-            logger.info("Started future task serializer.")
+            nursery.start_soon(self.future_scheduler.run)
+            logger.info("Started future task scheduler.")
+
+            nursery.start_soon(self.execution_info_writer.run)
+            logger.info("Started execution info writer.")
+
+            nursery.start_soon(self.future_task_journal.run)
+            logger.info("Started future task journal.")
+
+            nursery.start_soon(self.rule_snapshot.run, self.RULE_SNAPSHOT_INTERVAL)
+            logger.info("Started rule snapshot writer.")
 
             nursery.start_soon(self.update_interface)
             logger.info("Started update interface.")
@@ -99,13 +214,13 @@ class VM:
     #     while self.run_vm_thread:
     #         # Your code goes here
 
-    #         tmp_rule_list = list(map(lambda x: str(x), self.LIST_OF_RULES))
+    #         tmp_rule_list = list(map(lambda x: str(x), self.RULE_REGISTRY))
     #         r.set("list_of_rules", json.dumps(tmp_rule_list))
 
     #         future_task_awaiting = list(map(lambda x: str(x), self.FUTURE_TASKS_AWAITING_COMPLETION))
     #         r.set("future_task_awaiting", json.dumps(future_task_awaiting))
 
-    #         # for x in self.LIST_OF_RULES:
+    #         # for x in self.RULE_REGISTRY:
     #         #     r.lpush('list_of_rules', str(x))
 
     #         # for x in self.FUTURE_TASKS_AWAITING_COMPLETION:
@@ -117,177 +232,88 @@ class VM:
 
 
 
-    async def future_task_serializer(self):
-        while self.run_vm_thread:
-            # Every 5 seconds serialize the contents of FUTURE_TASKS_AWAITING_COMPLETION list
-            await trio.sleep(5)
-            # logger.info("Starting FUTURE_TASKS serialization")
-
-            def f():
-                pickle.dump(
-                    self.FUTURE_TASKS_AWAITING_COMPLETION,
-                    self.FUTURE_TASK_LIST_FILE_HANDLER,
-                )
-                self.last_serialized_rules = self.FUTURE_TASKS_AWAITING_COMPLETION
-                self.FUTURE_TASK_LIST_FILE_HANDLER.flush()
-
-            if self.last_serialized_rules != self.FUTURE_TASKS_AWAITING_COMPLETION:
-                logger.info(
-                    f"{len(self.FUTURE_TASKS_AWAITING_COMPLETION)} rules are being serialized to disk."
-                )
-                await trio.to_thread.run_sync(f)
-
-            else:
-                pass
-                # logger.info("No rules have changed. Nothing to serialize.")
-
     async def task_spawner(self, nursery):
-        while self.run_vm_thread:
-
-            # Look into active task_queue and run any rules if available
-            if not self.task_queue.empty():
-                rule_obj = self.task_queue.get_nowait()
-                if rule_obj.enabled:
-                    nursery.start_soon(self.__executor, nursery, rule_obj)
-                    logger.info(f"Spawned a new task inside the VM: {rule_obj}")
-                    self.TASKS_RUNNING += 1
-
-                else:
-                    logger.info(
-                        f"{rule_obj} is currently disabled. Skipping execution."
-                    )
-
-            # Spawn new tasks that come into future_tasks_queue
-            if not self.future_task_queue.empty():
-                rule_obj, time_to_wait = self.future_task_queue.get_nowait()
-                if rule_obj.enabled:
-                    nursery.start_soon(self.__future_executor, rule_obj, time_to_wait)
-                    logger.info(
-                        f"{rule_obj} will be added as an active task in {time_to_wait} seconds"
-                    )
-                    self.FUTURE_TASK_COUNT += 1
-                else:
-                    logger.info(
-                        f"Future task queue: {rule_obj} is currently disabled. Skipping execution."
-                    )
-
-            await trio.sleep(0)
-
-    async def __future_executor(self, rule_obj, time_to_wait):
-        """Wait for `time_to_wait` seconds and then execute the rule."""
-        await trio.sleep(
-            time_to_wait + 2
-        )  # Add 2 seconds for definite execution next time
-        self.execute_rule(rule_obj)
-        logger.info(f"Added {rule_obj} back to active task queue")
-
-        # Once the rule is scheduled for execution, remove it from FUTURE_TASKS list
+        # Rules are taken from the highest priority lane whenever one of the
+        # MAX_RUNNING_RULES evaluation slots is free, the rest keep waiting
+        execution_slots = trio.Semaphore(self.MAX_RUNNING_RULES)
+        while True:
+            await execution_slots.acquire()
+            lane, (rule_obj, coalesced) = await self.task_admission.get()
+            logger.debug(f"Took {rule_obj} from the {lane} lane")
+            self.__spawn(nursery, rule_obj, coalesced, release=execution_slots.release)
 
-        self.FUTURE_TASK_COUNT -= 1
+    @staticmethod
+    def is_coalesced(rule_obj):
+        # Immediate rules share their id, so they can't be coalesced
+        return rule_obj.id != "immediate"
+
+    def __spawn(self, nursery, rule_obj, coalesced=False, release=None):
+        # `coalesced` is True for rules admitted by the coalescer in execute_rule,
+        # `release` frees the evaluation slot taken by the task spawner
+        if rule_obj.enabled:
+            nursery.start_soon(self.__executor, nursery, rule_obj, coalesced, release)
+            logger.info(f"Spawned a new task inside the VM: {rule_obj}")
+            self.TASKS_RUNNING += 1
 
-    async def __executor(self, nursery, rule):
-        """Evaluates a rule using a stack."""
+        else:
+            logger.info(f"{rule_obj} is currently disabled. Skipping execution.")
+            if release is not None:
+                release()
+            if coalesced:
+                self.rule_coalescer.discard(rule_obj.id)
+            self.__remove_task_from_future_awaiting_completion(rule_obj)
+
+    def __run_future_tasks(self, rule_objs):
+        """Called by the future scheduler with every rule due in the current tick."""
+        logger.info(f"{len(rule_objs)} future task(s) are due for execution")
+        for rule_obj in rule_objs:
+            self.__admit(rule_obj, False, admission.TIMER)
+
+    def __admit(self, rule_obj, coalesced, lane):
+        # Coalesced rules are queued at most once per id, other handles are all distinct
+        key = rule_obj.id if coalesced else rule_obj.rule_uuid
+        self.task_admission.offer(lane, key, (rule_obj, coalesced))
+
+    def __dropped_task(self, lane, entry):
+        """Called by the admission queue for every rule it had to drop."""
+        rule_obj, coalesced = entry
+        if coalesced:
+            self.rule_coalescer.discard(rule_obj.id)
+        # A dropped future task must not keep the rule from being triggered again
+        self.__remove_task_from_future_awaiting_completion(rule_obj)
+
+    async def __executor(self, nursery, rule, coalesced=False, release=None):
+        """Evaluates a rule using its compiled evaluation tree."""
         logger.info(f"Executing: {rule}")
-        # Stack used for evaluating a rule
-        stack = []
-
-        # Evaluate each expression
-        for instruction in rule.instruction_stream:
-
-            # If the instruction is a logical AND,
-            # Pop operands from stack and perform AND operation
-            # And put the result back into the stack
-            if instructions.InstructionConstant.LOGICAL_AND == instruction:
-                # Pop values from stack
-                op1 = stack.pop()
-                op2 = stack.pop()
-
-                logger.debug(f"Evaluating AND instruction - {op1} AND {op2}")
-
-                # Evaluate op1
-                op1_value = None
-                if isinstance(op1, instructions.BaseInstruction):
-                    # If it's an instruction, evaluate it
-                    op1_value = await op1.evaluate(self)
-                else:
-                    # It's probably only a bool value
-                    op1_value = op1
-
-                # Evaluate op2
-                op2_value = None
-                if isinstance(op2, instructions.BaseInstruction):
-                    # If it's an instruction evaluate it
-                    op2_value = await op2.evaluate(self)
-                else:
-                    # It's probably only a bool value
-                    op2_value = op2
-
-                # Perform logical AND and push it to stack
-                stack.append(op1_value and op2_value)
-
-            # If the instruction is a logical OR,
-            # Pop operands from stack and perform OR operation
-            # And put the result back into the stack
-            elif instructions.InstructionConstant.LOGICAL_OR == instruction:
-                # Pop values from stack
-                op1 = stack.pop()
-                op2 = stack.pop()
-
-                logger.debug(f"Evaluating OR instruction - {op1} OR {op2}")
-
-                # Evaluate op1
-                op1_value = None
-                if isinstance(op1, instructions.BaseInstruction):
-                    # If it's an instruction, evaluate it
-                    op1_value = await op1.evaluate()
-                else:
-                    # It's probably only a bool value
-                    op1_value = op1
-
-                # Evaluate op2
-                op2_value = None
-                if isinstance(op2, instructions.BaseInstruction):
-                    # If it's an instruction evaluate it
-                    op2_value = await op2.evaluate()
-                else:
-                    # It's probably only a bool value
-                    op2_value = op2
-
-                # Perform logical AND and push it to stack
-                stack.append(op1_value or op2_value)
-
-            # It's probably an operand, just put it in the stack
-            else:
-                logger.debug(f"Appending instruction {instruction} to stack.")
-                stack.append(instruction)
-
-        last_item = stack.pop()
+        if coalesced:
+            self.rule_coalescer.start(rule.id)
 
-        execute_action = False
-        # If the last value is an Instruction, then the entire rule only had one instruction.
-        # So evaluate the instruction and simply return it's value
-        if isinstance(last_item, instructions.BaseInstruction):
-            logger.info("Last item in stack is an unevaluated instruction.")
-            execute_action = await last_item.evaluate(self)
-            logger.debug(f"Evaluation of {rule} returned {execute_action}")
-            self.TASKS_RUNNING -= 1
-
-        # It's just a boolean value, return it directly
-        else:
-            logger.debug(f"Evaluation of {rule} returned {last_item}")
-            self.TASKS_RUNNING -= 1
-            execute_action = last_item
+        # Every device is read at most once while evaluating this rule
+        context = EvaluationContext(
+            rule, self.device_state, self.device_history, self.state_transitions
+        )
+        try:
+            execute_action = await rule.evaluate(self, context)
+        finally:
+            # Only evaluations take a slot, actions run outside of it
+            if release is not None:
+                release()
+        logger.debug(f"Evaluation of {rule} returned {execute_action}")
+        self.TASKS_RUNNING -= 1
+        self.evaluated_rules += 1
 
         # Code to perform action
         if execute_action:
-            # Update rule information
+            # Update rule information, written back to Firestore in the background
             if rule.id != "immediate":
-                await rule.update_execution_info()
+                self.execution_info_writer.record(
+                    "rules", rule.id, rule.record_execution()
+                )
 
             logger.info(f"Executing {len(rule.action_stream)} action(s)")
             for action in rule.action_stream:
                 logger.info(f"Spawned a new task to execute {action}")
-                nursery.start_soon(action.perform)
+                nursery.start_soon(action.perform, context)
 
         else:
             logger.info("Rule did not evaluate to True. No actions will be executed.")
@@ -296,14 +322,50 @@ class VM:
         # If it belongs to that list
         self.__remove_task_from_future_awaiting_completion(rule)
 
-    def execute_rule(self, rule):
-        # This function will not return anything, it would directly execute the rule
-        self.task_queue.put(rule)
+        # Triggers that arrived during the evaluation are served by a single re-run
+        if coalesced and self.rule_coalescer.finish(rule.id):
+            rule_obj = self.RULE_REGISTRY.get(rule.id)
+            if rule_obj is None:
+                self.rule_coalescer.discard(rule.id)
+            else:
+                logger.info(f"{rule_obj} was triggered while running. Running it again.")
+                self.__admit(rule_obj, True, admission.TRIGGER)
+
+    def execute_rule(self, rule, lane=admission.TRIGGER):
+        # This function will not return anything, the rule is queued in `lane`
+        # and executed by the task spawner. Never blocks the calling thread.
+        coalesced = self.is_coalesced(rule)
+        if coalesced and not self.rule_coalescer.admit(rule.id):
+            # Already waiting, make sure it doesn't wait in a lower priority lane
+            self.task_admission.promote(rule.id, lane)
+            logger.info(
+                f"{rule} is already queued or running. "
+                f"{self.SUPPRESSED_TRIGGER_COUNT} trigger(s) suppressed so far."
+            )
+            return
+
+        self.__admit(rule, coalesced, lane)
 
     def stop(self):
         logger.info("Shutting down VM thread. Awaiting join.")
         self.run_vm_thread = False
+        self.vm_thread_started.wait()
+        try:
+            # Don't lose execution info and journal records that haven't been written yet
+            trio.from_thread.run(
+                self.execution_info_writer.flush, trio_token=self.trio_token
+            )
+            trio.from_thread.run(
+                self.future_task_journal.flush, trio_token=self.trio_token
+            )
+            trio.from_thread.run_sync(
+                self.nursery.cancel_scope.cancel, trio_token=self.trio_token
+            )
+        except trio.RunFinishedError:
+            pass
         self.vm_thread.join()
+        self.future_task_journal.close()
+        self.rule_snapshot.save()
 
     def waited_stop(self):
         # Stops for all currently executing tasks to finish and then shuts down the VM
@@ -491,8 +553,7 @@ class VM:
                     conditions=document["conditions"],
                     actions=document["actions"],
                 )
-                if rule_obj not in self.LIST_OF_RULES:
-                    self.LIST_OF_RULES.append(rule_obj)
+                self.RULE_REGISTRY.add(rule_obj)
 
             except ValidationError as e:
                 logger.error(
@@ -508,32 +569,51 @@ class VM:
         logger.info(f"{len(list_of_rules)} rules were loaded in VM")
 
         # Execute the rules
-        for r in self.LIST_OF_RULES:
-            self.execute_rule(r)
+        for r in self.RULE_REGISTRY:
+            self.execute_rule(r, admission.BULK)
 
     def rule_in_future_task_list(self, rule: rule.Rule):
-        for rule_obj in self.FUTURE_TASKS_AWAITING_COMPLETION:
-            if rule == rule_obj:
-                # We found an rule objects with same ID
-                return True
+        return self.FUTURE_TASKS_AWAITING_COMPLETION.has_rule(rule.id)
+
+    def update_device_state(self, device_id, family, data_packet, timestamp=None):
+        """Cache the state carried by a PubSub message so instructions don't have to read it back."""
+        if not isinstance(data_packet, dict):
+            logger.error(f"Unexpected message format from {device_id}. Not caching it.")
+            return
+
+        reading = self.device_state.update(device_id, family, data_packet, timestamp)
+        self.device_history.record(device_id, reading)
+        self.state_transitions.observe_reading(device_id, reading)
+
+    def process_reading(self, device_id, family, data_packet, timestamp=None):
+        """Cache a reading from PubSub and execute the rules that depend on the device."""
+        self.process_readings(device_id, [(family, data_packet, timestamp)])
+
+    def process_readings(self, device_id, readings):
+        """Cache readings of one device, (family, data_packet, timestamp) oldest first,
+        then execute the rules that depend on the device once.
 
-        # We haven't found shit, return false
-        return False
+        Readings of devices none of this partition's rules depend on are cached
+        too, so the state is current if one of them becomes owned here later.
+        """
+        for family, data_packet, timestamp in readings:
+            self.update_device_state(device_id, family, data_packet, timestamp)
+        self.execute_all_dependent_rules(device_id)
 
     def execute_all_dependent_rules(self, device_id):
-        for r in self.LIST_OF_RULES:
-            if device_id in r.dependent_devices:
-                # Rule should not be scheduled for execution in FUTURE_TASKS
-                if not self.rule_in_future_task_list(r):
-                    self.execute_rule(r)
-                    logger.info(
-                        f"{r} scheduled for execution because new data arrived from {device_id}"
-                    )
+        for r in self.RULE_REGISTRY.rules_for_device(device_id):
+            # Rule should not be scheduled for execution in FUTURE_TASKS
+            if not self.rule_in_future_task_list(r):
+                self.triggered_rules += 1
+                self.execute_rule(r)
+                logger.info(
+                    f"{r} scheduled for execution because new data arrived from {device_id}"
+                )
 
-                else:
-                    logger.info(
-                        f"{r} already scheduled for execution in FUTURE_TASK_QUEUE"
-                    )
+            else:
+                logger.info(
+                    f"{r} already scheduled for execution in FUTURE_TASK_QUEUE"
+                )
 
     def document_to_rule_obj(self, document) -> rule.Rule:
         doc_id = document.id
@@ -547,6 +627,7 @@ class VM:
                 enabled=document["enabled"],
                 conditions=document["conditions"],
                 actions=document["actions"],
+                max_concurrency=int(document.get("max_concurrency", 1)),
             )
 
             if "execution_count" in document:
@@ -564,112 +645,233 @@ class VM:
             logger.error(f"Some unknown error occurred. Error: {e}")
 
     def add_rule(self, document):
-        prev_rule_count = len(self.LIST_OF_RULES)
+        prev_rule_count = len(self.RULE_REGISTRY)
         rule_obj = self.document_to_rule_obj(document)
-        if rule_obj is not None and rule_obj not in self.LIST_OF_RULES:
-            logger.debug(f"Added {rule_obj} to LIST_OF_RULES")
-            self.LIST_OF_RULES.append(rule_obj)
+        if rule_obj is not None and self.RULE_REGISTRY.add(rule_obj):
+            logger.debug(f"Added {rule_obj} to RULE_REGISTRY")
+            self.state_transitions.subscribe(rule_obj.transition_channels)
 
-            # Just for the time being
-            self.execute_rule(rule_obj)
+            due = self.restored_future_tasks.pop(rule_obj.id, None)
+            if due is not None:
+                self.restore_future_task(rule_obj, due)
+            else:
+                # Just for the time being
+                self.execute_rule(rule_obj, admission.BULK)
 
         logger.debug(
-            f"Rule count before addition: {prev_rule_count} and after {len(self.LIST_OF_RULES)}"
+            f"Rule count before addition: {prev_rule_count} and after {len(self.RULE_REGISTRY)}"
         )
 
-    def remove_all_future_task_of_this_string(self,str, array):
-        return [i for i in array if i != str]
+    def cancel_future_task(self, rule_id):
+        """Drop the pending future task of `rule_id` and its timer. Returns True if there was one."""
+        task = self.FUTURE_TASKS_AWAITING_COMPLETION.remove_by_id(rule_id)
+        if task is None:
+            return False
+
+        self.future_scheduler.cancel(task.rule.rule_uuid)
+        self.future_task_journal.cancel(rule_id)
+        return True
 
     def update_rule(self, document):
-        prev_rule_count = len(self.LIST_OF_RULES)
+        prev_rule_count = len(self.RULE_REGISTRY)
         rule_obj = self.document_to_rule_obj(document)
-
-        if rule_obj is not None and rule_obj in self.LIST_OF_RULES:
-            i = 0
-            while i < len(self.LIST_OF_RULES):
-                if rule_obj == self.LIST_OF_RULES[i]:
-                    self.LIST_OF_RULES[i] = rule_obj
-                    logger.debug(f"{rule_obj} was updated in LIST_OF_RULES")
-                    break
-                i += 1
+        if rule_obj is None:
+            return
+
+        previous = self.RULE_REGISTRY.replace(rule_obj)
+        # Subscribed first, channels used by both versions keep their state
+        self.state_transitions.subscribe(rule_obj.transition_channels)
+        if previous is not None:
+            logger.debug(f"{rule_obj} was updated in RULE_REGISTRY")
+            self.state_transitions.unsubscribe(previous.transition_channels)
         else:
-            logger.debug(f"{rule_obj} was not found in LIST_OF_RULES. Adding it.")
-            self.LIST_OF_RULES.append(rule_obj)
             logger.debug(
-                f"{rule_obj} was added to the list. Since it was not present during the update."
+                f"{rule_obj} was added to the registry. Since it was not present during the update."
             )
 
             # Just for the time being
-            self.execute_rule(rule_obj)
+            self.execute_rule(rule_obj, admission.BULK)
         
-        if(any(p.id == rule_obj.id for p in self.FUTURE_TASKS_AWAITING_COMPLETION)):
-            logger.info(f"Removing {rule_obj.id} from future awaiting task list.")
-            self.FUTURE_TASKS_AWAITING_COMPLETION = self.remove_all_future_task_of_this_string(rule_obj.id, self.FUTURE_TASKS_AWAITING_COMPLETION)
+        if self.cancel_future_task(rule_obj.id):
+            logger.info(f"Removed {rule_obj.id} from future awaiting task list.")
 
-        # Just for the time being
-            self.execute_rule(rule_obj)
+            # Just for the time being
+            self.execute_rule(rule_obj, admission.BULK)
 
         logger.debug(
-            f"Rule count before addition: {prev_rule_count} and after {len(self.LIST_OF_RULES)}"
+            f"Rule count before addition: {prev_rule_count} and after {len(self.RULE_REGISTRY)}"
         )
 
     def remove_rule(self, document):
-        prev_rule_count = len(self.LIST_OF_RULES)
-        rule_obj = self.document_to_rule_obj(document)
-
-        try:
-            self.LIST_OF_RULES.remove(rule_obj)
-            logger.debug(f"{rule_obj} was removed from LIST_OF_RULES")
-        except ValueError:
+        # Only the id is needed, no need to parse the removed document
+        self.remove_rule_by_id(document.id)
+        # Its document is gone, buffered execution info can't be written anymore
+        self.execution_info_writer.discard("rules", document.id)
+
+    def remove_rule_by_id(self, rule_id):
+        prev_rule_count = len(self.RULE_REGISTRY)
+        rule_obj = self.RULE_REGISTRY.remove(rule_id)
+
+        if rule_obj is not None:
+            logger.debug(f"{rule_obj} was removed from RULE_REGISTRY")
+            self.cancel_future_task(rule_obj.id)
+            self.state_transitions.unsubscribe(rule_obj.transition_channels)
+        else:
             logger.debug(
-                f"{rule_obj} was not found in the LIST_OF_RULES. So nothing to remove :D"
+                f"{rule_id} was not found in the RULE_REGISTRY. So nothing to remove :D"
             )
         logger.debug(
-            f"Rule count before addition: {prev_rule_count} and after {len(self.LIST_OF_RULES)}"
+            f"Rule count before addition: {prev_rule_count} and after {len(self.RULE_REGISTRY)}"
         )
 
     def rule_changed_callback(self, col_snapshot, changes, read_time):
         for change in changes:
+            if change.type.name != "REMOVED" and not self.owns_rule_document(change.document):
+                # Owned by another partition, it may have moved there after its devices changed
+                if change.document.id in self.RULE_REGISTRY:
+                    logger.info(f"Rule {change.document.id} moved to another partition")
+                    self.remove_rule_by_id(change.document.id)
+                self.unconfirmed_snapshot_rules.discard(change.document.id)
+                self.rule_snapshot.remove(change.document.id)
+                continue
+
             if change.type.name == "ADDED":
                 logger.info(f"Rule was ADDED - {change.document.id}")
-                self.add_rule(change.document)
+                if change.document.id in self.unconfirmed_snapshot_rules:
+                    self.reconcile_snapshot_rule(change.document)
+                else:
+                    self.add_rule(change.document)
+                self.rule_snapshot.update(change.document)
             elif change.type.name == "MODIFIED":
                 logger.info(f"Rule was MODIFIED - {change.document.id}")
                 self.update_rule(change.document)
+                self.rule_snapshot.update(change.document)
             elif change.type.name == "REMOVED":
                 logger.info(f"Rule was REMOVED - {change.document.id}")
                 self.remove_rule(change.document)
+                self.rule_snapshot.remove(change.document.id)
+
+        # The first snapshot has every rule, snapshot rules it didn't confirm
+        # were deleted while the VM was down
+        for rule_id in list(self.unconfirmed_snapshot_rules):
+            logger.info(f"Rule {rule_id} from the snapshot no longer exists. Removing it.")
+            self.remove_rule_by_id(rule_id)
+            self.rule_snapshot.remove(rule_id)
+        self.unconfirmed_snapshot_rules = set()
+
+        # The first snapshot has every rule, restored tasks left over belong to
+        # rules deleted while the VM was down
+        for rule_id in list(self.restored_future_tasks):
+            logger.info(f"Rule {rule_id} no longer exists. Dropping its restored future task.")
+            self.future_task_journal.cancel(rule_id)
+        self.restored_future_tasks = {}
+
+    def rebalance(self):
+        """Called after the partition changed, drops rules it no longer owns and loads the new ones."""
+        dropped = 0
+        for rule_obj in self.RULE_REGISTRY.rules():
+            if not self.partition.owns_key(
+                sharding.home_key(rule_obj.id, rule_obj.dependent_devices)
+            ):
+                self.remove_rule_by_id(rule_obj.id)
+                self.rule_snapshot.remove(rule_obj.id)
+                dropped += 1
+
+        added = 0
+        for document in store.get_all_rules():
+            if document.id not in self.RULE_REGISTRY and self.owns_rule_document(document):
+                self.add_rule(document)
+                self.rule_snapshot.update(document)
+                added += 1
+
+        logger.info(
+            f"Rebalanced {self.partition}: dropped {dropped} rule(s), took over {added}. "
+            f"{len(self.RULE_REGISTRY)} rule(s) loaded."
+        )
+
+    def load_rule_snapshot(self):
+        """Build the rules saved in the local snapshot, before Firestore delivers them."""
+        documents = [
+            document
+            for document in self.rule_snapshot.load()
+            if self.owns_rule_document(document)
+        ]
+        for document in documents:
+            self.add_rule(document)
+        self.unconfirmed_snapshot_rules = {document.id for document in documents}
+
+    def reconcile_snapshot_rule(self, document):
+        """Called with the Firestore document of a rule loaded from the snapshot."""
+        self.unconfirmed_snapshot_rules.discard(document.id)
+        if (
+            document.id in self.RULE_REGISTRY
+            and self.rule_snapshot.version(document.id) == snapshot.document_version(document)
+        ):
+            logger.debug(f"Rule {document.id} is unchanged since the snapshot")
+            return
+
+        logger.info(f"Rule {document.id} changed since the snapshot. Rebuilding it.")
+        self.update_rule(document)
 
     def sync_rules(self):
+        if self.load_rules_from_disk:
+            self.load_rule_snapshot()
+
         firestore = store.store
         rules_col = firestore.collection("rules")
         rules_col.on_snapshot(self.rule_changed_callback)
         logger.info("Started the 'rules' collection watcher.")
 
     def add_rule_for_future_exec(self, rule_obj, time_to_execution):
+        due = time.time() + time_to_execution + self.FUTURE_TASK_GRACE_PERIOD
+        if self.schedule_future_task(rule_obj, due):
+            logger.info(
+                f"{rule_obj} will be added as an active task in {time_to_execution} seconds"
+            )
+
+    def restore_future_task(self, rule_obj, due):
+        """Schedule a future task restored from the journal at its original due time.
+
+        Tasks that became due while the VM was down are paced by the backlog pacer
+        instead of all running at once. The rule itself is not executed until then.
+        """
+        now = time.time()
+        if due <= now:
+            logger.info(f"Restored future task of {rule_obj} is {now - due:.0f} seconds overdue")
+            due = self.restored_backlog_pacer.due(now)
+        else:
+            logger.info(f"Restored future task of {rule_obj} is due in {due - now:.0f} seconds")
+        self.schedule_future_task(rule_obj, due)
+
+    def schedule_future_task(self, rule_obj, due):
+        """Execute `rule_obj` at `due` (a timestamp). Returns False if it was already scheduled later."""
+        # A rule has at most one pending future task, the later deadline wins
+        pending_task = self.FUTURE_TASKS_AWAITING_COMPLETION.get(rule_obj.id)
+        if pending_task is not None and pending_task.due >= due:
+            logger.debug(
+                f"{rule_obj} is already scheduled for a later execution. Skipping."
+            )
+            return False
+
         # Update rule_uuid to make sure the parent rule that added itself to FUTURE_TASKS_AWAITING_COMPLETION list
         # doesn't remove itself on finishing it's execution. So the parent's rule UUID and child's rule UUID
-        # should be different. Hence we need to create a new rule_object clone.
+        # should be different. The clone is a new handle sharing the parsed rule template.
         new_rule_obj = rule_obj.create_clone()
-        self.FUTURE_TASKS_AWAITING_COMPLETION.append(new_rule_obj)
-        self.future_task_queue.put((new_rule_obj, time_to_execution))
+        replaced_task = self.FUTURE_TASKS_AWAITING_COMPLETION.add(new_rule_obj, due)
+        if replaced_task is not None:
+            self.future_scheduler.cancel(replaced_task.rule.rule_uuid)
+
+        self.future_scheduler.schedule(new_rule_obj.rule_uuid, due, new_rule_obj)
+        # Immediate rules aren't in the registry, they can't be restored
+        if rule_obj.id != "immediate":
+            self.future_task_journal.schedule(rule_obj.id, due)
+        return True
 
     def __remove_task_from_future_awaiting_completion(self, rule_obj):
         logger.debug(f"Looking for {rule_obj} in FUTURE_TASKS_AWAITING_COMPLETION")
-        i = 0
-        found = False
-        for r in self.FUTURE_TASKS_AWAITING_COMPLETION:
-            if r.rule_uuid == rule_obj.rule_uuid:
-                logger.debug(
-                    f"Rule found at index {i} in FUTURE_TASKS_AWAITING_COMPLETION"
-                )
-                found = True
-                break
-            i += 1
-
-        if found:
-            self.FUTURE_TASKS_AWAITING_COMPLETION.pop(i)
+        if self.FUTURE_TASKS_AWAITING_COMPLETION.remove_by_uuid(rule_obj.rule_uuid):
             logger.debug(f"Removed {rule_obj} from list of awaiting completion tasks.")
+            self.future_task_journal.cancel(rule_obj.id)
         else:
             logger.debug(
                 f"{rule_obj} was not found in FUTURE_TASKS_AWAITING_COMPLETION."
@@ -0,0 +1,78 @@
+import trio
+from loguru import logger
+
+
+class WriteBehindBuffer:
+    """Collects document updates and writes them back in batches.
+
+    Updates to the same document are merged, the latest value of each field
+    wins. The buffer is flushed every `flush_interval` seconds, or as soon as
+    `max_pending` documents are waiting. `commit` is an async callable taking
+    a list of (collection, document, data) tuples, it may return the
+    (collection, document) pairs that don't exist anymore. Their updates are
+    dropped instead of retried.
+    """
+
+    def __init__(self, commit, flush_interval=5, max_pending=100):
+        self.commit = commit
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (collection, document) -> fields to update
+        self._pending = {}
+        self._flush_requested = trio.Event()
+        self.flushed_updates = 0
+        self.failed_flushes = 0
+        self.missing_documents = 0
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def record(self, collection: str, document: str, data):
+        key = (collection, document)
+        self._pending[key] = {**self._pending.get(key, {}), **data}
+        if len(self._pending) >= self.max_pending:
+            self._flush_requested.set()
+
+    def discard(self, collection: str, document: str):
+        """Drop the pending update of a document, e.g. because it was deleted."""
+        self._pending.pop((collection, document), None)
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        updates = self._pending
+        self._pending = {}
+        try:
+            missing = await self.commit(
+                [(collection, document, data) for (collection, document), data in updates.items()]
+            ) or []
+            self.flushed_updates += len(updates) - len(missing)
+            self.missing_documents += len(missing)
+            for collection, document in missing:
+                logger.warning(f"{collection}/{document} no longer exists. Dropped its update.")
+            logger.debug(f"Flushed {len(updates)} buffered document update(s).")
+
+        except Exception as e:
+            # Put the updates back, anything recorded in the meantime is newer
+            for key, data in updates.items():
+                self._pending[key] = {**data, **self._pending.get(key, {})}
+            self.failed_flushes += 1
+            logger.error(
+                f"Unable to flush {len(updates)} buffered document update(s). Error: {e}"
+            )
+
+    async def run(self):
+        while True:
+            with trio.move_on_after(self.flush_interval):
+                await self._flush_requested.wait()
+
+            self._flush_requested = trio.Event()
+            await self.flush()
+
+    def __str__(self):
+        return f"<WriteBehindBuffer: {self.pending} pending>"
+
+    def __repr__(self):
+        return self.__str__()